@@ -0,0 +1,295 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import asdict
+
+import numpy as np
+from PIL import Image
+from nbt import nbt
+
+import render
+from config import Config
+from database import open_database
+from image import create_image_handler
+from region_scan import SECTOR_SIZE
+from snapshot import GAMMA
+from tile_math import get_chunk_padding_top, get_tiles_for_chunks, get_tile_last_modified
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_chunk_nbt(chunk_x: int, chunk_z: int, complete: bool, sections: int, rng: np.random.Generator) -> bytes:
+    """
+    Returns the uncompressed NBT of a chunk with the given number of stone sections, from the bottom of the world
+    up, each with a block state array of random data like real chunks have.
+    """
+    chunk = nbt.NBTFile()
+    chunk.tags.append(nbt.TAG_Int(name="xPos", value=chunk_x))
+    chunk.tags.append(nbt.TAG_Int(name="zPos", value=chunk_z))
+    chunk.tags.append(nbt.TAG_Long(name="LastUpdate", value=int(rng.integers(0, 1 << 30))))
+    chunk.tags.append(nbt.TAG_String(name="Status", value="minecraft:full" if complete else "minecraft:noise"))
+    chunk.tags.append(nbt.TAG_List(name="block_entities", type=nbt.TAG_Compound))
+    section_list = nbt.TAG_List(name="sections", type=nbt.TAG_Compound)
+    for section_y in range(-4, -4 + sections):
+        section = nbt.TAG_Compound()
+        section.tags.append(nbt.TAG_Byte(name="Y", value=section_y))
+        block_states = nbt.TAG_Compound(name="block_states")
+        palette = nbt.TAG_List(name="palette", type=nbt.TAG_Compound)
+        for block_name in ("minecraft:stone", "minecraft:dirt"):
+            block_state = nbt.TAG_Compound()
+            block_state.tags.append(nbt.TAG_String(name="Name", value=block_name))
+            palette.tags.append(block_state)
+        block_states.tags.append(palette)
+        data = nbt.TAG_Long_Array(name="data")
+        data.value = rng.integers(-(1 << 62), 1 << 62, 64).tolist()
+        block_states.tags.append(data)
+        section.tags.append(block_states)
+        section_list.tags.append(section)
+    chunk.tags.append(section_list)
+    # Like the heightmaps and light Minecraft saves after the sections, which the scan doesn't need to read
+    heightmaps = nbt.TAG_Compound(name="Heightmaps")
+    for heightmap_name in ("MOTION_BLOCKING", "OCEAN_FLOOR", "WORLD_SURFACE"):
+        heightmap = nbt.TAG_Long_Array(name=heightmap_name)
+        heightmap.value = rng.integers(0, 1 << 62, 37).tolist()
+        heightmaps.tags.append(heightmap)
+    chunk.tags.append(heightmaps)
+
+    buffer = io.BytesIO()
+    chunk.write_file(buffer=buffer)
+    return buffer.getvalue()
+
+
+def write_region(path: str, chunks: dict[int, tuple[bytes, int]]):
+    """
+    Writes a region file from a dict of chunk slot, x + z * 32, to the uncompressed NBT and timestamp of the chunk.
+    """
+    locations = np.zeros(1024, dtype=">u4")
+    timestamps = np.zeros(1024, dtype=">u4")
+    body = bytearray()
+    for index, (data, timestamp) in sorted(chunks.items()):
+        compressed = zlib.compress(data)
+        sector_data = struct.pack(">IB", len(compressed) + 1, 2) + compressed
+        sector_data += b"\0" * (-len(sector_data) % SECTOR_SIZE)
+        locations[index] = ((2 + len(body) // SECTOR_SIZE) << 8) | (len(sector_data) // SECTOR_SIZE)
+        timestamps[index] = timestamp
+        body += sector_data
+
+    with open(path, "wb") as f:
+        f.write(locations.tobytes())
+        f.write(timestamps.tobytes())
+        f.write(body)
+
+
+def generate_world(world_path: str, size: int, incomplete: float, timestamp_spread: int, seed: int = 0):
+    """
+    Writes a square world of size by size chunks centred on the origin. incomplete is the share of chunks that
+    aren't fully generated and timestamp_spread the number of seconds their timestamps are spread over.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(world_path, "region"), exist_ok=True)
+    regions = defaultdict(dict)
+    base_timestamp = 1_700_000_000
+    for chunk_x in range(-size // 2, size - size // 2):
+        for chunk_z in range(-size // 2, size - size // 2):
+            complete = rng.random() >= incomplete
+            sections = int(rng.integers(5, 20))
+            timestamp = base_timestamp + int(rng.integers(0, timestamp_spread + 1))
+            regions[(chunk_x >> 5, chunk_z >> 5)][(chunk_x & 31) + (chunk_z & 31) * 32] = \
+                (make_chunk_nbt(chunk_x, chunk_z, complete, sections, rng), timestamp)
+
+    for (region_x, region_z), chunks in regions.items():
+        write_region(os.path.join(world_path, "region", f"r.{region_x}.{region_z}.mca"), chunks)
+
+
+def stand_in_chunky(config: Config, chunky_args: list[str]):
+    """
+    Takes the place of run_chunky. Writes a snapshot of the size and format the scene asks for, with content that
+    only depends on the camera position.
+    """
+    scene_path = chunky_args[-1]
+    with open(scene_path, "r") as f:
+        scene = json.load(f)
+    position = scene["camera"]["position"]
+    rng = np.random.default_rng([int(position["x"]) & 0xFFFFFFFF, int(position["z"]) & 0xFFFFFFFF])
+
+    width, height = scene["width"], scene["height"]
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = (x + rng.integers(0, 256)) % 256
+    pixels[..., 1] = (y + rng.integers(0, 256)) % 256
+    pixels[..., 2] = rng.integers(0, 32, (height, width)) + 96
+    pixels[..., 3] = 255
+
+    snapshot_path = os.path.join(os.path.dirname(scene_path), "snapshots", f"{scene['name']}-{scene['sppTarget']}")
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    if scene["outputMode"] == "PFM":
+        write_pfm(snapshot_path + ".pfm", (pixels[..., :3] / 255) ** GAMMA)
+    else:
+        Image.fromarray(pixels).save(snapshot_path + ".png")
+
+
+def write_pfm(path: str, pixels: np.ndarray):
+    """
+    Writes (height, width, 3) linear float pixels as a little-endian PFM file, like Chunky does.
+    """
+    height, width = pixels.shape[:2]
+    with open(path, "wb") as f:
+        f.write(f"PF\n{width} {height}\n-1.0\n".encode("ascii"))
+        f.write(np.ascontiguousarray(pixels[::-1], dtype="<f4").tobytes())
+
+
+class StageTimer:
+    """
+    Wraps functions of render to add up the time spent in them. Recursive calls of a wrapped function count once.
+    Time spent in a wrapped function called from another one is also added up under (outer name, inner name) in
+    nested, per thread, since move_image runs on the post-processing thread while Chunky runs on the main one.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.nested = defaultdict(float)
+        self.local = threading.local()
+
+    def wrap(self, name: str, function):
+        def wrapper(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            outer = stack[0] if len(stack) > 0 else None
+            counted = name not in stack
+            stack.append(name)
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.pop()
+                if counted:
+                    seconds = time.perf_counter() - start_time
+                    self.seconds[name] += seconds
+                    if outer is not None:
+                        self.nested[(outer, name)] += seconds
+        return wrapper
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(config: Config, size: int, incomplete: float, timestamp_spread: int, processes: int) -> dict:
+    """
+    Generates a world and renders it with the stand-in Chunky, in the current directory. Returns the seconds
+    each stage took along with the sizes involved.
+    """
+    stages = {}
+
+    start_time = time.perf_counter()
+    generate_world(config.world_path, size, incomplete, timestamp_spread)
+    stages["world_generation"] = time.perf_counter() - start_time
+
+    con = open_database(config)
+    cur = con.cursor()
+
+    start_time = time.perf_counter()
+    chunks = render.list_world_chunks(config, cur)
+    stages["region_scan"] = time.perf_counter() - start_time
+    chunks = [chunk for chunk in chunks if chunk.complete]
+    chunk_coords = [(chunk.x, chunk.z) for chunk in chunks]
+
+    start_time = time.perf_counter()
+    padding_top = get_chunk_padding_top(config, [chunk.height for chunk in chunks])
+    tiles = get_tiles_for_chunks(config, chunk_coords, padding_top)
+    stages["tile_planning"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    get_tile_last_modified(config, chunk_coords, [chunk.content_modified for chunk in chunks], tiles, padding_top)
+    stages["last_modified"] = time.perf_counter() - start_time
+
+    timer = StageTimer()
+    render.run_chunky = timer.wrap("chunky", stand_in_chunky)
+    render.move_image = timer.wrap("move_image", render.move_image)
+    render.check_make_zoom_tiles = timer.wrap("pyramid", render.check_make_zoom_tiles)
+    render.make_pending_zoom_tiles = timer.wrap("pending_zoom", render.make_pending_zoom_tiles)
+
+    image_handler = create_image_handler(config)
+    start_time = time.perf_counter()
+    render.render(config, image_handler)
+    stages["render"] = time.perf_counter() - start_time
+    stages["chunky_stand_in"] = timer.seconds["chunky"]
+    # Zoom tiles inside a snapshot are built from it in move_image, the rest by check_make_zoom_tiles, either from
+    # move_image or, for those whose children were rendered in other batches, from make_pending_zoom_tiles
+    stages["crop_encode"] = timer.seconds["move_image"] - timer.nested[("move_image", "pyramid")]
+    stages["pyramid"] = timer.seconds["pyramid"]
+    stages["pending_zoom"] = timer.seconds["pending_zoom"]
+
+    from rebuild import rebuild_pyramid
+    start_time = time.perf_counter()
+    rebuild_pyramid(config, image_handler, processes=processes)
+    stages["pyramid_rebuild"] = time.perf_counter() - start_time
+    image_handler.close()
+
+    tile_counts = dict(cur.execute(
+        "SELECT zoom_level, COUNT(*) FROM tiles WHERE render_name = ? GROUP BY zoom_level", (config.render_name,)
+    ).fetchall())
+    return {
+        "stages": stages,
+        "chunks": len(chunk_coords),
+        "tiles": tile_counts.get(0, 0),
+        "zoom_tiles": sum(count for zoom, count in tile_counts.items() if zoom < 0),
+    }
+
+
+if __name__ == '__main__':
+    parse = argparse.ArgumentParser(description="Renders a synthetic world with a stand-in for Chunky and times each stage")
+    parse.add_argument("--size", type=int, default=64, help="Width of the square world in chunks")
+    parse.add_argument("--incomplete", type=float, default=0.1, help="Share of chunks that aren't fully generated")
+    parse.add_argument("--timestamp-spread", type=int, default=30 * 86400, help="Seconds the chunk timestamps are spread over")
+    parse.add_argument("--tile-size", type=int, default=128, help="Tile size in pixels")
+    parse.add_argument("--format", type=str, default="png", help="Image format of the tiles")
+    parse.add_argument("--snapshot-format", type=str, default="png", help="Format of the stand-in Chunky's snapshots, png or pfm")
+    parse.add_argument("--processes", type=int, default=os.cpu_count(), help="Processes to rebuild the pyramid with")
+    parse.add_argument("--config", type=str, help="JSON file of further config values")
+    parse.add_argument("--output", type=str, help="File to write the results to as JSON. Defaults to printing them")
+    args = parse.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = Config(
+            world_path=os.path.join(directory, "world"),
+            tile_pixel_size=args.tile_size,
+            image_format=args.format,
+            snapshot_format=args.snapshot_format
+        )
+        if args.config:
+            config.load_from_dict(json.load(open(args.config, "r")))
+        # The render reads these from the working directory
+        for file_name in ("default_settings.json", "index.template.html"):
+            shutil.copyfile(os.path.join(REPO_PATH, file_name), os.path.join(directory, file_name))
+        cwd = os.getcwd()
+        os.chdir(directory)
+        # Progress goes to stderr so stdout only has the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run_benchmark(config, args.size, args.incomplete, args.timestamp_spread, args.processes)
+        os.chdir(cwd)
+
+    results = {
+        "commit": get_commit(),
+        "parameters": {"size": args.size, "incomplete": args.incomplete, "timestamp_spread": args.timestamp_spread},
+        "config": asdict(config),
+        **results,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
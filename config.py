@@ -1,25 +1,100 @@
+import dataclasses
 import math
 from dataclasses import dataclass
 
+# Blocks of height that shift a block up by one row of tiles
+TILE_ROW_HEIGHT = 16 * math.sqrt(2) / math.sin(math.radians(60))
+
+# Settings presets can't override, since all presets render from the same chunks and tiles
+SHARED_SETTINGS = {
+    "world_path", "scene_name", "tile_batch_size", "tile_render_batch_size", "tile_border_size", "tile_padding_bottom",
+    "tile_padding_top", "tile_pixel_size", "zoom_levels", "presets",
+}
+
+# Scene settings that change the octree Chunky builds from the chunks: the height range it loads, biome colours,
+# the water world and the octree format, plus the dimension under "world". The octree cache keys octrees by them, and
+# presets can't override them in their "scene", since all presets render from the octree of the first
+OCTREE_SCENE_SETTINGS = {
+    "yClipMin", "yClipMax", "yMin", "yMax", "biomeColorsEnabled", "waterWorldEnabled", "waterWorldHeight",
+    "waterWorldHeightOffsetEnabled", "waterWorldClipEnabled", "octreeImplementation", "world",
+}
+
 @dataclass
 class Config:
     world_path: str = None  # Absolute path to the world folder
     output_path: str = "~/output"
     render_name: str = "daylight"
+    # Scene presets rendered from one chunk load per batch, each a dict with a render_name, overrides of other config
+    # values such as samples_per_pixel, and "scene" overrides of default_settings.json, e.g. for the sun and sky.
+    # Each preset gets its own directory in the scene directory. None renders render_name alone
+    presets: list[dict] = None
+    scene_overrides: dict = None  # Overrides of default_settings.json, set from the "scene" of a preset
     chunky_home_path: str = "chunky"
     scene_name: str = "scene_name"
     tile_batch_size: int = 16  # Number of tiles the load the chunks for at once
     tile_render_batch_size: int = 16  # Number of tiles to render at each chunky invocation
     tile_border_size: int = 4  # Number of tiles outside the render area to load chunks for
-    tile_padding_bottom: int = math.ceil(64 / (16 * math.sqrt(2) / math.sin(math.radians(60))))
-    tile_padding_top: int = math.ceil(320 / (16 * math.sqrt(2) / math.sin(math.radians(60))))
+    tile_padding_bottom: int = math.ceil(64 / TILE_ROW_HEIGHT)
+    tile_padding_top: int = math.ceil(320 / TILE_ROW_HEIGHT)  # Upper limit, chunks use their own height when known
     tile_pixel_size: int = 384
     samples_per_pixel: int = 50
     zoom_levels: int = 8
     threads: int = 14
     use_avif: bool = False  # Use AVIF instead of PNG. Requires ffmpeg with libaom-av1
-    avif_crf: int = 20  # AVIF CRF value between 0 and 63 where lower is higher quality.
+    # AVIF CRF value between 0 and 63 where lower is higher quality. Defaults to 20 through ffmpeg and to the quality of
+    # image_preset in-process, where a set value is mapped to the matching Pillow quality instead
+    avif_crf: int = None
+    image_format: str = None  # "png", "avif" or "webp". Defaults to "avif" if use_avif is set and "png" otherwise
+    image_preset: str = "balanced"  # Encoder preset for in-process AVIF and WebP: "fast", "balanced" or "small"
+    scan_processes: int = 8  # Number of processes scanning region files in parallel
+    force_rescan: bool = False  # Scan every region file instead of only those changed since the last run
+    # Format Chunky writes snapshots in. "pfm" skips encoding and decoding a PNG of every sub-batch, but has no alpha
+    # channel, so tiles come out opaque and none are left out as empty. "png" keeps a transparent sky
+    snapshot_format: str = "png"
+    # SQLite journal mode of tiles.db and tiles.pack. "WAL" lets readers and the writer work at once, but only when all
+    # processes run on one host. Use "DELETE" when workers on several machines share the output over a network file system
+    journal_mode: str = "WAL"
+    tile_store: str = "directory"  # "directory" writes a file per tile, "packed" writes all tiles into tiles.pack in the scene directory
+    reconcile_workers: int = 16  # Number of threads listing tile directories in parallel when reconciling
+    encoder_processes: int = 1  # Number of processes encoding tiles in parallel
+    octree_cache_path: str = "chunky/octree_cache"  # Directory keeping the octrees of batches whose chunks haven't changed
+    octree_cache_size_mb: int = 0  # Megabytes of octrees kept in octree_cache_path. 0 disables the cache
+    pyramid_cache_tiles: int = 1024  # Number of decoded tiles kept in memory for zoom tiles spanning several batches
+    postprocess_queue_size: int = 2  # Snapshots that may wait for cropping and encoding while Chunky renders. 0 disables overlapping
+    metrics_path: str = None  # File to append a JSON line to for every timed stage and counter
+    prometheus_textfile: str = None  # .prom file to write stage totals to, for the node exporter's textfile collector
+    profile_path: str = None  # File to write cProfile stats of the timed stages to, for snakeviz or pstats
+    lease_duration: int = 600  # Seconds before a batch leased by an unresponsive worker is handed to another worker
+    worker_poll_interval: int = 10  # Seconds between queue checks when waiting for batches
+    watch_poll_interval: int = 10  # Seconds between checks of the region files in --watch mode where inotify isn't available
+    watch_settle_time: int = 5  # Seconds a region file must go unmodified before --watch rescans it, so it isn't read mid-save
 
     def load_from_dict(self, data: dict):
         for key, value in data.items():
             setattr(self, key, value)
+
+    def get_presets(self) -> list["Config"]:
+        """
+        Returns a config for each preset, or this config alone if there are no presets.
+        """
+        if not self.presets:
+            return [self]
+        configs = []
+        for preset in self.presets:
+            shared = SHARED_SETTINGS & preset.keys()
+            if len(shared) > 0:
+                raise ValueError(f"Presets can't override {', '.join(sorted(shared))}")
+            octree_settings = OCTREE_SCENE_SETTINGS & (preset.get("scene") or {}).keys()
+            if len(octree_settings) > 0:
+                raise ValueError(
+                    f"Presets can't override the scene settings {', '.join(sorted(octree_settings))}, which change the octree "
+                    f"all presets share. Set them in default_settings.json instead"
+                )
+            preset_config = dataclasses.replace(self)
+            preset_config.load_from_dict({key: value for key, value in preset.items() if key != "scene"})
+            preset_config.scene_overrides = preset.get("scene")
+            configs.append(preset_config)
+        render_names = [preset_config.render_name for preset_config in configs]
+        if len(set(render_names)) < len(render_names):
+            raise ValueError(f"Presets must have distinct render names: {render_names}")
+        return configs
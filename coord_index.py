@@ -0,0 +1,175 @@
+import numpy as np
+
+from tile_math import BLOCK_SIZE, COORD_OFFSET, pack_coords, unpack_coords
+
+# Zoom tiles are packed as the zoom level in the top 8 bits and x and y in 28 bits each, which holds tiles of
+# worlds far past Minecraft's border at any tile size
+ZOOM_OFFSET = 1 << 7
+ZOOM_COORD_OFFSET = 1 << 27
+ZOOM_COORD_MASK = (1 << 28) - 1
+
+
+def pack_keys(coords, dims: int) -> np.ndarray:
+    """
+    Packs (x, y) or (zoom, x, y) coordinates into 64-bit keys that sort in the same order as the coordinates.
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, dims)
+    if dims == 2:
+        return pack_coords(coords)
+    return ((coords[:, 0] + ZOOM_OFFSET).astype(np.uint64) << np.uint64(56)) | \
+        ((coords[:, 1] + ZOOM_COORD_OFFSET).astype(np.uint64) << np.uint64(28)) | \
+        (coords[:, 2] + ZOOM_COORD_OFFSET).astype(np.uint64)
+
+
+def unpack_keys(keys: np.ndarray, dims: int) -> np.ndarray:
+    if dims == 2:
+        return unpack_coords(keys)
+    keys = np.asarray(keys, dtype=np.uint64)
+    coords = np.empty((len(keys), 3), dtype=np.int64)
+    coords[:, 0] = (keys >> np.uint64(56)).astype(np.int64) - ZOOM_OFFSET
+    coords[:, 1] = ((keys >> np.uint64(28)) & np.uint64(ZOOM_COORD_MASK)).astype(np.int64) - ZOOM_COORD_OFFSET
+    coords[:, 2] = (keys & np.uint64(ZOOM_COORD_MASK)).astype(np.int64) - ZOOM_COORD_OFFSET
+    return coords
+
+
+def pack_key(coord: tuple, dims: int) -> np.uint64:
+    """
+    pack_keys for a single coordinate, without the array overhead.
+    """
+    if dims == 2:
+        return np.uint64(((coord[0] + COORD_OFFSET) << 32) | (coord[1] + COORD_OFFSET))
+    return np.uint64(((coord[0] + ZOOM_OFFSET) << 56) | ((coord[1] + ZOOM_COORD_OFFSET) << 28) | (coord[2] + ZOOM_COORD_OFFSET))
+
+
+class CoordIndex:
+    """
+    A set of (x, y) coordinates, or of (zoom, x, y) ones with dims=3, kept as packed keys in a sorted NumPy array.
+    With values, it maps each coordinate to an integer, kept in a parallel array. An entry takes 17 bytes instead of
+    the hundred or more of a tuple in a set or dict, which is what keeps planning a huge world in memory.
+
+    Entries can be tested, looked up and removed one at a time like in a set or dict, or many at a time with arrays
+    of coordinates. Removing an entry only clears its flag, so it is safe while another thread reads the index.
+    update merges new entries in, which rebuilds the arrays and must not happen while other threads use it.
+    """
+    def __init__(self, coords=(), values=None, dims: int = 2):
+        self.dims = dims
+        keys = pack_keys(coords, dims)
+        # The last of duplicate coordinates wins, like when filling a dict
+        keys, index = np.unique(keys[::-1], return_index=True)
+        self.keys = keys
+        self.values = None if values is None else np.asarray(values, dtype=np.int64).reshape(-1)[::-1][index]
+        self.present = np.ones(len(keys), dtype=bool)
+        self.count = len(keys)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Tuples are made a block at a time, so iterating never holds them all
+        coords = self.coords()
+        for start in range(0, len(coords), BLOCK_SIZE):
+            yield from (tuple(coord) for coord in coords[start:start + BLOCK_SIZE].tolist())
+
+    def __contains__(self, coord) -> bool:
+        return self.find_key(pack_key(coord, self.dims)) >= 0
+
+    def __getitem__(self, coord) -> int:
+        position = self.find_key(pack_key(coord, self.dims))
+        if position < 0:
+            raise KeyError(coord)
+        return int(self.values[position])
+
+    def get(self, coord, default=None):
+        position = self.find_key(pack_key(coord, self.dims))
+        return default if position < 0 else int(self.values[position])
+
+    def find_key(self, key: np.uint64) -> int:
+        position = int(np.searchsorted(self.keys, key))
+        if position < len(self.keys) and self.keys[position] == key and self.present[position]:
+            return position
+        return -1
+
+    def find(self, coords) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the positions of the coordinates in the arrays and whether each is in the index.
+        """
+        keys = pack_keys(coords, self.dims)
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        if len(self.keys) == 0:
+            return positions, np.zeros(len(keys), dtype=bool)
+        return positions, (self.keys[positions] == keys) & self.present[positions]
+
+    def contains(self, coords) -> np.ndarray:
+        return self.find(coords)[1]
+
+    def lookup(self, coords, default: int = 0) -> np.ndarray:
+        """
+        Returns the value of each coordinate, or default for those not in the index.
+        """
+        positions, found = self.find(coords)
+        if len(self.keys) == 0:
+            return np.full(len(found), default, dtype=np.int64)
+        return np.where(found, self.values[positions], default)
+
+    def remove(self, coord):
+        position = self.find_key(pack_key(coord, self.dims))
+        if position < 0:
+            raise KeyError(coord)
+        self.present[position] = False
+        self.count -= 1
+
+    def discard(self, coords):
+        """
+        Removes any of the coordinates that are in the index.
+        """
+        positions, found = self.find(coords)
+        positions = np.unique(positions[found])
+        self.present[positions] = False
+        self.count -= len(positions)
+
+    def update(self, coords, values=None):
+        """
+        Adds the coordinates, replacing the values of those already in the index.
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, self.dims)
+        keys = np.concatenate([self.keys[self.present], pack_keys(coords, self.dims)])
+        keys, index = np.unique(keys[::-1], return_index=True)
+        if self.values is not None:
+            self.values = np.concatenate([self.values[self.present], np.asarray(values, dtype=np.int64).reshape(-1)])[::-1][index]
+        self.keys = keys
+        self.present = np.ones(len(keys), dtype=bool)
+        self.count = len(keys)
+
+    def __ior__(self, other):
+        self.update(other.coords() if isinstance(other, CoordIndex) else list(other))
+        return self
+
+    def __isub__(self, other):
+        self.discard(other.coords() if isinstance(other, CoordIndex) else list(other))
+        return self
+
+    def coords(self) -> np.ndarray:
+        return unpack_keys(self.keys[self.present], self.dims)
+
+    def get_values(self) -> np.ndarray:
+        return self.values[self.present]
+
+    def to_tuples(self) -> list[tuple]:
+        return [tuple(coord) for coord in self.coords().tolist()]
+
+    def select(self, mask: np.ndarray) -> "CoordIndex":
+        """
+        Returns a new index of the entries of coords() where mask is set.
+        """
+        result = CoordIndex(dims=self.dims)
+        result.keys = self.keys[self.present][mask]
+        result.values = None if self.values is None else self.values[self.present][mask]
+        result.present = np.ones(len(result.keys), dtype=bool)
+        result.count = len(result.keys)
+        return result
+
+    def intersection(self, other: "CoordIndex") -> "CoordIndex":
+        return self.select(other.contains(self.coords()))
+
+    def difference(self, other: "CoordIndex") -> "CoordIndex":
+        return self.select(~other.contains(self.coords()))
@@ -0,0 +1,182 @@
+import os
+import sqlite3
+
+import numpy as np
+
+from config import Config
+
+
+# Journal modes tiles.db and tiles.pack can be opened in. WAL keeps its index in shared memory, which a network file
+# system doesn't share between hosts, so a farm across machines needs the rollback journal
+JOURNAL_MODES = ("WAL", "DELETE")
+
+
+def set_journal_mode(con: sqlite3.Connection, journal_mode: str):
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Unknown journal mode {journal_mode}, expected one of {', '.join(JOURNAL_MODES)}")
+    con.execute(f"PRAGMA journal_mode={journal_mode}")
+
+
+def get_database_path(config: Config):
+    return f"chunky/scenes/{config.scene_name}/tiles.db"
+
+
+def add_missing_columns(cur: sqlite3.Cursor, table: str, columns: dict[str, str]):
+    """
+    Adds columns to a table created by an older version.
+    """
+    existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    for name, column_type in columns.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
+def open_database(config: Config) -> sqlite3.Connection:
+    """
+    Opens tiles.db for the scene and creates any missing tables. The connection may be handed to the
+    post-processing thread, but must only be used by one thread at a time.
+    """
+    os.makedirs(os.path.dirname(get_database_path(config)), exist_ok=True)
+    con = sqlite3.connect(get_database_path(config), timeout=60, check_same_thread=False)
+    cur = con.cursor()
+    # With WAL, readers, such as the workers polling the batch queue, don't block the writer. Either journal keeps a
+    # crash from leaving a half-written transaction behind
+    set_journal_mode(con, config.journal_mode)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tiles (
+            render_name TEXT NOT NULL,
+            zoom_level INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            last_modified INTEGER NOT NULL,
+            empty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (render_name, zoom_level, x, y)
+        )
+    """)
+    add_missing_columns(cur, "tiles", {"empty": "INTEGER NOT NULL DEFAULT 0"})
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dirty_tiles (
+            render_name TEXT NOT NULL,
+            zoom_level INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            PRIMARY KEY (render_name, zoom_level, x, y)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS batches (
+            render_name TEXT NOT NULL,
+            batch_x INTEGER NOT NULL,
+            batch_y INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            worker TEXT,
+            lease_expires REAL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (render_name, batch_x, batch_y)
+        )
+    """)
+    # One row per Chunky run, with sub_x and sub_y, and one per batch, without
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS render_timings (
+            render_name TEXT NOT NULL,
+            batch_x INTEGER NOT NULL,
+            batch_y INTEGER NOT NULL,
+            sub_x INTEGER,
+            sub_y INTEGER,
+            chunks INTEGER NOT NULL,
+            tiles INTEGER NOT NULL,
+            spp INTEGER NOT NULL,
+            loads_chunks INTEGER,
+            seconds REAL NOT NULL,
+            finished REAL NOT NULL
+        )
+    """)
+    add_missing_columns(cur, "render_timings", {"loads_chunks": "INTEGER"})
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS region_scans (
+            region_x INTEGER NOT NULL,
+            region_z INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (region_x, region_z)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS region_chunks (
+            region_x INTEGER NOT NULL,
+            region_z INTEGER NOT NULL,
+            chunk_x INTEGER NOT NULL,
+            chunk_z INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            complete INTEGER NOT NULL,
+            digest BLOB,
+            height INTEGER,
+            content_modified INTEGER,
+            PRIMARY KEY (chunk_x, chunk_z)
+        )
+    """)
+    add_missing_columns(cur, "region_chunks", {"digest": "BLOB", "height": "INTEGER", "content_modified": "INTEGER"})
+    cur.execute("CREATE INDEX IF NOT EXISTS region_chunks_region ON region_chunks (region_x, region_z)")
+    con.commit()
+    return con
+
+
+def record_tiles(cur: sqlite3.Cursor, render_name: str, rows: list[tuple[int, int, int, int, int]]):
+    """
+    Records written tiles, given as (zoom_level, x, y, last_modified, empty) rows, and takes them off the journal of
+    dirty tiles. Both are part of the caller's transaction, so they are committed together.
+    """
+    cur.executemany(
+        "INSERT OR REPLACE INTO tiles (render_name, zoom_level, x, y, last_modified, empty) VALUES (?, ?, ?, ?, ?, ?)",
+        [(render_name, *row) for row in rows]
+    )
+    cur.executemany(
+        "DELETE FROM dirty_tiles WHERE render_name = ? AND zoom_level = ? AND x = ? AND y = ?",
+        [(render_name, *row[:3]) for row in rows]
+    )
+
+
+def get_tile_arrays(cur: sqlite3.Cursor, render_name: str, zoom_level: int, block_size: int = 1 << 16) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the (x, y) and last_modified of the tiles of a zoom level in tiles.db as arrays, read a block of rows
+    at a time so the rows are never all held as tuples.
+    """
+    cur.execute("SELECT x, y, last_modified FROM tiles WHERE render_name = ? AND zoom_level = ?", (render_name, zoom_level))
+    blocks = [np.empty((0, 3), dtype=np.int64)]
+    while True:
+        rows = cur.fetchmany(block_size)
+        if len(rows) == 0:
+            break
+        blocks.append(np.array(rows, dtype=np.int64).reshape(-1, 3))
+    rows = np.concatenate(blocks)
+    return rows[:, :2], rows[:, 2]
+
+
+def get_dirty_tiles(cur: sqlite3.Cursor, render_name: str) -> set[tuple[int, int, int]]:
+    """
+    Returns the (zoom, x, y) of the tiles in the journal that have yet to be rendered or built.
+    """
+    return set(cur.execute("SELECT zoom_level, x, y FROM dirty_tiles WHERE render_name = ?", (render_name,)))
+
+
+def set_dirty_tiles(cur: sqlite3.Cursor, render_name: str, tiles: set[tuple[int, int, int]]):
+    """
+    Replaces the journal of dirty tiles and commits it.
+    """
+    cur.execute("DELETE FROM dirty_tiles WHERE render_name = ?", (render_name,))
+    cur.executemany(
+        "INSERT INTO dirty_tiles (render_name, zoom_level, x, y) VALUES (?, ?, ?, ?)",
+        ((render_name, *tile) for tile in tiles)
+    )
+    cur.connection.commit()
+
+
+def add_dirty_tiles(cur: sqlite3.Cursor, render_name: str, tiles: set[tuple[int, int, int]]):
+    """
+    Adds tiles to the journal of dirty tiles and commits it.
+    """
+    cur.executemany(
+        "INSERT OR IGNORE INTO dirty_tiles (render_name, zoom_level, x, y) VALUES (?, ?, ?, ?)",
+        ((render_name, *tile) for tile in tiles)
+    )
+    cur.connection.commit()
@@ -0,0 +1,258 @@
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from config import Config
+from coord_index import CoordIndex
+from database import open_database
+from image import ImageHandler
+from metrics import metrics
+from octree_cache import get_octree_key
+from render import RenderPlan, plan_render, write_index, run_batch, make_pending_zoom_tiles, get_chunklist, get_zoom_tiles_to_render, \
+    load_scene_settings
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def get_batch_zoom_levels(config: Config):
+    """
+    Returns the number of zoom levels whose tiles lie entirely inside one batch. Workers build these levels
+    themselves, the levels above them are built by the coordinator once every batch is done.
+    """
+    levels = 0
+    size = config.tile_batch_size
+    while size % 2 == 0 and levels < config.zoom_levels:
+        size //= 2
+        levels += 1
+    return levels
+
+
+def enqueue_batches(config: Config, cur: sqlite3.Cursor, plan: RenderPlan):
+    """
+    Replaces the render's batch queue with the batches of the plan. Batches currently leased by a live worker are
+    left alone.
+    """
+    batch_tiles = {batch: [] for batch in plan.batches}
+    tiles = plan.tiles_to_render.coords()
+    for (tile_x, tile_y), last_modified in zip(tiles.tolist(), plan.tile_last_modified.lookup(tiles).tolist()):
+        batch = (tile_x // config.tile_batch_size, tile_y // config.tile_batch_size)
+        batch_tiles[batch].append((tile_x, tile_y, last_modified))
+
+    cur.execute(
+        "DELETE FROM batches WHERE render_name = ? AND NOT (status = 'leased' AND lease_expires > ?)",
+        (config.render_name, time.time())
+    )
+    scene = load_scene_settings(config)
+    for batch_x, batch_y in plan.batches:
+        chunks = get_chunklist(config, batch_x, batch_y, plan.chunk_padding_top)
+        payload = {
+            "tiles": batch_tiles[(batch_x, batch_y)],
+            "chunks": chunks,
+            "octree_key": get_octree_key(config, scene, chunks, plan.chunk_last_modified),
+        }
+        cur.execute(
+            "INSERT OR IGNORE INTO batches (render_name, batch_x, batch_y, status, payload) VALUES (?, ?, ?, 'pending', ?)",
+            (config.render_name, batch_x, batch_y, json.dumps(payload))
+        )
+    cur.execute("COMMIT")
+
+
+def lease_batch(config: Config, con: sqlite3.Connection, worker_id: str):
+    """
+    Leases the next pending batch, or a batch whose lease has expired. Returns None if there is nothing to lease.
+    """
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    now = time.time()
+    row = cur.execute(
+        "SELECT batch_x, batch_y, payload FROM batches "
+        "WHERE render_name = ? AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+        "ORDER BY rowid LIMIT 1",
+        (config.render_name, now)
+    ).fetchone()
+    if row is None:
+        cur.execute("COMMIT")
+        return None
+
+    batch_x, batch_y, payload = row
+    cur.execute(
+        "UPDATE batches SET status = 'leased', worker = ?, lease_expires = ? WHERE render_name = ? AND batch_x = ? AND batch_y = ?",
+        (worker_id, now + config.lease_duration, config.render_name, batch_x, batch_y)
+    )
+    cur.execute("COMMIT")
+    return batch_x, batch_y, json.loads(payload)
+
+
+def complete_batch(config: Config, cur: sqlite3.Cursor, worker_id: str, batch_x, batch_y):
+    cur.execute(
+        "UPDATE batches SET status = 'done', lease_expires = NULL WHERE render_name = ? AND batch_x = ? AND batch_y = ? AND worker = ?",
+        (config.render_name, batch_x, batch_y, worker_id)
+    )
+    cur.execute("COMMIT")
+
+
+def count_unfinished_batches(config: Config, cur: sqlite3.Cursor):
+    return cur.execute(
+        "SELECT COUNT(*) FROM batches WHERE render_name = ? AND status != 'done'", (config.render_name,)
+    ).fetchone()[0]
+
+
+def count_leased_batches(config: Config, cur: sqlite3.Cursor):
+    """
+    Returns the number of batches leased by a live worker, one whose lease hasn't expired.
+    """
+    return cur.execute(
+        "SELECT COUNT(*) FROM batches WHERE render_name = ? AND status = 'leased' AND lease_expires > ?",
+        (config.render_name, time.time())
+    ).fetchone()[0]
+
+
+
+class LeaseHeartbeat:
+    """
+    Keeps extending the lease of a batch from a background thread while the batch renders.
+    """
+    def __init__(self, config: Config, worker_id: str, batch_x, batch_y):
+        self.config = config
+        self.worker_id = worker_id
+        self.batch_x = batch_x
+        self.batch_y = batch_y
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        con = open_database(self.config)
+        interval = self.config.lease_duration / 4
+        while not self.stopped.wait(interval):
+            con.execute(
+                "UPDATE batches SET lease_expires = ? WHERE render_name = ? AND batch_x = ? AND batch_y = ? AND worker = ?",
+                (time.time() + self.config.lease_duration, self.config.render_name, self.batch_x, self.batch_y, self.worker_id)
+            )
+            con.commit()
+        con.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(config: Config, image_handler: ImageHandler):
+    """
+    Leases and renders batches until the queue is empty. Each worker renders in its own Chunky scene directory and
+    writes tiles to the shared output directory.
+    """
+    worker_id = get_worker_id()
+    scene_name = f"{config.scene_name}-{worker_id}"
+    batch_zoom_levels = get_batch_zoom_levels(config)
+
+    con = open_database(config)
+    cur = con.cursor()
+
+    print(f"Worker {worker_id} started.")
+
+    try:
+        while True:
+            job = lease_batch(config, con, worker_id)
+            if job is None:
+                if count_unfinished_batches(config, cur) == 0:
+                    break
+                time.sleep(config.worker_poll_interval)
+                continue
+
+            batch_x, batch_y, payload = job
+            print(f"Worker {worker_id} rendering batch {batch_x}, {batch_y}")
+
+            tiles = np.array(payload["tiles"], dtype=np.int64).reshape(-1, 3)
+            tile_last_modified = CoordIndex(tiles[:, :2], tiles[:, 2])
+            tiles_to_render = CoordIndex(tiles[:, :2])
+            zoom_tiles_to_render = get_zoom_tiles_to_render(tiles_to_render, batch_zoom_levels)
+            chunks = [tuple(chunk) for chunk in payload["chunks"]]
+
+            with LeaseHeartbeat(config, worker_id, batch_x, batch_y):
+                run_batch(
+                    config,
+                    image_handler,
+                    batch_x,
+                    batch_y,
+                    chunks,
+                    tiles_to_render,
+                    cur,
+                    tile_last_modified,
+                    zoom_tiles_to_render,
+                    scene_name=scene_name,
+                    min_zoom=-batch_zoom_levels,
+                    octree_key=payload.get("octree_key")
+                )
+            complete_batch(config, cur, worker_id, batch_x, batch_y)
+            metrics.flush()
+    finally:
+        # The scene directory holds a copy of the scene and its octree that no later run uses
+        shutil.rmtree(f"chunky/scenes/{scene_name}", ignore_errors=True)
+
+    print(f"Worker {worker_id} found no more batches. Exiting.")
+
+
+def run_coordinator(config: Config, image_handler: ImageHandler, worker_command: list[str], workers: int):
+    """
+    Plans the render and writes its batches to the queue in tiles.db, optionally starts local worker processes,
+    waits for all batches to be done and then builds the remaining zoom levels. Exits with an error if every local
+    worker exits first, or, without local workers, if no worker holds a batch for lease_duration seconds.
+    """
+    write_index(config)
+
+    con = open_database(config)
+    cur = con.cursor()
+
+    start_time = time.time()
+
+    plan = plan_render(config, cur)
+    enqueue_batches(config, cur, plan)
+
+    processes = [subprocess.Popen(worker_command) for _ in range(workers)]
+    print(f"Queued {len(plan.batches)} batches. Started {len(processes)} local workers.")
+
+    total_batches = len(plan.batches)
+    unfinished = count_unfinished_batches(config, cur)
+    last_leased_time = time.time()
+    while unfinished > 0:
+        print(f"\rWaiting for workers. Completed: ({total_batches - unfinished}/{total_batches})", end="")
+        time.sleep(config.worker_poll_interval)
+        unfinished = count_unfinished_batches(config, cur)
+        if unfinished == 0:
+            break
+        # Local workers only exit once every batch is done, so if they have all exited, they have failed
+        if len(processes) > 0 and all(process.poll() is not None for process in processes):
+            exit_codes = ", ".join(str(process.returncode) for process in processes)
+            print(f"\nAll local workers exited with {unfinished} batches unfinished. Exit codes: {exit_codes}. Exiting.", file=sys.stderr)
+            sys.exit(1)
+        # Without local workers, remote workers are only seen through their leases
+        if count_leased_batches(config, cur) > 0:
+            last_leased_time = time.time()
+        elif len(processes) == 0 and time.time() - last_leased_time > config.lease_duration:
+            print(f"\nNo worker has held a batch for {config.lease_duration} seconds, with {unfinished} batches unfinished. "
+                  f"Start workers with --worker. Exiting.", file=sys.stderr)
+            sys.exit(1)
+    print()
+
+    for process in processes:
+        process.wait()
+
+    # The zoom levels whose tiles span several batches are left in the journal by the workers
+    print("Building upper zoom levels...")
+    make_pending_zoom_tiles(config, image_handler, cur)
+
+    print("Render completed in", time.time() - start_time, "seconds.")
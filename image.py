@@ -1,96 +1,197 @@
+import multiprocessing
 import os
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import BytesIO
-from typing import Union
-from PIL import Image
+from typing import Union, Iterable, Iterator
+
+import numpy as np
+from PIL import Image, features
+
+from config import Config
+from metrics import metrics
+from tile_store import TileStore, DirectoryTileStore, create_tile_store
 
 
 def to_str_path(path: Union[str, bytes]) -> str:
     return path.decode("utf-8") if isinstance(path, bytes) else path
 
 
-def image_exists(image_os_path: Union[str, bytes], file_extension: str) -> bool:
-    path_str = to_str_path(image_os_path)
-    return os.path.isfile(path_str+file_extension)
+# Encoder settings for the in-process codecs. "fast" favours encoding speed, "small" favours file size.
+AVIF_PRESETS = {
+    "fast": {"quality": 75, "speed": 9},
+    "balanced": {"quality": 75, "speed": 6},
+    "small": {"quality": 65, "speed": 3},
+}
+WEBP_PRESETS = {
+    "fast": {"quality": 80, "method": 0},
+    "balanced": {"quality": 80, "method": 4},
+    "small": {"quality": 70, "method": 6},
+}
+# CRF used by the ffmpeg AVIF handler when avif_crf isn't set
+DEFAULT_AVIF_CRF = 20
+
+
+def crf_to_avif_quality(crf: int) -> int:
+    """
+    Returns the Pillow AVIF quality that libavif turns into the same quantizer as the CRF value.
+    """
+    return round(100 - crf * 100 / 63)
+
+
+def run_ffmpeg(args: list[str], input_data: bytes = None) -> bytes:
+    """
+    Runs ffmpeg and returns what it wrote to stdout. Raises RuntimeError with ffmpeg's error output if it fails.
+    """
+    result = subprocess.run(["ffmpeg", "-v", "error", *args], input=input_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode("utf-8", "replace").strip()
+        raise RuntimeError(f"ffmpeg {' '.join(args)} exited with code {result.returncode}: {error}")
+    return result.stdout
+
+
+def to_image(image: Union[Image.Image, np.ndarray]) -> Image.Image:
+    """
+    Wraps a raw RGBA array in a PIL image. PIL images are returned as they are.
+    """
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(image), "RGBA")
+    return image
+
+
+def decode_image(data: Union[bytes, BytesIO]) -> np.ndarray:
+    with Image.open(data if isinstance(data, BytesIO) else BytesIO(data)) as image:
+        return np.asarray(image.convert("RGBA"))
+
+
+def encode_image_in_pool(image_handler: "ImageHandler", image: Union[Image.Image, np.ndarray]) -> bytes:
+    return image_handler.encode_image(image)
 
 
 class ImageHandler:
-    def __init__(self):
-        pass
+    """
+    Encodes and decodes tiles in one image format, and reads and writes them through a tile store. Tiles are
+    addressed by their path without the file extension.
+    """
+    def __init__(self, processes: int = 1, store: TileStore = None):
+        self.processes = processes
+        self.pool = None
+        self.store = store if store is not None else DirectoryTileStore(self.file_extension)
 
-    def save_image(self, image: Image, image_os_path: Union[str, bytes]):
-        pass
+    file_extension = None
 
-    def load_image(self, image_os_path: Union[str, bytes]):
-        pass
+    def encode_image(self, image: Union[Image.Image, np.ndarray]) -> bytes:
+        raise NotImplementedError
 
-    @staticmethod
-    def image_exists(image_os_path: Union[str, bytes]) -> bool:
-        pass
+    def decode_image(self, data: bytes) -> np.ndarray:
+        return decode_image(data)
+
+    def write_tile(self, image_os_path: Union[str, bytes], data: bytes):
+        self.store.write(to_str_path(image_os_path), data)
+        metrics.count("bytes_written", len(data))
+
+    def save_image(self, image: Union[Image.Image, np.ndarray], image_os_path: Union[str, bytes]):
+        self.write_tile(image_os_path, self.encode_image(image))
+        self.store.flush()
+
+    def save_images(self, images: Iterable[tuple[Union[Image.Image, np.ndarray], Union[str, bytes]]]) -> Iterator[Union[str, bytes]]:
+        """
+        Saves a batch of (image, path) pairs, encoding them across a pool of processes. Yields the path of each
+        image once it has been written to the store, in order of completion. The store is flushed once the batch
+        is done.
+        """
+        try:
+            if self.processes <= 1:
+                for image, image_os_path in images:
+                    self.write_tile(image_os_path, self.encode_image(image))
+                    yield image_os_path
+                return
+
+            if self.pool is None:
+                # Spawn rather than fork, as the handler may be used from the post-processing thread
+                self.pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+            futures = {self.pool.submit(encode_image_in_pool, self, image): image_os_path for image, image_os_path in images}
+            for future in as_completed(futures):
+                self.write_tile(futures[future], future.result())
+                yield futures[future]
+        finally:
+            self.store.flush()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.store.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
+    def load_image(self, image_os_path: Union[str, bytes]) -> np.ndarray:
+        """
+        Returns the decoded image as an RGBA array.
+        """
+        return self.decode_image(self.store.read(to_str_path(image_os_path)))
+
+    def image_exists(self, image_os_path: Union[str, bytes]) -> bool:
+        return self.store.exists(to_str_path(image_os_path))
+
+    def remove_image(self, image_os_path: Union[str, bytes]):
+        """
+        Removes the image if it exists.
+        """
+        self.store.remove(to_str_path(image_os_path))
+        self.store.flush()
 
     def check(self):
         raise NotImplementedError("Check method not implemented.")
 
 
 class PngImageHandler(ImageHandler):
-    def __init__(self):
-        super().__init__()
+    file_extension = "png"
 
-    def save_image(self, image: Image, image_os_path: Union[str, bytes]):
-        path_str = to_str_path(image_os_path)
-        with BytesIO() as bio, open(path_str+".png", "wb") as f:
-            image.save(bio, format="png")
-            bio.seek(0)
-            f.write(bio.read())
+    def __init__(self, processes: int = 1, store: TileStore = None):
+        super().__init__(processes, store)
 
-    def load_image(self, image_os_path: Union[str, bytes]) -> bytes:
-        path_str = to_str_path(image_os_path)
-
-        with open(path_str+".png", "rb") as f:
-            return f.read()
-
-    @staticmethod
-    def image_exists(image_os_path: Union[str, bytes]) -> bool:
-        return image_exists(image_os_path, ".png")
+    def encode_image(self, image: Union[Image.Image, np.ndarray]) -> bytes:
+        with BytesIO() as bio:
+            to_image(image).save(bio, format="png")
+            return bio.getvalue()
 
     def check(self):
         return True
 
 
 class AvifImageHandler(ImageHandler):
+    file_extension = "avif"
     crf = None
 
-    def __init__(self, crf: int):
-        super().__init__()
+    def __init__(self, crf: int, processes: int = 1, store: TileStore = None):
+        super().__init__(processes, store)
         self.crf = crf
 
-    def save_image(self, image: Image, image_os_path: Union[str, bytes]):
-        output_file = to_str_path(image_os_path) + ".avif"
+    def encode_image(self, image: Union[Image.Image, np.ndarray]) -> bytes:
+        # The AVIF muxer needs a seekable output, so ffmpeg writes to a temporary file
+        with tempfile.TemporaryDirectory() as directory, BytesIO() as bio:
+            output_file = os.path.join(directory, "tile.avif")
+            to_image(image).save(bio, format="png")
+            run_ffmpeg(
+                ["-f", "png_pipe", "-i", "pipe:0", "-c:v", "libaom-av1", "-crf", str(self.crf), "-cpu-used", "6", output_file],
+                bio.getvalue()
+            )
+            with open(output_file, "rb") as f:
+                return f.read()
 
-        with subprocess.Popen(
-            ["ffmpeg", "-f", "png_pipe", "-i", "pipe:0", "-c:v", "libaom-av1", "-crf", str(self.crf), "-cpu-used", "6", output_file],
-            stdin=subprocess.PIPE,
-            stderr=subprocess.DEVNULL
-        ) as ffmpeg_process, BytesIO() as bio:
-            image.save(bio, format="png")
-            bio.seek(0)
-            ffmpeg_process.stdin.write(bio.read())
-            ffmpeg_process.stdin.close()
-            ffmpeg_process.wait()
-
-    def load_image(self, image_os_path: Union[str, bytes]) -> bytes:
-        path_str = to_str_path(image_os_path) + ".avif"
-
-        return subprocess.run(
-            ["ffmpeg", "-i", path_str, "-c:v", "png", "-f", "image2pipe", "pipe:1"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        ).stdout
-
-    @staticmethod
-    def image_exists(image_os_path: Union[str, bytes]) -> bool:
-        return image_exists(image_os_path, ".avif")
+    def decode_image(self, data: bytes) -> np.ndarray:
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, "tile.avif")
+            with open(input_file, "wb") as f:
+                f.write(data)
+            return decode_image(run_ffmpeg(["-i", input_file, "-c:v", "png", "-f", "image2pipe", "pipe:1"]))
 
     def check(self):
         result = subprocess.run(
@@ -101,3 +202,75 @@ class AvifImageHandler(ImageHandler):
             print("ffmpeg with libaom-av1 support is required to use the AVIF image format.", file=sys.stderr)
             return False
         return True
+
+
+class PillowAvifImageHandler(ImageHandler):
+    """
+    Encodes and decodes AVIF in-process with Pillow, without going through ffmpeg.
+    """
+    file_extension = "avif"
+
+    def __init__(self, preset: str = "balanced", processes: int = 1, store: TileStore = None, crf: int = None):
+        super().__init__(processes, store)
+        self.options = dict(AVIF_PRESETS[preset])
+        if crf is not None:
+            self.options["quality"] = crf_to_avif_quality(crf)
+
+    def encode_image(self, image: Union[Image.Image, np.ndarray]) -> bytes:
+        with BytesIO() as bio:
+            to_image(image).save(bio, format="avif", **self.options)
+            return bio.getvalue()
+
+    @staticmethod
+    def available() -> bool:
+        return features.check("avif")
+
+    def check(self):
+        if not self.available():
+            print("Pillow with AVIF support is required to encode AVIF in-process.", file=sys.stderr)
+            return False
+        return True
+
+
+class WebpImageHandler(ImageHandler):
+    file_extension = "webp"
+
+    def __init__(self, preset: str = "balanced", processes: int = 1, store: TileStore = None):
+        super().__init__(processes, store)
+        self.options = WEBP_PRESETS[preset]
+
+    def encode_image(self, image: Union[Image.Image, np.ndarray]) -> bytes:
+        with BytesIO() as bio:
+            to_image(image).save(bio, format="webp", **self.options)
+            return bio.getvalue()
+
+    def check(self):
+        if not features.check("webp"):
+            print("Pillow with WebP support is required to use the WebP image format.", file=sys.stderr)
+            return False
+        return True
+
+
+def get_image_format(config: Config) -> str:
+    if config.image_format is not None:
+        return config.image_format
+    return "avif" if config.use_avif else "png"
+
+
+def create_image_handler(config: Config) -> ImageHandler:
+    """
+    Creates the image handler for the configured format, writing to the configured tile store. AVIF is encoded
+    in-process when Pillow supports it and through ffmpeg otherwise.
+    """
+    image_format = get_image_format(config)
+    store = create_tile_store(config, image_format)
+    if image_format == "png":
+        return PngImageHandler(processes=config.encoder_processes, store=store)
+    if image_format == "webp":
+        return WebpImageHandler(preset=config.image_preset, processes=config.encoder_processes, store=store)
+    if image_format == "avif":
+        if PillowAvifImageHandler.available():
+            return PillowAvifImageHandler(preset=config.image_preset, processes=config.encoder_processes, store=store, crf=config.avif_crf)
+        crf = DEFAULT_AVIF_CRF if config.avif_crf is None else config.avif_crf
+        return AvifImageHandler(crf=crf, processes=config.encoder_processes, store=store)
+    raise ValueError(f"Unknown image format: {image_format}")
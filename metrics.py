@@ -0,0 +1,178 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from config import Config
+
+PROMETHEUS_PREFIX = "chunky_leaflet"
+# From Python 3.12, cProfile is built on sys.monitoring, which allows one profiler at a time and has it profile every
+# thread. Before, a profiler only sees the thread that enabled it, so each thread needs its own
+SHARED_PROFILER = sys.version_info >= (3, 12)
+
+
+class Metrics:
+    """
+    Records timed spans of the stages of a render and counters such as tiles and bytes written. Each span is written
+    to the events file as a line of JSON. flush writes the totals so far, as an event and to a Prometheus textfile
+    for the node exporter's textfile collector. With profile_path, the Python work inside spans is profiled with
+    cProfile on every thread and the merged stats are written there on close. The profiler is on while any thread
+    is in a span, with one per thread or, from Python 3.12, one for the process.
+
+    Spans and counts may come from any thread. Work done in other processes, such as pooled encoding, is timed by
+    the span around it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events_file = None
+        self.prometheus_path = None
+        self.profile_path = None
+        self.instance = None
+        self.profilers = []
+        self.profiled_threads = 0
+        self.stage_seconds = defaultdict(float)
+        self.stage_counts = defaultdict(int)
+        self.counters = defaultdict(float)
+
+    def configure(self, config: Config, instance: str = None):
+        """
+        Starts recording to the paths set in config. instance names the process, e.g. a farm worker, in events and
+        in the name of its textfile, so that several processes can report side by side.
+        """
+        self.instance = instance
+        if config.metrics_path:
+            self.events_file = open(config.metrics_path, "a")
+        if config.prometheus_textfile:
+            self.prometheus_path = config.prometheus_textfile
+            if instance is not None:
+                root, extension = os.path.splitext(self.prometheus_path)
+                self.prometheus_path = f"{root}-{instance}{extension}"
+        self.profile_path = config.profile_path
+
+    def emit(self, event: dict):
+        if self.events_file is None:
+            return
+        event = {"time": time.time(), **event}
+        if self.instance is not None:
+            event["instance"] = self.instance
+        line = json.dumps(event)
+        with self.lock:
+            self.events_file.write(line + "\n")
+            self.events_file.flush()
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        Times the body as a span of the stage. labels are added to the event, but not to the Prometheus totals.
+        """
+        profiler = self.start_profiling()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.stop_profiling(profiler)
+            with self.lock:
+                self.stage_seconds[stage] += seconds
+                self.stage_counts[stage] += 1
+            self.emit({"event": "span", "stage": stage, "seconds": seconds, **labels})
+
+    def count(self, counter: str, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def start_profiling(self):
+        if self.profile_path is None:
+            return None
+        # Spans nest, so only the outermost one on each thread turns its profiler on and off
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        if depth > 0:
+            return None
+        if SHARED_PROFILER:
+            # The first thread to enter a span turns the shared profiler on and the last one to leave turns it off
+            with self.lock:
+                if len(self.profilers) == 0:
+                    self.profilers.append(cProfile.Profile())
+                self.profiled_threads += 1
+                if self.profiled_threads == 1:
+                    self.profilers[0].enable()
+                return self.profilers[0]
+        profiler = getattr(self.local, "profiler", None)
+        if profiler is None:
+            profiler = self.local.profiler = cProfile.Profile()
+            with self.lock:
+                self.profilers.append(profiler)
+        profiler.enable()
+        return profiler
+
+    def stop_profiling(self, profiler):
+        if self.profile_path is None:
+            return
+        self.local.depth -= 1
+        if profiler is None:
+            return
+        if SHARED_PROFILER:
+            with self.lock:
+                self.profiled_threads -= 1
+                if self.profiled_threads == 0:
+                    profiler.disable()
+            return
+        profiler.disable()
+
+    def flush(self):
+        """
+        Writes the totals so far. The textfile is replaced atomically, so the collector never reads half of it.
+        """
+        with self.lock:
+            totals = {
+                "event": "totals",
+                "stage_seconds": dict(self.stage_seconds),
+                "stage_spans": dict(self.stage_counts),
+                "counters": dict(self.counters),
+            }
+        self.emit(totals)
+        if self.prometheus_path is None:
+            return
+
+        with self.lock:
+            lines = [
+                f"# HELP {PROMETHEUS_PREFIX}_stage_seconds_total Seconds spent in each stage of the render.",
+                f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds_total counter",
+            ]
+            lines += [f'{PROMETHEUS_PREFIX}_stage_seconds_total{{stage="{stage}"}} {seconds}' for stage, seconds in sorted(self.stage_seconds.items())]
+            lines += [
+                f"# HELP {PROMETHEUS_PREFIX}_stage_spans_total Number of times each stage of the render ran.",
+                f"# TYPE {PROMETHEUS_PREFIX}_stage_spans_total counter",
+            ]
+            lines += [f'{PROMETHEUS_PREFIX}_stage_spans_total{{stage="{stage}"}} {count}' for stage, count in sorted(self.stage_counts.items())]
+            for counter, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{counter}_total counter")
+                lines.append(f"{PROMETHEUS_PREFIX}_{counter}_total {value}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_last_update_seconds gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_last_update_seconds {time.time()}")
+
+        tmp_path = f"{self.prometheus_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prometheus_path)
+
+    def close(self):
+        self.flush()
+        if self.profile_path is not None and len(self.profilers) > 0:
+            stats = pstats.Stats(*self.profilers)
+            stats.dump_stats(self.profile_path)
+            print(f"Wrote profile to {self.profile_path}.")
+        if self.events_file is not None:
+            self.events_file.close()
+            self.events_file = None
+
+
+# Shared by the whole process, like the print-based progress it accompanies
+metrics = Metrics()
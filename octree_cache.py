@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from typing import Optional
+
+from config import Config, OCTREE_SCENE_SETTINGS
+
+# Bumped when the key no longer identifies the same octree, e.g. after a Chunky upgrade changes the format
+OCTREE_KEY_VERSION = 1
+
+
+def get_octree_key(config: Config, scene: dict, chunks: list[tuple[int, int]], chunk_last_modified: dict[tuple[int, int], int]) -> str:
+    """
+    Returns the key of the octree Chunky builds from the chunks, which changes with the world, the chunk list, the
+    content of any of its chunks and the OCTREE_SCENE_SETTINGS of the scene settings, but not with settings such
+    as the sky, spp or render_name.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"{OCTREE_KEY_VERSION}:{os.path.abspath(config.world_path)}".encode("utf-8"))
+    octree_settings = {key: scene.get(key) for key in OCTREE_SCENE_SETTINGS}
+    hasher.update(json.dumps(octree_settings, sort_keys=True).encode("utf-8"))
+    for chunk in sorted(chunks):
+        hasher.update(f";{chunk[0]},{chunk[1]}:{chunk_last_modified.get(chunk, 0)}".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def link_or_copy(src_path: str, dst_path: str):
+    """
+    Hard links src_path to dst_path, or copies it if the file system can't. dst_path is replaced atomically.
+    """
+    tmp_path = f"{dst_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+class OctreeCache:
+    """
+    Keeps the octrees Chunky built in a directory, keyed by get_octree_key, so batches whose chunks haven't
+    changed skip loading them. The least recently used octrees are evicted once the directory holds more than
+    max_bytes.
+
+    Octrees are hard linked where possible. This is safe since create_scene removes a scene's octree, rather than
+    overwriting it, before the scene is used for another batch.
+    """
+    def __init__(self, cache_path: str, max_bytes: int):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+
+    def get_entry_path(self, key: str):
+        return os.path.join(self.cache_path, f"{key}.octree2")
+
+    def keys(self) -> set[str]:
+        """
+        Returns the keys of the cached octrees.
+        """
+        try:
+            return {name[:-len(".octree2")] for name in os.listdir(self.cache_path) if name.endswith(".octree2")}
+        except FileNotFoundError:
+            return set()
+
+    def fetch(self, key: str, octree_path: str) -> bool:
+        """
+        Places the cached octree for key at octree_path. Returns whether there was one.
+        """
+        entry_path = self.get_entry_path(key)
+        try:
+            link_or_copy(entry_path, octree_path)
+        except FileNotFoundError:
+            return False
+        # The modification time orders entries for eviction
+        os.utime(entry_path)
+        return True
+
+    def store(self, key: str, octree_path: str):
+        """
+        Adds the octree at octree_path to the cache under key, if it isn't cached already.
+        """
+        entry_path = self.get_entry_path(key)
+        if not os.path.isfile(octree_path) or os.path.isfile(entry_path):
+            return
+        os.makedirs(self.cache_path, exist_ok=True)
+        link_or_copy(octree_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_path):
+            if entry.name.endswith(".octree2") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another worker evicted it first
+                pass
+            total_bytes -= size
+
+
+def create_octree_cache(config: Config) -> Optional[OctreeCache]:
+    if config.octree_cache_size_mb <= 0:
+        return None
+    return OctreeCache(config.octree_cache_path, config.octree_cache_size_mb * 1024 * 1024)
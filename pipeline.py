@@ -0,0 +1,64 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class PostProcessPipeline:
+    """
+    Runs the post-processing of rendered snapshots on a background thread so that Chunky can render the next
+    sub-batch in the meantime. At most queue_size snapshots wait for or undergo post-processing at a time; submit
+    blocks when the queue is full. A queue_size of 0 runs everything synchronously.
+
+    Jobs run one at a time and in order, so they may share a SQLite cursor as long as the submitting thread does not
+    use it until wait() has returned.
+    """
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=1) if queue_size > 0 else None
+        self.slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self.futures: list[Future] = []
+
+    def submit(self, fn, *args, takes_slot: bool = True):
+        """
+        Queues fn(*args) after the jobs submitted before it. Jobs that don't hold a snapshot, such as recording a
+        timing, are submitted without takes_slot, so they neither wait for nor use up a slot of the queue.
+        """
+        if self.executor is None:
+            fn(*args)
+            return
+
+        if takes_slot:
+            self.slots.acquire()
+        self.raise_errors()
+        future = self.executor.submit(fn, *args)
+        if takes_slot:
+            future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def raise_errors(self):
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self.futures = [future for future in self.futures if not future.done()]
+
+    def wait(self):
+        """
+        Blocks until all submitted jobs are done. Raises the first error a job raised.
+        """
+        futures = self.futures
+        self.futures = []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        else:
+            self.close()
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+def is_empty(image: np.ndarray) -> bool:
+    """
+    Returns whether an RGBA array is fully transparent.
+    """
+    return not image[..., 3].any()
+
+
+def downsample(image: np.ndarray) -> np.ndarray:
+    """
+    Halves the width and height of an RGBA array by averaging each 2x2 block of pixels. Colours are weighted by
+    alpha so transparent pixels don't darken the edges of the map.
+    """
+    height, width = image.shape[0] // 2, image.shape[1] // 2
+    blocks = image[:height * 2, :width * 2].reshape(height, 2, width, 2, 4).astype(np.uint32)
+
+    alpha = blocks[..., 3].sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3))
+
+    result = np.empty((height, width, 4), dtype=np.uint8)
+    result[..., :3] = (rgb + alpha[..., None] // 2) // np.maximum(alpha, 1)[..., None]
+    result[..., 3] = (alpha + 2) // 4
+    return result
+
+
+def compose_parent(children: list, size: int) -> np.ndarray:
+    """
+    Builds a parent tile from its four children, given in the order of get_child_tiles. Missing children are
+    left transparent.
+    """
+    half_size = size // 2
+    parent = np.zeros((size, size, 4), dtype=np.uint8)
+    for (src_x, src_y), child in zip([(0, 0), (1, 0), (0, 1), (1, 1)], children):
+        if child is not None:
+            parent[src_y*half_size:(src_y+1)*half_size, src_x*half_size:(src_x+1)*half_size] = downsample(child)
+    return parent
+
+
+def get_block_tiles(block: np.ndarray, base_tile_x, base_tile_y, tile_size, min_zoom) -> dict:
+    """
+    Splits a rendered block of zoom 0 tiles into tiles and downsamples it level by level, for as long as the
+    tiles of the next level lie entirely inside the block. Returns a dict of (zoom, x, y) to RGBA arrays, which
+    are views into the block and the downsampled copies of it.
+    """
+    block_tiles = {}
+    zoom = 0
+    tiles_x = block.shape[1] // tile_size
+    tiles_y = block.shape[0] // tile_size
+
+    while True:
+        for sub_x in range(tiles_x):
+            for sub_y in range(tiles_y):
+                block_tiles[(zoom, base_tile_x + sub_x, base_tile_y + sub_y)] = \
+                    block[sub_y*tile_size:(sub_y+1)*tile_size, sub_x*tile_size:(sub_x+1)*tile_size]
+
+        aligned = base_tile_x % 2 == 0 and base_tile_y % 2 == 0 and tiles_x % 2 == 0 and tiles_y % 2 == 0
+        if not aligned or zoom <= min_zoom:
+            return block_tiles
+
+        block = downsample(block)
+        zoom -= 1
+        base_tile_x //= 2
+        base_tile_y //= 2
+        tiles_x //= 2
+        tiles_y //= 2
+
+
+class TileCache:
+    """
+    Least recently used cache of decoded tiles, keyed by (zoom, x, y). Holds the tiles on the edges of rendered
+    blocks so that parents spanning several blocks can be built without reading the tiles back from disk.
+    """
+    def __init__(self, max_tiles: int):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+    def get(self, tile):
+        image = self.tiles.get(tile)
+        if image is not None:
+            self.tiles.move_to_end(tile)
+        return image
+
+    def put(self, tile, image: np.ndarray):
+        if self.max_tiles <= 0:
+            return
+        # Copy so that a view doesn't keep the whole block it was cut from alive
+        self.tiles[tile] = np.array(image)
+        self.tiles.move_to_end(tile)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
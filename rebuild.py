@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from config import Config
+from database import open_database, record_tiles
+from image import ImageHandler
+from metrics import metrics
+from pyramid import compose_parent, is_empty
+from render import get_child_tiles
+from tile_store import get_tiles_path
+
+
+def build_zoom_tile(image_handler: ImageHandler, tiles_path: str, tile_size: int, tile: tuple[int, int, int]):
+    """
+    Builds and encodes a zoom tile from its four children in the tile store. Runs in the worker processes of
+    rebuild_pyramid, which writes the result. Returns the tile and its encoded image, or None if it is empty.
+    """
+    children = []
+    for zoom, x, y in get_child_tiles(*tile):
+        child_path = f"{tiles_path}/zoom_{zoom}/{x}/{y}"
+        children.append(image_handler.load_image(child_path) if image_handler.image_exists(child_path) else None)
+
+    if all(child is None or is_empty(child) for child in children):
+        return tile, None
+    return tile, image_handler.encode_image(compose_parent(children, tile_size))
+
+
+def rebuild_pyramid(config: Config, image_handler: ImageHandler, levels: list[int] = None, only_stale=False, processes: int = None):
+    """
+    Rebuilds zoom levels from the tiles below them, one level at a time and across a pool of processes, without
+    rendering anything. levels selects the zoom levels to rebuild, e.g. [-1, -2], and defaults to all of them. With
+    only_stale, only parents that are missing from tiles.db or older than one of their children are rebuilt.
+    """
+    if levels is None:
+        levels = list(range(-1, -config.zoom_levels - 1, -1))
+    levels = sorted(set(levels), reverse=True)
+
+    tiles_path = get_tiles_path(config)
+    con = open_database(config)
+    cur = con.cursor()
+
+    start_time = time.time()
+
+    with ProcessPoolExecutor(processes or os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as pool:
+        for zoom in levels:
+            children = cur.execute(
+                "SELECT x, y, last_modified FROM tiles WHERE render_name = ? AND zoom_level = ?",
+                (config.render_name, zoom + 1)
+            ).fetchall()
+
+            tile_last_modified = {}
+            for x, y, last_modified in children:
+                tile = (zoom, x // 2, y // 2)
+                tile_last_modified[tile] = max(tile_last_modified.get(tile, 0), last_modified)
+
+            if only_stale:
+                existing = cur.execute(
+                    "SELECT x, y, last_modified FROM tiles WHERE render_name = ? AND zoom_level = ?",
+                    (config.render_name, zoom)
+                ).fetchall()
+                existing_last_modified = {(zoom, x, y): last_modified for x, y, last_modified in existing}
+                tiles = [tile for tile in tile_last_modified if existing_last_modified.get(tile, -1) < tile_last_modified[tile]]
+            else:
+                tiles = list(tile_last_modified)
+
+            print(f"Rebuilding {len(tiles)} tiles at zoom level {zoom}...", end="")
+
+            with metrics.span("rebuild_level", zoom=zoom, tiles=len(tiles)):
+                rows = []
+                built_tiles = pool.map(build_zoom_tile, repeat(image_handler), repeat(tiles_path), repeat(config.tile_pixel_size), tiles, chunksize=32)
+                for index, ((zoom, x, y), data) in enumerate(built_tiles):
+                    # Empty tiles have no file, so one left from an earlier render is removed
+                    if data is None:
+                        image_handler.store.remove(f"{tiles_path}/zoom_{zoom}/{x}/{y}")
+                    else:
+                        image_handler.write_tile(f"{tiles_path}/zoom_{zoom}/{x}/{y}", data)
+                    rows.append((zoom, x, y, tile_last_modified[(zoom, x, y)], int(data is None)))
+                    if (index + 1) % 1000 == 0:
+                        print(f"\rRebuilding {len(tiles)} tiles at zoom level {zoom}... ({index + 1} of {len(tiles)})", end="")
+
+                record_tiles(cur, config.render_name, rows)
+                # The next level reads this one from the store
+                image_handler.store.flush()
+                cur.execute("COMMIT")
+            print(f"\rRebuilt {len(tiles)} tiles at zoom level {zoom}.")
+
+    print("Rebuild completed in", time.time() - start_time, "seconds.")
@@ -0,0 +1,82 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from database import open_database
+from image import ImageHandler
+from rebuild import rebuild_pyramid
+from tile_store import get_tiles_path
+
+IMAGE_SIGNATURES = {
+    "png": lambda data: data[:8] == b"\x89PNG\r\n\x1a\n",
+    "webp": lambda data: data[:4] == b"RIFF" and data[8:12] == b"WEBP",
+    "avif": lambda data: data[4:8] == b"ftyp",
+}
+
+
+def has_image_signature(data: bytes, file_extension: str) -> bool:
+    return data is not None and IMAGE_SIGNATURES[file_extension](data)
+
+
+def reconcile(config: Config, image_handler: ImageHandler, verify=False, processes: int = None):
+    """
+    Checks tiles.db against the tile store at every zoom level. Rows of tiles that are missing from the store,
+    empty files, and, with verify, files that aren't valid images are deleted along with the broken files, so the
+    next render renders those zoom 0 tiles again. The zoom levels above are rebuilt here, along with tiles that
+    are in the store but not in tiles.db.
+    """
+    tiles_path = get_tiles_path(config)
+    con = open_database(config)
+    cur = con.cursor()
+
+    start_time = time.time()
+    levels_to_rebuild = []
+    tiles_to_render = 0
+
+    for zoom in range(0, -config.zoom_levels - 1, -1):
+        print(f"Reconciling zoom level {zoom}...", end="")
+        rows = {
+            (x, y): empty for x, y, empty in cur.execute(
+                "SELECT x, y, empty FROM tiles WHERE render_name = ? AND zoom_level = ?", (config.render_name, zoom)
+            )
+        }
+        stored = {(x, y): size for x, y, size in image_handler.store.list_tile_sizes(tiles_path, zoom, config.reconcile_workers)}
+
+        missing = [tile for tile, empty in rows.items() if not empty and tile not in stored]
+        unrecorded = [tile for tile in stored if tile not in rows]
+        # Empty tiles have no file, so a file means the row is out of date
+        not_empty = [tile for tile, empty in rows.items() if empty and tile in stored]
+        broken = [tile for tile, size in stored.items() if size == 0]
+        if verify:
+            candidates = [tile for tile, size in stored.items() if size > 0]
+            with ThreadPoolExecutor(config.reconcile_workers) as pool:
+                valid = pool.map(
+                    lambda tile: has_image_signature(image_handler.store.read(f"{tiles_path}/zoom_{zoom}/{tile[0]}/{tile[1]}"), image_handler.file_extension),
+                    candidates
+                )
+                broken += [tile for tile, tile_valid in zip(candidates, valid) if not tile_valid]
+
+        for x, y in broken:
+            image_handler.store.remove(f"{tiles_path}/zoom_{zoom}/{x}/{y}")
+        image_handler.store.flush()
+        cur.executemany(
+            "DELETE FROM tiles WHERE render_name = ? AND zoom_level = ? AND x = ? AND y = ?",
+            [(config.render_name, zoom, x, y) for x, y in missing + not_empty + broken]
+        )
+        cur.connection.commit()
+
+        print(
+            f"\rZoom level {zoom}: {len(missing)} tiles missing from the store, {len(unrecorded)} missing from tiles.db, "
+            f"{len(broken)} broken and {len(not_empty)} wrongly recorded as empty."
+        )
+        if zoom == 0:
+            tiles_to_render = len(missing) + len(not_empty) + len(broken)
+        elif len(missing) + len(unrecorded) + len(not_empty) + len(broken) > 0:
+            levels_to_rebuild.append(zoom)
+
+    if len(levels_to_rebuild) > 0:
+        rebuild_pyramid(config, image_handler, levels_to_rebuild, only_stale=True, processes=processes)
+    if tiles_to_render > 0:
+        print(f"{tiles_to_render} zoom 0 tiles will be rendered by the next render.")
+
+    print("Reconcile completed in", time.time() - start_time, "seconds.")
@@ -0,0 +1,404 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import zlib
+from typing import NamedTuple
+
+import numpy as np
+
+COMPLETE_STATUSES = {"minecraft:full", "minecraft:initialize_light", "minecraft:carvers", "full", "minecraft:structure_starts", "minecraft:biomes"}
+
+AIR_BLOCKS = {"minecraft:air", "minecraft:cave_air", "minecraft:void_air"}
+
+# Tags that decide how a chunk looks, which are all its digest is made of. Minecraft rewrites the others, such as its
+# timestamps, heightmaps, light and scheduled ticks, whenever it saves the chunk, even if nothing in it was changed
+DIGEST_TAGS = {"Status", "sections", "block_entities"}
+# The same tags in chunks saved before 1.18, which keep them in a Level compound under older names
+LEVEL_DIGEST_TAGS = {"Status", "Sections", "TileEntities", "Biomes"}
+# Tags of a section that decide how it looks. Its light is left out, as Minecraft recomputes it
+SECTION_DIGEST_TAGS = {"Y", "block_states", "biomes", "Palette", "BlockStates", "Blocks", "Data", "Add"}
+
+SECTOR_SIZE = 4096
+READ_SIZE = 4096
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+TAG_LONG_ARRAY = 12
+
+FIXED_TAG_SIZES = {TAG_BYTE: 1, TAG_SHORT: 2, TAG_INT: 4, TAG_LONG: 8, TAG_FLOAT: 4, TAG_DOUBLE: 8}
+FIXED_TAG_FORMATS = {TAG_BYTE: ">b", TAG_SHORT: ">h", TAG_INT: ">i", TAG_LONG: ">q", TAG_FLOAT: ">f", TAG_DOUBLE: ">d"}
+ARRAY_TAG_DTYPES = {TAG_BYTE_ARRAY: ">i1", TAG_INT_ARRAY: ">i4", TAG_LONG_ARRAY: ">i8"}
+
+
+class ChunkScan(NamedTuple):
+    x: int
+    z: int
+    timestamp: int
+    complete: bool
+    digest: bytes = None
+    # Top of the highest section with blocks in it, None if unknown. RegionScanCache keeps the highest it has been
+    height: int = None
+    # Timestamp of the last save that changed the chunk's digest, filled in by RegionScanCache
+    content_modified: int = None
+
+
+class ChunkReader:
+    """
+    Decompresses a chunk a few kilobytes at a time as NBT is read from it, so that reading can stop as soon as the
+    wanted tags have been found.
+    """
+    def __init__(self, data, compression: int, start: int = 0, end: int = None):
+        self.data = data
+        self.data_pos = start
+        self.data_end = len(data) if end is None else end
+        self.buffer = bytearray()
+        self.pos = 0
+        self.hasher = None
+        if compression == 1:
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        elif compression == 2:
+            self.decompressor = zlib.decompressobj()
+        elif compression == 3:
+            self.decompressor = None
+        else:
+            raise ValueError(f"Unsupported chunk compression {compression}")
+
+    def fill(self, size: int):
+        if self.pos > 65536:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        while len(self.buffer) - self.pos < size:
+            if self.data_pos >= self.data_end:
+                raise EOFError("Chunk data ended unexpectedly")
+            data = self.data[self.data_pos:min(self.data_pos + READ_SIZE, self.data_end)]
+            self.data_pos += READ_SIZE
+            self.buffer += self.decompressor.decompress(data) if self.decompressor is not None else data
+
+    def read(self, size: int) -> bytes:
+        self.fill(size)
+        result = bytes(self.buffer[self.pos:self.pos + size])
+        self.pos += size
+        if self.hasher is not None:
+            self.hasher.update(result)
+        return result
+
+    def skip(self, size: int):
+        self.fill(size)
+        if self.hasher is not None:
+            self.hasher.update(self.buffer[self.pos:self.pos + size])
+        self.pos += size
+
+    def read_byte(self) -> int:
+        return self.read(1)[0]
+
+    def read_int(self) -> int:
+        return struct.unpack(">i", self.read(4))[0]
+
+    def read_string(self) -> str:
+        length = struct.unpack(">H", self.read(2))[0]
+        return self.read(length).decode("utf-8", errors="replace")
+
+    def skip_payload(self, tag: int):
+        if tag in FIXED_TAG_SIZES:
+            self.skip(FIXED_TAG_SIZES[tag])
+        elif tag in ARRAY_TAG_DTYPES:
+            self.skip(self.read_int() * np.dtype(ARRAY_TAG_DTYPES[tag]).itemsize)
+        elif tag == TAG_STRING:
+            self.skip(struct.unpack(">H", self.read(2))[0])
+        elif tag == TAG_LIST:
+            element_tag = self.read_byte()
+            length = self.read_int()
+            if element_tag in FIXED_TAG_SIZES:
+                self.skip(FIXED_TAG_SIZES[element_tag] * max(length, 0))
+            else:
+                for _ in range(length):
+                    self.skip_payload(element_tag)
+        elif tag == TAG_COMPOUND:
+            while True:
+                child_tag = self.read_byte()
+                if child_tag == TAG_END:
+                    break
+                self.skip_payload(TAG_STRING)
+                self.skip_payload(child_tag)
+        else:
+            raise ValueError(f"Unknown NBT tag {tag}")
+
+    def read_payload(self, tag: int):
+        """
+        Reads a whole tag payload. Compounds become dicts, lists become lists and arrays become NumPy arrays.
+        """
+        if tag in FIXED_TAG_FORMATS:
+            return struct.unpack(FIXED_TAG_FORMATS[tag], self.read(FIXED_TAG_SIZES[tag]))[0]
+        if tag in ARRAY_TAG_DTYPES:
+            dtype = np.dtype(ARRAY_TAG_DTYPES[tag])
+            return np.frombuffer(self.read(self.read_int() * dtype.itemsize), dtype=dtype)
+        if tag == TAG_STRING:
+            return self.read_string()
+        if tag == TAG_LIST:
+            element_tag = self.read_byte()
+            return [self.read_payload(element_tag) for _ in range(self.read_int())]
+        if tag == TAG_COMPOUND:
+            result = {}
+            while True:
+                child_tag = self.read_byte()
+                if child_tag == TAG_END:
+                    return result
+                name = self.read_string()
+                result[name] = self.read_payload(child_tag)
+        raise ValueError(f"Unknown NBT tag {tag}")
+
+    def scan_tags(self, names: set[str]) -> tuple[dict, bytes]:
+        """
+        Reads the root compound, or the Level compound of chunks saved before 1.18, until all of its digest tags have
+        been read. Returns the values of the named tags, which must be among the digest tags, along with a digest of
+        the digest tags. Each tag is hashed separately and the hashes are combined in name order, so the digest
+        doesn't depend on the order the tags were saved in.
+        """
+        if self.read_byte() != TAG_COMPOUND:
+            raise ValueError("Chunk root is not a compound")
+        self.skip_payload(TAG_STRING)
+
+        digest_tags = DIGEST_TAGS
+        found = {}
+        tag_digests = {}
+        depth = 0
+        # The tags after the last digest tag are left unread
+        while not digest_tags <= tag_digests.keys():
+            tag = self.read_byte()
+            if tag == TAG_END:
+                if depth == 0:
+                    break
+                depth -= 1
+                continue
+            name = self.read_string()
+            if name == "Level" and tag == TAG_COMPOUND:
+                depth += 1
+                digest_tags = LEVEL_DIGEST_TAGS
+                continue
+            if name not in digest_tags:
+                self.skip_payload(tag)
+                continue
+
+            hasher = hashlib.blake2b(bytes([tag]) + name.encode("utf-8"), digest_size=16)
+            if name in ("sections", "Sections"):
+                found[name] = self.read_payload(tag)
+                for section in found[name]:
+                    update_digest(hasher, {key: value for key, value in section.items() if key in SECTION_DIGEST_TAGS})
+            else:
+                self.hasher = hasher
+                if name in names:
+                    found[name] = self.read_payload(tag)
+                else:
+                    self.skip_payload(tag)
+                self.hasher = None
+            tag_digests[name] = hasher.digest()
+
+        digest = hashlib.blake2b(digest_size=16)
+        for name in sorted(tag_digests):
+            digest.update(tag_digests[name])
+        return {name: value for name, value in found.items() if name in names}, digest.digest()
+
+
+def update_digest(hasher, value):
+    """
+    Hashes a tag payload as read by ChunkReader.read_payload, with the tags of compounds in name order.
+    """
+    if isinstance(value, dict):
+        hasher.update(struct.pack(">cI", b"{", len(value)))
+        for key in sorted(value):
+            hasher.update(key.encode("utf-8") + b"\0")
+            update_digest(hasher, value[key])
+    elif isinstance(value, list):
+        hasher.update(struct.pack(">cI", b"[", len(value)))
+        for item in value:
+            update_digest(hasher, item)
+    elif isinstance(value, np.ndarray):
+        hasher.update(struct.pack(">c2sI", b"a", value.dtype.str[1:].encode("ascii"), len(value)))
+        hasher.update(value.tobytes())
+    else:
+        hasher.update(repr(value).encode("utf-8") + b"\0")
+
+def read_region_header(region_file) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Decodes the location and timestamp tables of a region file. Returns the sector offset, sector count and
+    timestamp of each of the 1024 chunk slots, indexed by x + z * 32.
+    """
+    header = np.frombuffer(region_file[:2 * SECTOR_SIZE], dtype=">u4")
+    locations = header[:1024]
+    offsets = (locations >> 8).astype(np.int64)
+    sector_counts = (locations & 0xFF).astype(np.int64)
+    timestamps = header[1024:].astype(np.int64)
+    return offsets, sector_counts, timestamps
+
+
+def get_stored_chunks(region_file, offsets: np.ndarray, sector_counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the indices of the chunk slots whose location points at chunk data that fits in the file. Slots pointing
+    into the header or past the end of the file, or whose length field is larger than their sectors, have no chunk.
+    """
+    in_file = (offsets >= 2) & ((offsets + sector_counts) * SECTOR_SIZE <= len(region_file))
+    indices = []
+    for index in np.flatnonzero(in_file):
+        start = int(offsets[index]) * SECTOR_SIZE
+        length = struct.unpack(">I", region_file[start:start + 4])[0]
+        if 1 < length and length + 4 <= int(sector_counts[index]) * SECTOR_SIZE:
+            indices.append(index)
+    return np.array(indices, dtype=np.int64)
+
+
+def is_section_empty(section: dict) -> bool:
+    if "block_states" in section:
+        palette = section["block_states"].get("palette", [])
+    elif "Palette" in section:
+        palette = section["Palette"]
+    elif "Blocks" in section:
+        # Numeric block IDs from before 1.13, where 0 is air
+        return not np.any(section["Blocks"])
+    else:
+        return True
+    return all(block.get("Name") in AIR_BLOCKS for block in palette)
+
+
+def get_chunk_height(sections: list) -> int:
+    """
+    Returns the y coordinate of the top of the highest section that has blocks in it, or 0 if there are none.
+    """
+    heights = [(section["Y"] + 1) * 16 for section in sections if "Y" in section and not is_section_empty(section)]
+    return max(heights, default=0)
+
+
+def read_chunk_status(region_file, offset: int):
+    """
+    Returns the Status, content digest and height of the chunk stored at the given sector offset. All three are
+    None if the chunk can't be read.
+    """
+    start = offset * SECTOR_SIZE
+    try:
+        length, compression = struct.unpack(">IB", region_file[start:start + 5])
+        if compression & 0x80:
+            # Stored in a separate .mcc file
+            return None, None, None
+        reader = ChunkReader(region_file, compression, start + 5, start + 4 + length)
+        found, digest = reader.scan_tags({"Status", "sections", "Sections"})
+        sections = found.get("sections", found.get("Sections"))
+        return found.get("Status"), digest, None if sections is None else get_chunk_height(sections)
+    except (ValueError, EOFError, struct.error, zlib.error, KeyError, TypeError, AttributeError):
+        return None, None, None
+
+
+def scan_region(region_path: str, region_x: int, region_z: int) -> list[ChunkScan]:
+    """
+    Lists the chunks of a region file from its header, along with the Status, content digest and height of each
+    chunk. Chunks without a readable status are counted as complete.
+    """
+    if os.path.getsize(region_path) < 2 * SECTOR_SIZE:
+        return []
+
+    result = []
+    with open(region_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as region_file:
+        offsets, sector_counts, timestamps = read_region_header(region_file)
+        for index in get_stored_chunks(region_file, offsets, sector_counts):
+            status, digest, height = read_chunk_status(region_file, int(offsets[index]))
+            result.append(ChunkScan(
+                region_x * 32 + int(index) % 32,
+                region_z * 32 + int(index) // 32,
+                int(timestamps[index]),
+                status is None or status in COMPLETE_STATUSES,
+                digest,
+                height
+            ))
+    return result
+
+
+class RegionScanCache:
+    """
+    Stores region scan results in tiles.db, keyed by the region file's mtime and size, so unchanged regions don't
+    need to be scanned again.
+    """
+    def __init__(self, cur: sqlite3.Cursor):
+        self.cur = cur
+        self.regions = {
+            (region_x, region_z): (mtime, size)
+            for region_x, region_z, mtime, size in cur.execute("SELECT region_x, region_z, mtime, size FROM region_scans")
+        }
+
+    def get(self, region_x: int, region_z: int, stat: os.stat_result):
+        """
+        Returns the cached chunks of the region, or None if the region file has changed since it was scanned.
+        """
+        if self.regions.get((region_x, region_z)) != (stat.st_mtime_ns, stat.st_size):
+            return None
+        rows = self.cur.execute(
+            "SELECT chunk_x, chunk_z, timestamp, complete, digest, height, COALESCE(content_modified, timestamp) FROM region_chunks "
+            "WHERE region_x = ? AND region_z = ?",
+            (region_x, region_z)
+        ).fetchall()
+        return [
+            ChunkScan(chunk_x, chunk_z, timestamp, bool(complete), digest, height, content_modified)
+            for chunk_x, chunk_z, timestamp, complete, digest, height, content_modified in rows
+        ]
+
+    def put(self, region_x: int, region_z: int, stat: os.stat_result, chunks: list[ChunkScan]) -> list[ChunkScan]:
+        """
+        Stores the scan of a region and returns its chunks with content_modified filled in. Chunks whose digest is
+        the same as in the previous scan keep their previous content_modified, so re-saving a chunk without
+        changing it doesn't make its tiles stale.
+
+        A chunk's height never goes below the one previously stored. Tiles rendered while a chunk was taller still
+        show its old blocks, so when they are torn down, those tiles must stay in the chunk's window to be
+        rendered again.
+        """
+        previous = {
+            (chunk_x, chunk_z): (digest, content_modified, height)
+            for chunk_x, chunk_z, digest, content_modified, height in self.cur.execute(
+                "SELECT chunk_x, chunk_z, digest, COALESCE(content_modified, timestamp), height FROM region_chunks "
+                "WHERE region_x = ? AND region_z = ?",
+                (region_x, region_z)
+            )
+        }
+        result = []
+        for chunk in chunks:
+            previous_digest, previous_content_modified, previous_height = previous.get((chunk.x, chunk.z), (None, None, None))
+            if chunk.height is not None and previous_height is not None:
+                chunk = chunk._replace(height=max(chunk.height, previous_height))
+            if chunk.digest is not None and chunk.digest == previous_digest:
+                result.append(chunk._replace(content_modified=previous_content_modified))
+            else:
+                result.append(chunk._replace(content_modified=chunk.timestamp))
+
+        self.cur.execute("DELETE FROM region_chunks WHERE region_x = ? AND region_z = ?", (region_x, region_z))
+        self.cur.executemany(
+            "INSERT OR REPLACE INTO region_chunks (region_x, region_z, chunk_x, chunk_z, timestamp, complete, digest, height, content_modified) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (region_x, region_z, chunk.x, chunk.z, chunk.timestamp, int(chunk.complete), chunk.digest, chunk.height, chunk.content_modified)
+                for chunk in result
+            ]
+        )
+        self.cur.execute(
+            "INSERT OR REPLACE INTO region_scans (region_x, region_z, mtime, size) VALUES (?, ?, ?, ?)",
+            (region_x, region_z, stat.st_mtime_ns, stat.st_size)
+        )
+        self.regions[(region_x, region_z)] = (stat.st_mtime_ns, stat.st_size)
+        return result
+
+    def remove_missing(self, regions: list[tuple[int, int]]):
+        """
+        Forgets regions whose files no longer exist.
+        """
+        for region_x, region_z in set(self.regions) - set(regions):
+            self.cur.execute("DELETE FROM region_chunks WHERE region_x = ? AND region_z = ?", (region_x, region_z))
+            self.cur.execute("DELETE FROM region_scans WHERE region_x = ? AND region_z = ?", (region_x, region_z))
+            del self.regions[(region_x, region_z)]
@@ -0,0 +1,781 @@
+import os
+import subprocess
+import sys
+import json
+import sqlite3
+
+import fs
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+
+import numpy as np
+
+from config import Config
+from coord_index import CoordIndex
+from database import open_database, record_tiles, get_dirty_tiles, set_dirty_tiles, get_tile_arrays
+from metrics import metrics
+from octree_cache import create_octree_cache, get_octree_key
+from pipeline import PostProcessPipeline
+from pyramid import TileCache, get_block_tiles, compose_parent, is_empty
+from region_scan import scan_region, RegionScanCache, ChunkScan
+from schedule import Schedule, combine_schedules, get_render_runs, plan_schedule, print_schedule, record_timing
+from snapshot import get_output_mode, get_snapshot_extension, read_snapshot
+from tile_math import get_camera_pos_of_tile, get_tiles_for_chunks, get_chunks_for_batch, get_tile_last_modified, to_tuples, \
+    get_chunk_padding_top, filter_chunks_for_batch, unique_coords
+from image import ImageHandler, create_image_handler, get_image_format
+from tile_store import get_output_path
+
+
+def get_batch_chunks(config: Config, batch_x, batch_y, chunk_padding_top: CoordIndex) -> np.ndarray:
+    """
+    Returns the chunks of chunk_padding_top that are loaded to render the batch, given the top padding of each.
+    """
+    chunks = get_chunks_for_batch(config, batch_x, batch_y)
+    chunks = chunks[chunk_padding_top.contains(chunks)]
+    return filter_chunks_for_batch(config, batch_x, batch_y, chunks, chunk_padding_top.lookup(chunks))
+
+
+def get_chunklist(config: Config, batch_x, batch_y, chunk_padding_top: CoordIndex):
+    """
+    get_batch_chunks as a list of tuples, as written to the scene.
+    """
+    return to_tuples(get_batch_chunks(config, batch_x, batch_y, chunk_padding_top))
+
+
+def run_chunky(config: Config, chunky_args: list[str]):
+    args = ["java", f"-Dchunky.home={config.chunky_home_path}", "-jar", "chunky/ChunkyLauncher.jar", f"-threads", str(config.threads)]
+    for arg in chunky_args:
+        args.append(arg)
+    subprocess.Popen(args).wait()
+
+
+def merge_settings(settings: dict, overrides: dict) -> dict:
+    """
+    Returns settings with overrides applied, merging nested dicts key by key.
+    """
+    merged = dict(settings)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_settings(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_scene_settings(config: Config) -> dict:
+    """
+    Returns default_settings.json with the scene overrides of the config applied.
+    """
+    scene = json.load(open("default_settings.json", "r"))
+    if config.scene_overrides:
+        scene = merge_settings(scene, config.scene_overrides)
+    return scene
+
+
+def create_scene(config: Config, scene_name, tile_x, tile_y, chunks: list[tuple[int, int]], reset=False) -> dict:
+    """
+    Writes the scene for rendering the tiles from tile_x, tile_y on, and returns its settings.
+    """
+    scene = load_scene_settings(config)
+
+    scenes = fs.open_fs("")
+    scenes.makedirs("chunky/scenes/"+scene_name, recreate=True)
+    scene_fs = scenes.opendir("chunky/scenes/"+scene_name)
+
+    if scene_fs.exists(scene_name+".dump"):
+        scene_fs.remove(scene_name+".dump")
+    if reset and scene_fs.exists(scene_name+".octree2"):
+        scene_fs.remove(scene_name+".octree2")
+
+    camera = scene["camera"]
+    camera["projectionMode"] = "PARALLEL"
+    camera["dof"] = "Infinity"
+    camera["focalOffset"] = 0.0
+    camera["shift"]["x"] = 0.0
+    camera["shift"]["y"] = 0.0
+    scene["spp"] = 0
+    scene["sppTarget"] = config.samples_per_pixel
+    scene["outputMode"] = get_output_mode(config)
+    scene["name"] = scene_name
+    scene["width"] = config.tile_pixel_size * config.tile_render_batch_size
+    scene["height"] = config.tile_pixel_size * config.tile_render_batch_size
+    scene["chunkList"] = chunks
+    scene["entities"] = []
+    scene["actors"] = []
+    scene["world"]["path"] = config.world_path
+
+    scene["waterOpacity"] = 0.42
+    scene["waterVisibility"] = 15.0
+
+    center_tile_x = tile_x + (config.tile_render_batch_size - 1) / 2
+    center_tile_y = tile_y + (config.tile_render_batch_size - 1) / 2
+
+    camera_x, camera_y, camera_z = get_camera_pos_of_tile(config, center_tile_x, center_tile_y)
+
+    camera["position"]["x"] = camera_x
+    camera["position"]["y"] = camera_y
+    camera["position"]["z"] = camera_z
+    camera["fov"] = 22.625 * config.tile_render_batch_size
+
+    scene_fs.writebytes(scene_name + ".json", json.dumps(scene).encode("utf-8"))
+    return scene
+
+
+def list_regions(config: Config):
+    world_fs = fs.open_fs(config.world_path)
+    regions = world_fs.listdir("region")
+    regions = [region for region in regions if region.endswith(".mca")]
+    regions = [(int(region.split(".")[1]), int(region.split(".")[2])) for region in regions]
+    return regions
+
+
+def run_batch(
+        config: Config,
+        image_handler: ImageHandler,
+        batch_x,
+        batch_y,
+        chunks: list[tuple[int, int]],
+        tiles_to_render,
+        cur: sqlite3.Cursor,
+        tile_last_modified,
+        zoom_tiles_to_render: CoordIndex,
+        scene_name: str = None,
+        min_zoom: int = None,
+        pipeline: PostProcessPipeline = None,
+        tile_cache: TileCache = None,
+        octree_key: str = None,
+        reset_octree: bool = True
+) -> bool:
+    """
+    Renders one batch. chunks is the batch's chunk list, from get_chunklist. scene_name selects the Chunky scene directory to render in, which lets several
+    workers share one output directory. min_zoom limits how far up the zoom pyramid is built.
+
+    Snapshots are post-processed through pipeline while Chunky renders the next sub-batch. Without a pipeline,
+    one is created for the batch and drained before returning. tile_cache keeps tiles on the edges of the batch
+    for building zoom tiles that span several batches. octree_key, from get_octree_key, lets the batch reuse the
+    octree of an earlier render of the same chunks from the octree cache. Without reset_octree, the octree left in the
+    scene by the previous batch is rendered from, which is how presets share one chunk load.
+
+    Returns whether Chunky was run, which it isn't if none of the batch's tiles are to be rendered.
+    """
+    if pipeline is None:
+        with PostProcessPipeline(config.postprocess_queue_size) as batch_pipeline:
+            return run_batch(config, image_handler, batch_x, batch_y, chunks, tiles_to_render, cur, tile_last_modified, zoom_tiles_to_render, scene_name, min_zoom, batch_pipeline, tile_cache, octree_key, reset_octree)
+
+    scene_name = scene_name or config.scene_name
+    first = reset_octree
+    batch_loads_chunks = False
+    batch_start_time = time.time()
+
+    output_fs = fs.open_fs(get_output_path(config), create=True)
+    output_fs.makedirs("tiles", recreate=True)
+    scene_fs = fs.open_fs("chunky/scenes/" + scene_name, create=True)
+    num_chunks = len(chunks)
+    octree_cache = create_octree_cache(config) if octree_key is not None else None
+    octree_path = f"chunky/scenes/{scene_name}/{scene_name}.octree2"
+
+    # tiles_to_render is modified by the post-processing thread, so it must not be iterated here
+    runs = get_render_runs(config, batch_x, batch_y, tiles_to_render)
+    for sub_x, sub_y, num_tiles in runs:
+        tile_x = batch_x * config.tile_batch_size + sub_x * config.tile_render_batch_size
+        tile_y = batch_y * config.tile_batch_size + sub_y * config.tile_render_batch_size
+
+        scene = create_scene(config, scene_name, tile_x, tile_y, chunks, reset=first)
+        octree_cached = first and octree_cache is not None and octree_cache.fetch(octree_key, octree_path)
+        if octree_cached:
+            print(f"Reusing the cached octree of batch {batch_x}, {batch_y}.")
+        # Chunky's startup, chunk loading and path tracing happen in one process, so loads_chunks tells the runs
+        # that loaded chunks apart from those that only loaded the octree
+        loads_chunks = first and not octree_cached
+        batch_loads_chunks |= loads_chunks
+        if loads_chunks:
+            metrics.count("chunks_loaded", num_chunks)
+        run_start_time = time.time()
+        with metrics.span("chunky", render_name=config.render_name, batch=[batch_x, batch_y], sub_batch=[sub_x, sub_y],
+                          chunks=num_chunks, tiles=num_tiles, spp=config.samples_per_pixel, loads_chunks=loads_chunks):
+            run_chunky(
+                config,
+                ["-f", "-render", "chunky/scenes/" + scene_name + "/" + scene_name + ".json"]
+            )
+        if first and octree_cache is not None:
+            octree_cache.store(octree_key, octree_path)
+        first = False
+        # The cursor belongs to the pipeline until it is drained, so timings are recorded through it
+        pipeline.submit(
+            record_timing, config, cur, batch_x, batch_y, sub_x, sub_y, num_chunks, num_tiles, loads_chunks, time.time() - run_start_time,
+            takes_slot=False
+        )
+
+        # Give the snapshot a name of its own so no later render, of this batch, a later batch or another preset,
+        # overwrites it while it waits to be processed
+        extension = get_snapshot_extension(config)
+        snapshot_path = f"snapshots/{scene_name}-{config.render_name}-{batch_x}-{batch_y}-{sub_x}-{sub_y}.{extension}"
+        scene_fs.move(f"snapshots/{scene_name}-{config.samples_per_pixel}.{extension}", snapshot_path, overwrite=True)
+
+        pipeline.submit(
+            move_image,
+            config,
+            image_handler,
+            scene_fs,
+            output_fs,
+            snapshot_path,
+            scene["exposure"],
+            scene["postprocess"],
+            tile_x,
+            tile_y,
+            tiles_to_render,
+            cur,
+            tile_last_modified,
+            zoom_tiles_to_render,
+            min_zoom,
+            tile_cache
+        )
+
+    if len(runs) > 0:
+        pipeline.submit(
+            record_timing, config, cur, batch_x, batch_y, None, None, num_chunks, sum(tiles for _, _, tiles in runs), batch_loads_chunks,
+            time.time() - batch_start_time, takes_slot=False
+        )
+    return len(runs) > 0
+
+
+def move_image(
+        config: Config,
+        image_handler: ImageHandler,
+        scene_fs,
+        output_fs,
+        snapshot_path,
+        exposure: float,
+        postprocess: str,
+        base_tile_x,
+        base_tile_y,
+        tiles_to_render,
+        cur: sqlite3.Cursor,
+        tile_last_modified,
+        zoom_tiles_to_render: CoordIndex,
+        min_zoom: int = None,
+        tile_cache: TileCache = None
+):
+    if min_zoom is None:
+        min_zoom = -config.zoom_levels
+
+    with metrics.span("snapshot_decode", format=config.snapshot_format):
+        image = read_snapshot(config, scene_fs.getsyspath(snapshot_path), exposure, postprocess)
+
+    # The zoom levels that lie entirely inside the snapshot are downsampled from it in one go
+    with metrics.span("crop"):
+        block_tiles = get_block_tiles(image, base_tile_x, base_tile_y, config.tile_pixel_size, min_zoom)
+
+    tiles_rendered = []
+    rows = []
+    images = []
+    path_tiles = {}
+
+    for sub_x, sub_y in itertools.product(range(config.tile_render_batch_size), range(config.tile_render_batch_size)):
+        tile_x = base_tile_x + sub_x
+        tile_y = base_tile_y + sub_y
+        if (tile_x, tile_y) not in tiles_to_render:
+            continue
+        cropped = block_tiles[(0, tile_x, tile_y)]
+        os_path = output_fs.getospath(f"tiles/zoom_0/{tile_x}/{tile_y}")
+        if is_empty(cropped):
+            # Empty tiles have no file, so one left from an earlier render is removed
+            image_handler.remove_image(os_path)
+            rows.append((0, tile_x, tile_y, tile_last_modified[(tile_x, tile_y)], 1))
+            tiles_rendered.append((0, tile_x, tile_y, tile_last_modified[(tile_x, tile_y)]))
+            tiles_to_render.remove((tile_x, tile_y))
+            zoom_tiles_to_render.remove((0, tile_x, tile_y))
+            continue
+        images.append((cropped, os_path))
+        path_tiles[os_path] = (tile_x, tile_y)
+
+    # Only record tiles in the database once their files have been written
+    with metrics.span("encode", zoom=0, tiles=len(images)):
+        for os_path in image_handler.save_images(images):
+            tile_x, tile_y = path_tiles[os_path]
+            rows.append((0, tile_x, tile_y, tile_last_modified[(tile_x, tile_y)], 0))
+            tiles_rendered.append((0, tile_x, tile_y, tile_last_modified[(tile_x, tile_y)]))
+            tiles_to_render.remove((tile_x, tile_y))
+            zoom_tiles_to_render.remove((0, tile_x, tile_y))
+    metrics.count("tiles_written", len(images))
+    metrics.count("empty_tiles", len(rows) - len(images))
+
+    if tile_cache is not None:
+        for tile, tile_image in block_tiles.items():
+            if get_parent_tile(*tile) not in block_tiles:
+                tile_cache.put(tile, tile_image)
+
+    record_tiles(cur, config.render_name, rows)
+    with metrics.span("zoom_tiles"):
+        check_make_zoom_tiles(config, image_handler, output_fs.opendir("tiles"), tiles_rendered, zoom_tiles_to_render, cur, min_zoom, block_tiles, tile_cache)
+    # The tiles and the journal entries they clear are committed together
+    with metrics.span("commit"):
+        cur.execute("COMMIT")
+
+    scene_fs.remove(snapshot_path)
+
+
+def get_parent_tile(zoom_level, tile_x, tile_z):
+    return zoom_level - 1, tile_x // 2, tile_z // 2
+
+
+def get_child_tiles(zoom_level, tile_x, tile_z):
+    yield zoom_level + 1, tile_x * 2, tile_z * 2
+    yield zoom_level + 1, tile_x * 2 + 1, tile_z * 2
+    yield zoom_level + 1, tile_x * 2, tile_z * 2 + 1
+    yield zoom_level + 1, tile_x * 2 + 1, tile_z * 2 + 1
+
+
+def check_make_zoom_tiles(
+        config: Config,
+        image_handler: ImageHandler,
+        tile_fs,
+        tiles_rendered,
+        zoom_tiles_to_render,
+        cur: sqlite3.Cursor,
+        min_zoom: int = None,
+        block_tiles: dict = None,
+        tile_cache: TileCache = None
+):
+    """
+    Builds the parents of the rendered tiles once none of their children are waiting to be rendered, and then
+    their parents in turn. Tiles are taken from block_tiles, the tiles downsampled from the current snapshot, then
+    from tile_cache and only then read back from disk. Empty tiles have no file and are read as None. Parents
+    whose children are all empty are recorded as empty without being composed.
+    """
+    if block_tiles is None:
+        block_tiles = {}
+    if min_zoom is None:
+        min_zoom = -config.zoom_levels
+    upper_tiles = set()
+    tile_last_modified = {}
+
+    for zoom, x, y, last_modified in tiles_rendered:
+        upper_tile = (zoom - 1, x // 2, y // 2)
+        if upper_tile not in upper_tiles:
+            upper_tiles.add(upper_tile)
+            tile_last_modified[upper_tile] = last_modified
+        else:
+            tile_last_modified[upper_tile] = max(tile_last_modified[upper_tile], last_modified)
+
+    upper_tiles = [x for x in upper_tiles if x[0] >= min_zoom and all(y not in zoom_tiles_to_render for y in get_child_tiles(*x))]
+
+    def get_tile(tile):
+        if tile in block_tiles:
+            return block_tiles[tile]
+        if tile_cache is not None:
+            cached = tile_cache.get(tile)
+            if cached is not None:
+                return cached
+        zoom, x, y = tile
+        src_path_os = tile_fs.getospath(f"zoom_{zoom}/{x}/{y}")
+        if not image_handler.image_exists(src_path_os):
+            return None
+        return image_handler.load_image(src_path_os)
+
+    empty_tiles = []
+
+    def make_zoom_tiles():
+        for upper_tile in upper_tiles:
+            zoom, x, y = upper_tile
+            if upper_tile in block_tiles:
+                dst_image = block_tiles[upper_tile]
+            else:
+                children = [get_tile(child) for child in get_child_tiles(*upper_tile)]
+                if all(child is None or is_empty(child) for child in children):
+                    dst_image = None
+                else:
+                    dst_image = compose_parent(children, config.tile_pixel_size)
+                    if tile_cache is not None:
+                        tile_cache.put(upper_tile, dst_image)
+
+            if dst_image is None or is_empty(dst_image):
+                empty_tiles.append(upper_tile)
+                continue
+            yield dst_image, tile_fs.getospath(f"zoom_{zoom}/{x}/{y}")
+
+    path_tiles = {tile_fs.getospath(f"zoom_{zoom}/{x}/{y}"): (zoom, x, y) for zoom, x, y in upper_tiles}
+    rows = []
+
+    for os_path in image_handler.save_images(make_zoom_tiles()):
+        upper_tile = path_tiles[os_path]
+        rows.append((*upper_tile, tile_last_modified[upper_tile], 0))
+        zoom_tiles_to_render.remove(upper_tile)
+
+    for upper_tile in empty_tiles:
+        zoom, x, y = upper_tile
+        image_handler.remove_image(tile_fs.getospath(f"zoom_{zoom}/{x}/{y}"))
+        rows.append((*upper_tile, tile_last_modified[upper_tile], 1))
+        zoom_tiles_to_render.remove(upper_tile)
+
+    record_tiles(cur, config.render_name, rows)
+    metrics.count("tiles_written", len(rows) - len(empty_tiles))
+    metrics.count("empty_tiles", len(empty_tiles))
+
+    if len(upper_tiles) > 0 and all(tile[0] > min_zoom for tile in upper_tiles):
+        next_tiles_to_render = [(zoom, x, y, tile_last_modified[(zoom, x, y)]) for zoom, x, y in upper_tiles]
+        check_make_zoom_tiles(config, image_handler, tile_fs, next_tiles_to_render, zoom_tiles_to_render, cur, min_zoom, block_tiles, tile_cache)
+
+
+def make_pending_zoom_tiles(config: Config, image_handler: ImageHandler, cur: sqlite3.Cursor):
+    """
+    Builds the zoom tiles left in the journal whose children are all done, such as the parents of tiles rendered by
+    a run that was stopped before it got to them. Each level is built from the tiles.db rows of the level below.
+    """
+    zoom_tiles_to_render = get_dirty_tiles(cur, config.render_name)
+    output_fs = fs.open_fs(get_output_path(config), create=True)
+    output_fs.makedirs("tiles", recreate=True)
+    tile_fs = output_fs.opendir("tiles")
+
+    for zoom in range(-1, -config.zoom_levels - 1, -1):
+        pending = {(x, y) for tile_zoom, x, y in zoom_tiles_to_render if tile_zoom == zoom}
+        if len(pending) == 0:
+            continue
+        children = cur.execute(
+            "SELECT x, y, last_modified FROM tiles WHERE render_name = ? AND zoom_level = ?", (config.render_name, zoom + 1)
+        ).fetchall()
+        tiles_rendered = [(zoom + 1, x, y, last_modified) for x, y, last_modified in children if (x // 2, y // 2) in pending]
+        print(f"Building {len(pending)} pending tiles at zoom level {zoom}...")
+        with metrics.span("pending_zoom_tiles", zoom=zoom, tiles=len(pending)):
+            check_make_zoom_tiles(config, image_handler, tile_fs, tiles_rendered, zoom_tiles_to_render, cur, zoom)
+
+        # Tiles with no children left have nothing to be built from
+        orphans = pending - {(x // 2, y // 2) for _, x, y, _ in tiles_rendered} - \
+            {(x // 2, y // 2) for tile_zoom, x, y in zoom_tiles_to_render if tile_zoom == zoom + 1}
+        cur.executemany(
+            "DELETE FROM dirty_tiles WHERE render_name = ? AND zoom_level = ? AND x = ? AND y = ?",
+            [(config.render_name, zoom, x, y) for x, y in orphans]
+        )
+        zoom_tiles_to_render -= {(zoom, x, y) for x, y in orphans}
+        cur.connection.commit()
+
+
+def tiles_to_batches(config: Config, tiles: CoordIndex) -> set[tuple[int, int]]:
+    return set(to_tuples(unique_coords(tiles.coords() // config.tile_batch_size)))
+
+
+def get_zoom_tiles_to_render(tiles_to_render: CoordIndex, zoom_levels) -> CoordIndex:
+    """
+    Returns the zoom 0 tiles to render along with every upper zoom tile above them, as (zoom, x, y) coordinates.
+    """
+    levels = []
+    lower_tiles = tiles_to_render.coords()
+    for zoom_level in range(0, -zoom_levels - 1, -1):
+        levels.append(np.concatenate([np.full((len(lower_tiles), 1), zoom_level, dtype=np.int64), lower_tiles], axis=1))
+        lower_tiles = unique_coords(lower_tiles // 2)
+
+    return CoordIndex(np.concatenate(levels), dims=3)
+
+
+def list_chunks_in_region(config: Config, region_x, region_z):
+    chunks = scan_region(get_region_path(config, region_x, region_z), region_x, region_z)
+    return [(chunk.x, chunk.z, chunk.timestamp) for chunk in chunks if chunk.complete]
+
+
+def get_region_path(config: Config, region_x, region_z):
+    return f"{config.world_path}/region/r.{region_x}.{region_z}.mca"
+
+
+def scan_regions(config: Config, regions: list[tuple[int, int]]):
+    """
+    Scans regions across scan_processes processes. Yields (region_x, region_z, chunks, error) as each region
+    finishes, where error is the exception raised while scanning the region, if any.
+    """
+    if config.scan_processes <= 1:
+        for region_x, region_z in regions:
+            try:
+                yield region_x, region_z, scan_region(get_region_path(config, region_x, region_z), region_x, region_z), None
+            except Exception as e:
+                yield region_x, region_z, None, e
+        return
+
+    with ProcessPoolExecutor(config.scan_processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {
+            pool.submit(scan_region, get_region_path(config, region_x, region_z), region_x, region_z): (region_x, region_z)
+            for region_x, region_z in regions
+        }
+        for future in as_completed(futures):
+            region_x, region_z = futures[future]
+            error = future.exception()
+            yield region_x, region_z, future.result() if error is None else None, error
+
+
+def list_world_chunks(config: Config, cur: sqlite3.Cursor, dry_run=False) -> list[ChunkScan]:
+    """
+    Lists the chunks of every region in the world. Regions that haven't changed since the last run are read from
+    the scan cache in tiles.db, the rest are scanned in parallel. Regions that fail to scan are reported and left
+    out. The chunks have content_modified filled in. With dry_run, the new scans aren't written to the cache.
+    """
+    regions = list_regions(config)
+    region_cache = RegionScanCache(cur)
+
+    chunks = []
+    region_stats = {}
+    for region_x, region_z in regions:
+        region_stat = os.stat(get_region_path(config, region_x, region_z))
+        cached_chunks = None if config.force_rescan else region_cache.get(region_x, region_z, region_stat)
+        if cached_chunks is None:
+            region_stats[(region_x, region_z)] = region_stat
+        else:
+            chunks.extend(cached_chunks)
+
+    print(f"{len(regions) - len(region_stats)} of {len(regions)} regions are unchanged since the last scan.")
+    print(f"Listing chunks...", end="")
+    regions_failed = 0
+    for region_index, (region_x, region_z, region_chunks, error) in enumerate(scan_regions(config, list(region_stats))):
+        print(f"\rListing chunks... ({region_index + 1} of {len(region_stats)})", end="")
+        if error is not None:
+            print(f"\nFailed to scan region {region_x}, {region_z}: {error}", file=sys.stderr)
+            regions_failed += 1
+            continue
+        chunks.extend(region_cache.put(region_x, region_z, region_stats[(region_x, region_z)], region_chunks))
+    print()
+
+    if regions_failed > 0:
+        print(f"{regions_failed} regions could not be scanned and were skipped.")
+
+    region_cache.remove_missing(regions)
+    if dry_run:
+        cur.connection.rollback()
+    else:
+        cur.connection.commit()
+    return chunks
+
+
+@dataclass
+class RenderPlan:
+    chunk_padding_top: CoordIndex
+    chunk_last_modified: CoordIndex
+    tile_last_modified: CoordIndex
+    tiles_to_render: CoordIndex
+    zoom_tiles_to_render: CoordIndex
+    batches: list[tuple[int, int]]
+    schedule: Schedule
+
+
+def write_index(config: Config):
+    output_fs = fs.open_fs(get_output_path(config), create=True)
+    if not output_fs.exists("index.html"):
+        with output_fs.open("index.html", "w") as index_output, open("index.template.html", "r") as index_template:
+            index_output.write(
+                index_template.read() \
+                              .replace("#TILE_SIZE#", str(config.tile_pixel_size)) \
+                              .replace("#ZOOM_LEVELS#", str(config.zoom_levels)) \
+                              .replace("#FILE_FORMAT#", get_image_format(config))
+            )
+
+
+def plan_render(
+        config: Config,
+        cur: sqlite3.Cursor,
+        dry_run=False,
+        chunks: list[ChunkScan] = None,
+        chunk_counts: dict[tuple[int, int], int] = None,
+        octree_batches: set[tuple[int, int]] = None
+) -> RenderPlan:
+    """
+    Lists all chunks in the world and works out which tiles and batches need to be rendered. tiles.db is taken as
+    the record of which tiles exist; use --reconcile to check it against the tile store. The tiles to render and
+    build are written to the journal in tiles.db, along with any an earlier run left pending, and the region scan
+    cache is updated, unless dry_run is set. chunks, from list_world_chunks, saves listing them again when planning
+    several presets, and chunk_counts, the number of chunks each batch loads, saves counting them again.
+    octree_batches, the batches whose octree is cached or built by an earlier preset, is passed on to plan_schedule.
+    """
+    if chunks is None:
+        with metrics.span("region_scan"):
+            chunks = list_world_chunks(config, cur, dry_run)
+    chunks = [chunk for chunk in chunks if chunk.complete]
+    chunk_coords = np.array([(chunk.x, chunk.z) for chunk in chunks], dtype=np.int64).reshape(-1, 2)
+    # Re-saving a chunk updates its timestamp, so only changes to its content count
+    chunk_last_modified = np.array([chunk.content_modified for chunk in chunks], dtype=np.int64)
+    # Chunks only reach as many tiles up as their highest blocks do
+    padding_top = get_chunk_padding_top(config, [chunk.height for chunk in chunks])
+    del chunks
+
+    tiles = get_tiles_for_chunks(config, chunk_coords, padding_top)
+
+    print(f"There are {len(chunk_coords)} chunks needing {len(tiles)} tiles.")
+    print("Generating tile list...")
+
+    tile_last_modified = CoordIndex(tiles, get_tile_last_modified(config, chunk_coords, chunk_last_modified, tiles, padding_top))
+
+    existing_tiles, existing_last_modified = get_tile_arrays(cur, config.render_name, 0)
+    existing_needed = tile_last_modified.contains(existing_tiles)
+
+    num_unknown_tiles_db = int(np.count_nonzero(~existing_needed))
+    if num_unknown_tiles_db > 0:
+        print(f"{num_unknown_tiles_db} tiles exist in the database but aren't needed. Ignoring them.")
+
+    unchanged_tiles = CoordIndex(existing_tiles[existing_needed & (tile_last_modified.lookup(existing_tiles) == existing_last_modified)])
+
+    num_tiles_missing_from_db = len(tiles) - int(np.count_nonzero(existing_needed))
+    if num_tiles_missing_from_db > 0:
+        print(f"{num_tiles_missing_from_db} tiles missing from database. Assuming they need to be updated.")
+
+    tiles_to_render = CoordIndex(tiles[~unchanged_tiles.contains(tiles)])
+
+    # Tiles left in the journal by a run that was stopped are picked up where it left off
+    dirty_tiles = get_dirty_tiles(cur, config.render_name)
+    if len(dirty_tiles) > 0:
+        print(f"Resuming {len(dirty_tiles)} tiles left pending by an earlier run.")
+        dirty_tiles = CoordIndex(list(dirty_tiles), dims=3)
+        dirty_render_tiles = dirty_tiles.coords()
+        dirty_render_tiles = dirty_render_tiles[dirty_render_tiles[:, 0] == 0, 1:]
+        tiles_to_render |= CoordIndex(dirty_render_tiles[tile_last_modified.contains(dirty_render_tiles)])
+    else:
+        dirty_tiles = CoordIndex(dims=3)
+
+    zoom_tiles_to_render = get_zoom_tiles_to_render(tiles_to_render, config.zoom_levels)
+    dirty_zoom_tiles = dirty_tiles.coords()
+    zoom_tiles_to_render.update(dirty_zoom_tiles[dirty_zoom_tiles[:, 0] < 0])
+    if not dry_run:
+        set_dirty_tiles(cur, config.render_name, zoom_tiles_to_render)
+
+    zoom_levels = zoom_tiles_to_render.coords()[:, 0]
+    for zoom_level in reversed(range(-config.zoom_levels, 0)):
+        print("Zoom level", zoom_level, "has", int(np.count_nonzero(zoom_levels == zoom_level)), "tiles.")
+
+    print(len(zoom_tiles_to_render))
+
+    print(f"There are {int(np.count_nonzero(existing_needed))} existing tiles. {len(unchanged_tiles)} are unchanged.")
+    print(f"Total tiles to render: {len(tiles_to_render)}.")
+
+    batches = tiles_to_batches(config, tiles_to_render)
+    print(f"Render will consist of {len(batches)} batches.")
+
+    chunk_padding_top = CoordIndex(chunk_coords, padding_top)
+    chunk_last_modified = CoordIndex(chunk_coords, chunk_last_modified)
+    # Batches whose octree is in the cache don't load their chunks, which the schedule needs to know to predict them
+    octree_cache = create_octree_cache(config)
+    cached_octrees = octree_cache.keys() if octree_cache is not None else set()
+    scene = load_scene_settings(config) if len(cached_octrees) > 0 else None
+    if octree_batches is None:
+        octree_batches = set()
+    # Only the counts are kept, as the chunk lists of every batch would take more memory than the rest of the plan.
+    # Each batch's list is made once more when it is rendered
+    if chunk_counts is None:
+        chunk_counts = {}
+    for batch in batches:
+        if batch not in chunk_counts:
+            batch_chunks = get_chunklist(config, *batch, chunk_padding_top)
+            chunk_counts[batch] = len(batch_chunks)
+            if scene is not None and get_octree_key(config, scene, batch_chunks, chunk_last_modified) in cached_octrees:
+                octree_batches.add(batch)
+    schedule = plan_schedule(config, cur, batches, tiles_to_render, chunk_counts, octree_batches)
+
+    print("First 5 batches: ", schedule.batches[:5])
+
+    return RenderPlan(chunk_padding_top, chunk_last_modified, tile_last_modified, tiles_to_render, zoom_tiles_to_render, schedule.batches, schedule)
+
+
+def plan_presets(config: Config, cur: sqlite3.Cursor, dry_run=False) -> list[tuple[Config, RenderPlan]]:
+    """
+    Plans the render of each preset, listing the chunks of the world only once.
+    """
+    presets = config.get_presets()
+    with metrics.span("region_scan"):
+        chunks = list_world_chunks(config, cur, dry_run)
+    plans = []
+    # The presets load the same chunks, so each batch's chunks are counted once for all of them, and only the first
+    # preset to render a batch loads them
+    chunk_counts = {}
+    octree_batches = set()
+    for preset in presets:
+        if len(presets) > 1:
+            print(f"Planning preset {preset.render_name}...")
+        plans.append((preset, plan_render(preset, cur, dry_run, chunks, chunk_counts, octree_batches)))
+    return plans
+
+
+def render_presets(
+        config: Config,
+        plans: list[tuple[Config, RenderPlan]],
+        image_handlers: list[ImageHandler],
+        tile_caches: list[TileCache],
+        cur: sqlite3.Cursor,
+        pipeline: PostProcessPipeline,
+        batch_x,
+        batch_y
+):
+    """
+    Renders a batch of every preset from one load of its chunks.
+    """
+    # The presets render from the same chunks, so the first one's chunk list stands for all of them
+    first_plan = plans[0][1]
+    chunks = get_chunklist(config, batch_x, batch_y, first_plan.chunk_padding_top)
+    octree_key = get_octree_key(config, load_scene_settings(plans[0][0]), chunks, first_plan.chunk_last_modified)
+    reset_octree = True
+    with metrics.span("batch", batch=[batch_x, batch_y]):
+        for (preset, plan), image_handler, tile_cache in zip(plans, image_handlers, tile_caches):
+            # Only the first preset with tiles to render in the batch loads its chunks
+            if run_batch(
+                preset,
+                image_handler,
+                batch_x,
+                batch_y,
+                chunks,
+                plan.tiles_to_render,
+                cur,
+                plan.tile_last_modified,
+                plan.zoom_tiles_to_render,
+                pipeline=pipeline,
+                tile_cache=tile_cache,
+                octree_key=octree_key,
+                reset_octree=reset_octree
+            ):
+                reset_octree = False
+
+
+def render(config: Config, image_handler: ImageHandler):
+    """
+    Renders every preset, or just render_name without presets. image_handler is that of the first preset. Each
+    batch loads its chunks once and renders the presets one after another from the same octree.
+    """
+    con = open_database(config)
+    cur = con.cursor()
+
+    start_time = time.time()
+
+    with metrics.span("plan"):
+        plans = plan_presets(config, cur)
+    for preset, _ in plans:
+        write_index(preset)
+    image_handlers = [image_handler] + [create_image_handler(preset) for preset, _ in plans[1:]]
+    tile_caches = [TileCache(config.pyramid_cache_tiles) for _ in plans]
+    schedule = combine_schedules([plan.schedule for _, plan in plans])
+
+    batches_completed = 0
+    total_batches = len(schedule.batches)
+
+    rendering_start_time = time.time()
+
+    with PostProcessPipeline(config.postprocess_queue_size) as pipeline:
+        for batch_x, batch_y in schedule.batches:
+            if batches_completed > 0:
+                elapsed_time = time.time() - rendering_start_time
+                print(f"Rendering batch {batch_x}, {batch_y}. Completed: ({batches_completed}/{total_batches}). ETA: {schedule.get_eta(batches_completed, elapsed_time):.0f} seconds")
+            else:
+                print(f"Rendering batch {batch_x}, {batch_y}")
+            render_presets(config, plans, image_handlers, tile_caches, cur, pipeline, batch_x, batch_y)
+            batches_completed += 1
+            metrics.count("batches")
+            metrics.flush()
+
+    for (preset, _), preset_image_handler in zip(plans, image_handlers):
+        make_pending_zoom_tiles(preset, preset_image_handler, cur)
+    for preset_image_handler in image_handlers[1:]:
+        preset_image_handler.close()
+
+    print("Render completed in", time.time() - start_time, "seconds.")
+
+
+def print_plan(config: Config):
+    """
+    Plans the render and prints its schedule and predicted time without rendering anything or writing to tiles.db.
+    """
+    con = open_database(config)
+    plans = plan_presets(config, con.cursor(), dry_run=True)
+    print_schedule(combine_schedules([plan.schedule for _, plan in plans]))
@@ -0,0 +1,182 @@
+import itertools
+import sqlite3
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from config import Config
+from coord_index import CoordIndex
+from tile_math import get_tile_rect, get_z_order
+
+# Fewer Chunky runs than this on record are too few to fit the cost model to
+MIN_HISTORY = 8
+# Only the most recent runs are fitted to, so the model follows changes to the machine and to Chunky
+MAX_HISTORY = 2000
+
+
+def get_render_runs(config: Config, batch_x, batch_y, tiles_to_render: CoordIndex) -> list[tuple[int, int, int]]:
+    """
+    Returns the (sub_x, sub_y, number of tiles to render) of each sub-batch of the batch that Chunky is run for,
+    which are those with tiles to render.
+    """
+    size = config.tile_render_batch_size
+    subs = config.tile_batch_size // size
+    tile_x = batch_x * config.tile_batch_size
+    tile_y = batch_y * config.tile_batch_size
+    tiles = get_tile_rect(tile_x, tile_y, tile_x + subs * size - 1, tile_y + subs * size - 1)
+    # get_tile_rect lists tiles by x and then y, so this splits them into (sub_x, x, sub_y, y)
+    counts = tiles_to_render.contains(tiles).reshape(subs, size, subs, size).sum(axis=(1, 3))
+    return [(sub_x, sub_y, int(counts[sub_x, sub_y])) for sub_x, sub_y in itertools.product(range(subs), range(subs)) if counts[sub_x, sub_y] > 0]
+
+
+def order_batches(batches) -> list[tuple[int, int]]:
+    """
+    Orders batches along a Z-order curve, so the batches under each zoom tile are rendered one after another and
+    the pyramid above them can be built early.
+    """
+    batches = list(batches)
+    if len(batches) == 0:
+        return batches
+    return [batches[i] for i in np.argsort(get_z_order(batches), kind="stable")]
+
+
+class CostModel:
+    """
+    Predicts the seconds a Chunky run takes from the number of chunks in its scene, the number of tiles it renders,
+    its samples per pixel and whether it loads the chunks, by least squares fits to the runs recorded in tiles.db.
+    Runs that load the chunks and runs that reuse an octree, left by the batch's first run or taken from the octree
+    cache, are fitted separately, as loading the chunks can take up most of a run. With too few runs of one kind on
+    record, it is predicted from the fit to the other, and with too few of either, every run is predicted to take
+    the average recorded time, or one unit if none are recorded.
+    """
+    def __init__(self, history: np.ndarray):
+        history = np.asarray(history, dtype=np.float64).reshape(-1, 5)
+        self.samples = len(history)
+        self.mean = history[:, 4].mean() if self.samples > 0 else 1.0
+        # Coefficients and the time of the cheapest run on record, which no run of the kind is predicted below
+        self.fits = {}
+        for loads_chunks in (True, False):
+            runs = history[(history[:, 3] != 0) == loads_chunks]
+            if len(runs) >= MIN_HISTORY:
+                features = self.get_features(runs[:, 0], runs[:, 1], runs[:, 2])
+                self.fits[loads_chunks] = (np.linalg.lstsq(features, runs[:, 4], rcond=None)[0], runs[:, 4].min())
+
+    @staticmethod
+    def get_features(chunks, tiles, spp) -> np.ndarray:
+        chunks, tiles, spp = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (chunks, tiles, spp)))
+        return np.stack([np.ones_like(chunks), chunks, tiles, spp], axis=-1)
+
+    def predict(self, chunks, tiles, spp, loads_chunks) -> np.ndarray:
+        chunks, tiles, spp, loads_chunks = np.broadcast_arrays(chunks, tiles, spp, np.asarray(loads_chunks, dtype=bool))
+        features = self.get_features(chunks, tiles, spp)
+        predictions = np.full(features.shape[:-1], self.mean)
+        for kind in (True, False):
+            fit = self.fits.get(kind, self.fits.get(not kind))
+            if fit is not None:
+                coefficients, floor = fit
+                predictions[loads_chunks == kind] = np.maximum(features[loads_chunks == kind] @ coefficients, floor)
+        return predictions
+
+
+def load_cost_model(cur: sqlite3.Cursor) -> CostModel:
+    # Runs recorded before loads_chunks was kept are left out, as it isn't known which of them loaded the chunks
+    history = cur.execute(
+        "SELECT chunks, tiles, spp, loads_chunks, seconds FROM render_timings WHERE sub_x IS NOT NULL AND loads_chunks IS NOT NULL "
+        "ORDER BY finished DESC LIMIT ?",
+        (MAX_HISTORY,)
+    ).fetchall()
+    return CostModel(history)
+
+
+def record_timing(config: Config, cur: sqlite3.Cursor, batch_x, batch_y, sub_x, sub_y, chunks, tiles, loads_chunks: bool, seconds):
+    """
+    Records how long a Chunky run took, or with sub_x and sub_y None, a whole batch. loads_chunks is whether the run,
+    or any run of the batch, loaded the chunks rather than reusing an octree.
+    """
+    cur.execute(
+        "INSERT INTO render_timings (render_name, batch_x, batch_y, sub_x, sub_y, chunks, tiles, spp, loads_chunks, seconds, finished) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (config.render_name, batch_x, batch_y, sub_x, sub_y, chunks, tiles, config.samples_per_pixel, int(loads_chunks), seconds, time.time())
+    )
+    cur.connection.commit()
+
+
+@dataclass
+class Schedule:
+    batches: list[tuple[int, int]]
+    # Predicted cost of each batch, in seconds if timed and in Chunky runs otherwise
+    costs: list[float]
+    timed: bool
+    cumulative_costs: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.cumulative_costs = np.concatenate([[0.0], np.cumsum(self.costs)])
+
+    def get_total_cost(self) -> float:
+        return float(self.cumulative_costs[-1])
+
+    def get_eta(self, completed: int, elapsed: float) -> float:
+        """
+        Returns the seconds left after the first completed batches took elapsed seconds, from the predicted cost of
+        the remaining batches scaled by how the completed ones compared to their prediction.
+        """
+        done = self.cumulative_costs[completed]
+        remaining = self.cumulative_costs[-1] - done
+        if done <= 0:
+            return float(remaining) if self.timed else 0.0
+        return float(elapsed / done * remaining)
+
+
+def plan_schedule(
+        config: Config,
+        cur: sqlite3.Cursor,
+        batches,
+        tiles_to_render,
+        chunk_counts: dict[tuple[int, int], int],
+        octree_batches: set[tuple[int, int]] = None
+) -> Schedule:
+    """
+    Orders the batches along a Z-order curve and predicts the cost of each from the render timings in tiles.db.
+    chunk_counts maps each batch to the number of chunks it loads. The first run of each batch is predicted to load
+    its chunks, unless the batch is in octree_batches, the batches whose octree is cached or built by an earlier
+    preset. The batches are added to octree_batches, as presets planned after this one render from its octree.
+    """
+    if octree_batches is None:
+        octree_batches = set()
+    batches = order_batches(batches)
+    model = load_cost_model(cur)
+    costs = []
+    for batch in batches:
+        tiles = [tiles for _, _, tiles in get_render_runs(config, *batch, tiles_to_render)]
+        loads_chunks = [index == 0 and batch not in octree_batches for index in range(len(tiles))]
+        costs.append(float(model.predict(chunk_counts[batch], tiles, config.samples_per_pixel, loads_chunks).sum()))
+    octree_batches.update(batches)
+    return Schedule(batches, costs, model.samples > 0)
+
+
+def combine_schedules(schedules: list[Schedule]) -> Schedule:
+    """
+    Merges the schedules of presets that are rendered batch by batch into one, adding up the cost of each batch.
+    """
+    if len(schedules) == 1:
+        return schedules[0]
+    costs = {}
+    for schedule in schedules:
+        for batch, cost in zip(schedule.batches, schedule.costs):
+            costs[batch] = costs.get(batch, 0.0) + cost
+    batches = order_batches(costs)
+    return Schedule(batches, [costs[batch] for batch in batches], all(schedule.timed for schedule in schedules))
+
+
+def print_schedule(schedule: Schedule, limit: int = 20):
+    unit = "seconds" if schedule.timed else "Chunky runs"
+    print(f"{len(schedule.batches)} batches in Z-order. The first {min(limit, len(schedule.batches))}:")
+    for (batch_x, batch_y), cost in zip(schedule.batches[:limit], schedule.costs[:limit]):
+        print(f"  Batch {batch_x}, {batch_y}: {cost:.1f} {unit}")
+
+    total = schedule.get_total_cost()
+    if schedule.timed:
+        print(f"Predicted render time: {total:.0f} seconds ({total / 3600:.1f} hours).")
+    else:
+        print(f"No render timings are recorded yet. The render will take {total:.0f} Chunky runs.")
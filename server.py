@@ -0,0 +1,75 @@
+import os
+import re
+import shutil
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import Config
+from image import ImageHandler
+from render import write_index
+from tile_store import DirectoryTileStore, get_output_path, get_tiles_path
+
+CONTENT_TYPES = {"png": "image/png", "avif": "image/avif", "webp": "image/webp"}
+
+TILE_URL_PATTERN = re.compile(r"/tiles/zoom_(-?\d+)/(-?\d+)/(-?\d+)\.(\w+)")
+
+
+def serve_tiles(config: Config, image_handler: ImageHandler, port: int):
+    """
+    Serves index.html and the tile URLs it requests straight from the tile store, so a packed store can be
+    viewed without exporting it.
+    """
+    write_index(config)
+    index_path = f"{get_output_path(config)}/index.html"
+    tiles_path = get_tiles_path(config)
+
+    class TileRequestHandler(BaseHTTPRequestHandler):
+        def send_data(self, data: bytes, content_type: str):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = urllib.parse.urlparse(self.path).path
+            if path in ("/", "/index.html"):
+                with open(index_path, "rb") as f:
+                    self.send_data(f.read(), "text/html; charset=utf-8")
+                return
+
+            match = TILE_URL_PATTERN.fullmatch(path)
+            if match is not None and match[4] == image_handler.file_extension:
+                data = image_handler.store.read(f"{tiles_path}/zoom_{match[1]}/{match[2]}/{match[3]}")
+                if data is not None:
+                    self.send_data(data, CONTENT_TYPES[image_handler.file_extension])
+                    return
+            self.send_error(404)
+
+    server = ThreadingHTTPServer(("", port), TileRequestHandler)
+    print(f"Serving the map on http://localhost:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def export_tiles(config: Config, image_handler: ImageHandler, output_path: str):
+    """
+    Copies index.html and every tile in the tile store to output_path, in the tiles/zoom_<z>/<x>/<y> layout that
+    index.html requests, for hosting as static files.
+    """
+    write_index(config)
+    os.makedirs(output_path, exist_ok=True)
+    shutil.copyfile(f"{get_output_path(config)}/index.html", os.path.join(output_path, "index.html"))
+
+    tiles_path = get_tiles_path(config)
+    output_store = DirectoryTileStore(image_handler.file_extension)
+    for zoom in range(0, -config.zoom_levels - 1, -1):
+        tiles = list(image_handler.store.list_tiles(tiles_path, zoom))
+        for index, (x, y) in enumerate(tiles):
+            output_store.write(f"{output_path}/tiles/zoom_{zoom}/{x}/{y}", image_handler.store.read(f"{tiles_path}/zoom_{zoom}/{x}/{y}"))
+            if (index + 1) % 1000 == 0:
+                print(f"\rExporting zoom level {zoom}... ({index + 1} of {len(tiles)})", end="")
+        print(f"\rExported {len(tiles)} tiles at zoom level {zoom}.")
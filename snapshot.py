@@ -0,0 +1,87 @@
+import numpy as np
+from PIL import Image
+
+from config import Config
+
+# The gamma of Chunky's GAMMA post-processing
+GAMMA = 2.2
+# Rows of pixels converted at a time, which bounds the float temporaries of a PFM snapshot
+STRIP_ROWS = 256
+
+SNAPSHOT_FORMATS = {
+    # Format: (Chunky output mode, snapshot file extension)
+    "png": ("PNG", "png"),
+    "pfm": ("PFM", "pfm"),
+}
+PFM_POSTPROCESSING = ("GAMMA", "NONE")
+
+
+def get_output_mode(config: Config) -> str:
+    return SNAPSHOT_FORMATS[config.snapshot_format][0]
+
+
+def get_snapshot_extension(config: Config) -> str:
+    return SNAPSHOT_FORMATS[config.snapshot_format][1]
+
+
+def check_scene(config: Config, scene: dict):
+    """
+    Raises ValueError if snapshots of the scene can't be read in config.snapshot_format.
+    """
+    if config.snapshot_format not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Unknown snapshot format {config.snapshot_format}, expected one of {', '.join(SNAPSHOT_FORMATS)}")
+    if config.snapshot_format == "pfm" and scene["postprocess"] not in PFM_POSTPROCESSING:
+        raise ValueError(f"PFM snapshots can't be post-processed with {scene['postprocess']}, only with {' or '.join(PFM_POSTPROCESSING)}")
+
+
+def read_pfm(path: str) -> np.ndarray:
+    """
+    Memory maps a colour PFM file. Returns its pixels as a (height, width, 3) float32 view, top row first, without
+    reading them.
+    """
+    tokens = []
+    offset = 0
+    with open(path, "rb") as f:
+        while len(tokens) < 4:
+            line = f.readline()
+            if len(line) == 0:
+                raise ValueError(f"{path} ends inside its PFM header")
+            offset += len(line)
+            tokens.extend(line.split())
+    if tokens[0] != b"PF":
+        raise ValueError(f"{path} isn't a colour PFM file")
+    width, height, scale = int(tokens[1]), int(tokens[2]), float(tokens[3])
+    # The sign of the scale gives the byte order
+    pixels = np.memmap(path, dtype="<f4" if scale < 0 else ">f4", mode="r", offset=offset, shape=(height, width, 3))
+    # Rows are stored from the bottom up
+    return pixels[::-1]
+
+
+def tone_map(pixels: np.ndarray, exposure: float, postprocess: str) -> np.ndarray:
+    """
+    Converts linear float RGB pixels to an RGBA array the way Chunky post-processes its PNG output. PFM has no
+    alpha channel, so every pixel is opaque.
+    """
+    height, width = pixels.shape[:2]
+    result = np.empty((height, width, 4), dtype=np.uint8)
+    result[..., 3] = 255
+    for start in range(0, height, STRIP_ROWS):
+        strip = np.maximum(pixels[start:start + STRIP_ROWS] * np.float32(exposure), 0)
+        if postprocess == "GAMMA":
+            np.power(strip, np.float32(1 / GAMMA), out=strip)
+        np.minimum(strip, 1, out=strip)
+        result[start:start + STRIP_ROWS, :, :3] = strip * 255 + 0.5
+    return result
+
+
+def read_snapshot(config: Config, path: str, exposure: float, postprocess: str) -> np.ndarray:
+    """
+    Reads a snapshot Chunky rendered as an RGBA array. exposure and postprocess are those of its scene, which PFM
+    snapshots are tone-mapped with. The tiles and zoom tiles cut from it are views into this array.
+    """
+    if config.snapshot_format == "pfm":
+        return tone_map(read_pfm(path), exposure, postprocess)
+    with Image.open(path) as image:
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        return np.asarray(image)
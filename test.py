@@ -1,6 +1,39 @@
+import dataclasses
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from unittest import mock
 
+import numpy as np
+from PIL import Image
+from nbt import nbt, region
+
+import benchmark
+import coord_index
+import database
+import farm
+import image
+import metrics
+import octree_cache
+import pipeline
+import pyramid
+import rebuild
+import region_scan
+import render
+import schedule
+import snapshot
 import tile_math
+import tile_store
+import watch
 from config import Config
 
 
@@ -62,5 +95,1010 @@ class TestTileCoordinates(unittest.TestCase):
         )
 
 
+class TestPyramid(unittest.TestCase):
+    def test_downsample(self):
+        image = np.zeros((2, 2, 4), dtype=np.uint8)
+        image[0, 0] = (200, 100, 50, 255)
+        image[1, 1] = (0, 0, 0, 255)
+
+        self.assertListEqual(pyramid.downsample(image)[0, 0].tolist(), [100, 50, 25, 128])
+
+    def test_is_empty(self):
+        image = np.zeros((4, 4, 4), dtype=np.uint8)
+        image[..., :3] = 255
+        self.assertTrue(pyramid.is_empty(image))
+        image[3, 3, 3] = 1
+        self.assertFalse(pyramid.is_empty(image))
+
+    def test_block_tiles_match_composed_parents(self):
+        rng = np.random.default_rng(0)
+        block = rng.integers(0, 256, (32, 32, 4), dtype=np.uint8)
+
+        block_tiles = pyramid.get_block_tiles(block, 4, -4, 8, -8)
+
+        self.assertEqual(min(tile[0] for tile in block_tiles), -2)
+        for (zoom, x, y), image in block_tiles.items():
+            if zoom == 0:
+                continue
+            children = [block_tiles[(zoom + 1, x * 2 + dx, y * 2 + dy)] for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]]
+            np.testing.assert_array_equal(image, pyramid.compose_parent(children, 8))
+
+
+def reference_tile_for_chunk(chunk_x, chunk_z):
+    return math.floor(chunk_x - (chunk_z + chunk_x) / 2), math.floor((chunk_z + chunk_x) / 4 + 0.5)
+
+
+def reference_tiles_for_chunk(config, chunk_x, chunk_z):
+    base_tile_x, base_tile_y = reference_tile_for_chunk(chunk_x, chunk_z)
+    width = 2 if (chunk_x + chunk_z) % 2 == 1 else 1
+    base_tile_y -= config.tile_padding_top
+    height = config.tile_padding_top + config.tile_padding_bottom + 1
+    return {(x, y) for x in range(base_tile_x, base_tile_x + width) for y in range(base_tile_y, base_tile_y + height)}
+
+
+def reference_chunks_for_tile(tile_x, tile_y):
+    center_x = tile_x + 2 * tile_y
+    center_y = -tile_x + 2 * tile_y
+    return {
+        (center_x-2, center_y-1), (center_x-1, center_y-2), (center_x-1, center_y-1), (center_x-1, center_y),
+        (center_x, center_y-1), (center_x, center_y), (center_x, center_y+1), (center_x+1, center_y),
+    }
+
+
+def reference_chunkset_for_tile(config, tile_x, tile_z):
+    base_x = tile_x - config.tile_border_size
+    base_z = tile_z - config.tile_border_size - config.tile_padding_top
+    width = config.tile_border_size * 2 + 1
+    height = width + config.tile_padding_top + config.tile_padding_bottom
+    chunkset = set()
+    for i in range(width):
+        for j in range(height):
+            chunkset |= reference_chunks_for_tile(base_x + i, base_z + j)
+    return chunkset
+
+
+def reference_chunklist_for_batch(config, batch_x, batch_y):
+    base_x = batch_x * config.tile_batch_size - config.tile_border_size
+    base_y = batch_y * config.tile_batch_size - config.tile_border_size - config.tile_padding_top
+    width = config.tile_batch_size + config.tile_border_size * 2 + 1
+    height = width + config.tile_padding_top + config.tile_padding_bottom
+    chunkset = set()
+    for i in range(width):
+        for j in range(height):
+            chunkset |= reference_chunkset_for_tile(config, base_x + i, base_y + j)
+    return sorted(chunkset)
+
+
+def random_config(rng):
+    return Config(
+        tile_batch_size=rng.choice([1, 2, 4]),
+        tile_border_size=rng.randint(0, 2),
+        tile_padding_top=rng.randint(0, 3),
+        tile_padding_bottom=rng.randint(0, 2),
+    )
+
+
+class TestVectorizedTileMath(unittest.TestCase):
+    def test_tile_for_chunks(self):
+        rng = np.random.default_rng(1)
+        chunks = rng.integers(-100000, 100000, (1000, 2))
+        tiles = tile_math.get_tile_for_chunks(Config(), chunks)
+        for (chunk_x, chunk_z), tile in zip(chunks.tolist(), tiles.tolist()):
+            self.assertTupleEqual(tuple(tile), reference_tile_for_chunk(chunk_x, chunk_z))
+
+    def test_tiles_for_chunks(self):
+        rng = random.Random(2)
+        for _ in range(50):
+            config = random_config(rng)
+            chunks = [(rng.randint(-50, 50), rng.randint(-50, 50)) for _ in range(rng.randint(0, 30))]
+            expected = set()
+            for chunk_x, chunk_z in chunks:
+                expected |= reference_tiles_for_chunk(config, chunk_x, chunk_z)
+            self.assertListEqual(tile_math.to_tuples(tile_math.get_tiles_for_chunks(config, chunks)), sorted(expected))
+            if len(chunks) > 0:
+                self.assertSetEqual(tile_math.get_tiles_for_chunk(config, *chunks[0]), reference_tiles_for_chunk(config, *chunks[0]))
+
+    def test_chunks_for_tiles(self):
+        rng = random.Random(3)
+        for _ in range(50):
+            tiles = [(rng.randint(-50, 50), rng.randint(-50, 50)) for _ in range(rng.randint(0, 30))]
+            expected = set()
+            for tile_x, tile_y in tiles:
+                expected |= reference_chunks_for_tile(tile_x, tile_y)
+            self.assertListEqual(tile_math.to_tuples(tile_math.get_chunks_for_tiles(Config(), tiles)), sorted(expected))
+
+    def test_chunklists(self):
+        rng = random.Random(4)
+        for _ in range(30):
+            config = random_config(rng)
+            x, y = rng.randint(-20, 20), rng.randint(-20, 20)
+            self.assertListEqual(tile_math.get_chunklist_for_tile(config, x, y), sorted(reference_chunkset_for_tile(config, x, y)))
+            self.assertListEqual(tile_math.get_chunklist_for_batch(config, x, y), reference_chunklist_for_batch(config, x, y))
+
+    def test_tile_last_modified(self):
+        rng = random.Random(5)
+        for _ in range(30):
+            config = random_config(rng)
+            chunks = {(rng.randint(-40, 40), rng.randint(-40, 40)): rng.randint(1, 1000) for _ in range(rng.randint(0, 200))}
+            tiles = [(rng.randint(-30, 30), rng.randint(-30, 30)) for _ in range(50)]
+            expected = []
+            for tile_x, tile_y in tiles:
+                timestamps = [chunks[chunk] for chunk in reference_chunkset_for_tile(config, tile_x, tile_y) if chunk in chunks]
+                expected.append(max(timestamps, default=0))
+            last_modified = tile_math.get_tile_last_modified(config, list(chunks), list(chunks.values()), tiles, max_cells=rng.choice([64, 1 << 22]))
+            self.assertListEqual(last_modified.tolist(), expected)
+
+    def test_chunk_padding_top(self):
+        rng = random.Random(6)
+        for _ in range(20):
+            config = random_config(rng)
+            chunks = list({(rng.randint(-30, 30), rng.randint(-30, 30)): None for _ in range(rng.randint(1, 60))})
+            timestamps = [rng.randint(1, 1000) for _ in chunks]
+            padding_top = [rng.randint(0, config.tile_padding_top) for _ in chunks]
+            chunk_configs = [dataclasses.replace(config, tile_padding_top=padding) for padding in padding_top]
+
+            expected_tiles = set()
+            for chunk, chunk_config in zip(chunks, chunk_configs):
+                expected_tiles |= reference_tiles_for_chunk(chunk_config, *chunk)
+            self.assertListEqual(tile_math.to_tuples(tile_math.get_tiles_for_chunks(config, chunks, padding_top)), sorted(expected_tiles))
+
+            tiles = [(rng.randint(-20, 20), rng.randint(-20, 20)) for _ in range(30)]
+            expected_last_modified = []
+            for tile in tiles:
+                tile_chunks = {padding: reference_chunkset_for_tile(dataclasses.replace(config, tile_padding_top=padding), *tile) for padding in set(padding_top)}
+                expected_last_modified.append(max(
+                    (timestamp for chunk, timestamp, padding in zip(chunks, timestamps, padding_top) if chunk in tile_chunks[padding]), default=0
+                ))
+            self.assertListEqual(tile_math.get_tile_last_modified(config, chunks, timestamps, tiles, padding_top).tolist(), expected_last_modified)
+
+            batch_x, batch_y = rng.randint(-3, 3), rng.randint(-3, 3)
+            batch_chunks = {padding: set(reference_chunklist_for_batch(dataclasses.replace(config, tile_padding_top=padding), batch_x, batch_y)) for padding in set(padding_top)}
+            expected_chunks = [chunk for chunk, padding in zip(chunks, padding_top) if chunk in batch_chunks[padding]]
+            self.assertListEqual(tile_math.to_tuples(tile_math.filter_chunks_for_batch(config, batch_x, batch_y, chunks, padding_top)), expected_chunks)
+
+        self.assertListEqual(tile_math.get_chunk_padding_top(Config(), [None, -64, 0, 1, 64, 1000]).tolist(), [13, 0, 0, 1, 3, 13])
+
+    def test_tiles_depending_on_chunks(self):
+        rng = random.Random(7)
+        for _ in range(20):
+            config = random_config(rng)
+            chunks = list({(rng.randint(-20, 20), rng.randint(-20, 20)): None for _ in range(rng.randint(1, 10))})
+            padding_top = [rng.randint(0, config.tile_padding_top) for _ in chunks]
+            tiles = tile_math.get_tile_rect(-40, -40, 40, 40)
+            last_modified = tile_math.get_tile_last_modified(config, chunks, [1] * len(chunks), tiles, padding_top)
+            self.assertListEqual(
+                tile_math.to_tuples(tile_math.get_tiles_depending_on_chunks(config, chunks, padding_top)),
+                tile_math.to_tuples(tiles[last_modified > 0])
+            )
+
+    def test_chunks_for_tile_chunklists(self):
+        rng = random.Random(8)
+        for _ in range(20):
+            config = random_config(rng)
+            tiles = [(rng.randint(-20, 20), rng.randint(-20, 20)) for _ in range(rng.randint(0, 5))]
+            expected = set()
+            for tile in tiles:
+                expected |= reference_chunkset_for_tile(config, *tile)
+            self.assertListEqual(tile_math.to_tuples(tile_math.get_chunks_for_tile_chunklists(config, tiles)), sorted(expected))
+
+    def test_unique_coords(self):
+        coords = [(3, -1), (-5, 2), (3, -1), (-5, -7), (0, 0)]
+        self.assertListEqual(tile_math.to_tuples(tile_math.unique_coords(coords)), sorted(set(coords)))
+
+
+def make_chunk(chunk_x, chunk_z, status, old_format=False, last_update=0, block=0, sections=None):
+    """
+    Returns a chunk with the given status and sections, a dict of section y to the block names of its palette. block
+    stands for the contents of a block entity, while last_update goes into the tags Minecraft rewrites on every save.
+    old_format nests the tags in a Level compound under their names from before 1.18.
+    """
+    chunk = nbt.NBTFile()
+    level = chunk
+    if old_format:
+        level = nbt.TAG_Compound(name="Level")
+        chunk.tags.append(level)
+    level.tags.append(nbt.TAG_Long(name="LastUpdate", value=last_update))
+    level.tags.append(nbt.TAG_Long(name="InhabitedTime", value=last_update // 2))
+    block_entities = nbt.TAG_List(name="TileEntities" if old_format else "block_entities", type=nbt.TAG_Compound)
+    block_entity = nbt.TAG_Compound()
+    block_entity.tags.append(nbt.TAG_String(name="id", value="minecraft:chest"))
+    block_entity.tags.append(nbt.TAG_Int(name="Block", value=block))
+    block_entities.tags.append(block_entity)
+    level.tags.append(block_entities)
+    level.tags.append(nbt.TAG_Long_Array(name="Padding"))
+    level.tags[-1].value = list(range(512))
+    level.tags.append(nbt.TAG_Int(name="xPos", value=chunk_x))
+    level.tags.append(nbt.TAG_Int(name="zPos", value=chunk_z))
+    heightmaps = nbt.TAG_Compound(name="Heightmaps")
+    heightmaps.tags.append(nbt.TAG_Long_Array(name="MOTION_BLOCKING"))
+    heightmaps.tags[-1].value = [last_update] * 37
+    level.tags.append(heightmaps)
+    if old_format:
+        level.tags.append(nbt.TAG_Int_Array(name="Biomes"))
+        level.tags[-1].value = [1] * 1024
+    level.tags.append(nbt.TAG_String(name="Status", value=status))
+    if sections is not None:
+        section_list = nbt.TAG_List(name="Sections" if old_format else "sections", type=nbt.TAG_Compound)
+        for section_y, blocks in sections.items():
+            section = nbt.TAG_Compound()
+            section.tags.append(nbt.TAG_Byte(name="Y", value=section_y))
+            palette = nbt.TAG_List(name="Palette" if old_format else "palette", type=nbt.TAG_Compound)
+            for block_name in blocks:
+                block_state = nbt.TAG_Compound()
+                block_state.tags.append(nbt.TAG_String(name="Name", value=block_name))
+                palette.tags.append(block_state)
+            if old_format:
+                section.tags.append(palette)
+            else:
+                block_states = nbt.TAG_Compound(name="block_states")
+                block_states.tags.append(palette)
+                section.tags.append(block_states)
+            section.tags.append(nbt.TAG_Byte_Array(name="SkyLight"))
+            section.tags[-1].value = bytearray([last_update % 256] * 2048)
+            section_list.tags.append(section)
+        level.tags.append(section_list)
+    block_ticks = nbt.TAG_List(name="TileTicks" if old_format else "block_ticks", type=nbt.TAG_Compound)
+    block_tick = nbt.TAG_Compound()
+    block_tick.tags.append(nbt.TAG_Int(name="t", value=last_update))
+    block_ticks.tags.append(block_tick)
+    level.tags.append(block_ticks)
+    return chunk
+
+class TestCoordIndex(unittest.TestCase):
+    def test_mapping(self):
+        rng = random.Random(8)
+        for dims in (2, 3):
+            expected = {}
+            coords = []
+            for _ in range(300):
+                coord = tuple(rng.randint(-50, 50) for _ in range(dims))
+                coords.append(coord)
+                expected[coord] = rng.randint(0, 1000)
+            index = coord_index.CoordIndex(list(expected), list(expected.values()), dims=dims)
+            self.assertEqual(len(index), len(expected))
+            self.assertListEqual(list(index), sorted(expected))
+
+            queries = coords[:50] + [tuple(rng.randint(-60, 60) for _ in range(dims)) for _ in range(50)]
+            self.assertListEqual(index.contains(queries).tolist(), [coord in expected for coord in queries])
+            self.assertListEqual(index.lookup(queries, -1).tolist(), [expected.get(coord, -1) for coord in queries])
+            for coord in queries:
+                self.assertEqual(coord in index, coord in expected)
+                self.assertEqual(index.get(coord), expected.get(coord))
+
+            for coord in coords[:20]:
+                if coord in expected:
+                    index.remove(coord)
+                    del expected[coord]
+            index.discard(coords[20:40])
+            for coord in coords[20:40]:
+                expected.pop(coord, None)
+            added = {tuple(rng.randint(-60, 60) for _ in range(dims)): rng.randint(0, 1000) for _ in range(40)}
+            index.update(list(added), list(added.values()))
+            expected.update(added)
+            self.assertListEqual(list(zip(index.to_tuples(), index.get_values().tolist())), sorted(expected.items()))
+            with self.assertRaises(KeyError):
+                index.remove(coords[0])
+
+    def test_set_operations(self):
+        rng = random.Random(9)
+        a = {(rng.randint(-20, 20), rng.randint(-20, 20)) for _ in range(200)}
+        b = {(rng.randint(-20, 20), rng.randint(-20, 20)) for _ in range(200)}
+        index_a = coord_index.CoordIndex(list(a))
+        index_b = coord_index.CoordIndex(list(b))
+        self.assertListEqual(index_a.intersection(index_b).to_tuples(), sorted(a & b))
+        self.assertListEqual(index_a.difference(index_b).to_tuples(), sorted(a - b))
+        index_a |= index_b
+        self.assertListEqual(index_a.to_tuples(), sorted(a | b))
+        index_a -= b
+        self.assertListEqual(index_a.to_tuples(), sorted(a - b))
+        self.assertEqual(len(coord_index.CoordIndex()), 0)
+        self.assertFalse(coord_index.CoordIndex().contains([(0, 0)])[0])
+
+
+class TestRegionScan(unittest.TestCase):
+    def test_scan_region(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "r.-1.2.mca")
+            open(path, "wb").close()
+            region_file = region.RegionFile(path)
+            region_file.write_chunk(0, 0, make_chunk(-32, 64, "minecraft:full"))
+            region_file.write_chunk(31, 1, make_chunk(-1, 65, "minecraft:noise"))
+            region_file.write_chunk(5, 31, make_chunk(-27, 95, "full", old_format=True))
+            timestamps = {(chunk["x"], chunk["z"]): region_file.metadata[(chunk["x"], chunk["z"])].timestamp for chunk in region_file.get_chunks()}
+            first_offset = region_file.metadata[(0, 0)].blockstart
+            region_file.close()
+            # Broken locations pointing into the header, past the end of the file and at more data than their sectors
+            with open(path, "r+b") as f:
+                for index, offset, sector_count in ((2, 1, 1), (3, 1000, 1), (4, first_offset, 0)):
+                    f.seek(index * 4)
+                    f.write(((offset << 8) | sector_count).to_bytes(4, "big"))
+
+            chunks = region_scan.scan_region(path, -1, 2)
+
+        self.assertSetEqual(
+            {(chunk.x, chunk.z, chunk.timestamp, chunk.complete) for chunk in chunks},
+            {
+                (-32, 64, timestamps[(0, 0)], True),
+                (-1, 65, timestamps[(31, 1)], False),
+                (-27, 95, timestamps[(5, 31)], True),
+            }
+        )
+
+    def test_synthetic_world(self):
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark.generate_world(directory, 24, 0.25, 1000)
+            chunks = [
+                chunk for name in os.listdir(os.path.join(directory, "region"))
+                for chunk in region_scan.scan_region(os.path.join(directory, "region", name), *map(int, name.split(".")[1:3]))
+            ]
+
+        self.assertSetEqual({(chunk.x, chunk.z) for chunk in chunks}, {(x, z) for x in range(-12, 12) for z in range(-12, 12)})
+        self.assertAlmostEqual(sum(not chunk.complete for chunk in chunks) / len(chunks), 0.25, delta=0.05)
+        self.assertTrue(all(1_700_000_000 <= chunk.timestamp <= 1_700_001_000 for chunk in chunks))
+        self.assertTrue(all(16 <= chunk.height <= 240 for chunk in chunks))
+
+    def test_chunk_digest(self):
+        def serialize(chunk):
+            data = io.BytesIO()
+            chunk.write_file(buffer=data)
+            return data.getvalue()
+
+        def digest(chunk):
+            return region_scan.ChunkReader(zlib.compress(serialize(chunk)), 2).scan_tags({"Status"})
+
+        for old_format in (False, True):
+            sections = {0: ["minecraft:stone"], 1: ["minecraft:air", "minecraft:dirt"]}
+            found, original = digest(make_chunk(3, 4, "full", old_format, last_update=100, sections=sections))
+            self.assertDictEqual(found, {"Status": "full"})
+            # Saving the chunk again rewrites its timestamps, heightmaps, light and ticks, but nothing that is rendered
+            self.assertEqual(digest(make_chunk(3, 4, "full", old_format, last_update=500, sections=sections))[1], original)
+            self.assertNotEqual(digest(make_chunk(3, 4, "full", old_format, last_update=100, block=1, sections=sections))[1], original)
+            self.assertNotEqual(digest(make_chunk(3, 4, "full", old_format, last_update=100, sections={0: ["minecraft:stone"]}))[1], original)
+            self.assertNotEqual(digest(make_chunk(3, 4, "noise", old_format, last_update=100, sections=sections))[1], original)
+
+            # Reading stops after the sections, the last of the tags that are hashed
+            data = serialize(make_chunk(3, 4, "full", old_format, last_update=100, sections=sections))
+            truncated = data[:data.index(b"TileTicks" if old_format else b"block_ticks")]
+            self.assertEqual(region_scan.ChunkReader(truncated, 3).scan_tags({"Status"})[1], original)
+
+    def test_chunk_height(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "r.0.0.mca")
+            open(path, "wb").close()
+            region_file = region.RegionFile(path)
+            region_file.write_chunk(0, 0, make_chunk(0, 0, "full", sections={-4: ["minecraft:stone"], 3: ["minecraft:air", "minecraft:grass_block"], 5: ["minecraft:air"]}))
+            region_file.write_chunk(1, 0, make_chunk(1, 0, "full", sections={-1: ["minecraft:cave_air"]}))
+            region_file.write_chunk(2, 0, make_chunk(2, 0, "full"))
+            region_file.close()
+
+            chunks = region_scan.scan_region(path, 0, 0)
+
+        self.assertDictEqual({chunk.x: chunk.height for chunk in chunks}, {0: 64, 1: 0, 2: None})
+
+    def test_content_modified(self):
+        con = sqlite3.connect(":memory:")
+        cur = con.cursor()
+        cur.execute(
+            "CREATE TABLE region_chunks (region_x, region_z, chunk_x, chunk_z, timestamp, complete, digest, height, content_modified, PRIMARY KEY (chunk_x, chunk_z))"
+        )
+        cur.execute("CREATE TABLE region_scans (region_x, region_z, mtime, size, PRIMARY KEY (region_x, region_z))")
+        cache = region_scan.RegionScanCache(cur)
+        stat = os.stat(__file__)
+
+        cache.put(0, 0, stat, [region_scan.ChunkScan(0, 0, 100, True, b"a"), region_scan.ChunkScan(1, 0, 100, True, b"b")])
+        chunks = cache.put(0, 0, stat, [region_scan.ChunkScan(0, 0, 200, True, b"a"), region_scan.ChunkScan(1, 0, 200, True, b"c")])
+        self.assertListEqual([chunk.content_modified for chunk in chunks], [100, 200])
+        self.assertListEqual(sorted(chunk.content_modified for chunk in cache.get(0, 0, stat)), [100, 200])
+
+        # Tearing a chunk down doesn't shrink it, so the tiles that showed its old blocks are rendered again
+        cache.put(0, 0, stat, [region_scan.ChunkScan(0, 0, 300, True, b"d", 256)])
+        chunks = cache.put(0, 0, stat, [region_scan.ChunkScan(0, 0, 400, True, b"e", 64)])
+        self.assertListEqual([(chunk.height, chunk.content_modified) for chunk in chunks], [(256, 400)])
+        self.assertListEqual([chunk.height for chunk in cache.get(0, 0, stat)], [256])
+
+
+class TestImage(unittest.TestCase):
+    def test_pooled_encoding(self):
+        rng = np.random.default_rng(3)
+        tiles = [rng.integers(0, 256, (16, 16, 4), dtype=np.uint8) for _ in range(6)]
+        with tempfile.TemporaryDirectory() as directory:
+            for handler_class in (image.PngImageHandler, image.WebpImageHandler):
+                pack_path = os.path.join(directory, f"tiles.{handler_class.file_extension}.pack")
+                pooled = handler_class(processes=2, store=tile_store.PackedTileStore(pack_path))
+                paths = [f"{directory}/tiles/zoom_0/{index}/0" for index in range(len(tiles))]
+                try:
+                    self.assertSetEqual(set(pooled.save_images(zip(tiles, paths))), set(paths))
+                    # The processes encode each tile to the bytes encoding it in-process gives
+                    for tile, path in zip(tiles, paths):
+                        self.assertEqual(pooled.store.read(path), handler_class().encode_image(tile))
+                finally:
+                    pooled.close()
+
+    def test_ffmpeg_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # An ffmpeg without libaom-av1
+            ffmpeg_path = os.path.join(directory, "ffmpeg")
+            with open(ffmpeg_path, "w") as f:
+                f.write("#!/bin/sh\necho \"Unknown encoder 'libaom-av1'\" >&2\nexit 8\n")
+            os.chmod(ffmpeg_path, 0o755)
+            handler = image.AvifImageHandler(20)
+            with mock.patch.dict(os.environ, {"PATH": directory + os.pathsep + os.environ["PATH"]}):
+                with self.assertRaisesRegex(RuntimeError, "code 8: Unknown encoder 'libaom-av1'"):
+                    handler.encode_image(np.zeros((4, 4, 4), dtype=np.uint8))
+                with self.assertRaisesRegex(RuntimeError, "code 8"):
+                    handler.decode_image(b"\0")
+
+    def test_rescan(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                config = Config(world_path=os.path.join(directory, "world"), scan_processes=1)
+                os.makedirs(os.path.join(config.world_path, "region"))
+                for region_x in (0, 1):
+                    path = render.get_region_path(config, region_x, 0)
+                    open(path, "wb").close()
+                    region_file = region.RegionFile(path)
+                    region_file.write_chunk(0, 0, make_chunk(region_x * 32, 0, "full"))
+                    region_file.close()
+                con = database.open_database(config)
+                cur = con.cursor()
+
+                def list_world_chunks():
+                    with mock.patch.object(render, "scan_region", wraps=region_scan.scan_region) as scan:
+                        chunks = render.list_world_chunks(config, cur)
+                    return {(chunk.x, chunk.z): chunk for chunk in chunks}, sorted(call.args[1:] for call in scan.call_args_list)
+
+                chunks, scanned = list_world_chunks()
+                self.assertListEqual(scanned, [(0, 0), (1, 0)])
+                self.assertEqual(list_world_chunks(), (chunks, []))
+
+                # Saving the chunk again without changing it only touches its volatile tags and timestamp
+                path = render.get_region_path(config, 1, 0)
+                region_file = region.RegionFile(path)
+                region_file.write_chunk(0, 0, make_chunk(32, 0, "full", last_update=500))
+                region_file.close()
+                with open(path, "r+b") as f:
+                    f.seek(region_scan.SECTOR_SIZE)
+                    f.write((chunks[(32, 0)].timestamp + 1000).to_bytes(4, "big"))
+                stat = os.stat(path)
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+                rescanned, scanned = list_world_chunks()
+                self.assertListEqual(scanned, [(1, 0)])
+                self.assertEqual(rescanned[(32, 0)].timestamp, chunks[(32, 0)].timestamp + 1000)
+                self.assertEqual(rescanned[(32, 0)].content_modified, chunks[(32, 0)].content_modified)
+                self.assertEqual(rescanned[(0, 0)], chunks[(0, 0)])
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+    def test_scan_regions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark.generate_world(directory, 34, 0.25, 1000)
+            regions = render.list_regions(Config(world_path=directory)) + [(5, 5)]
+            results = {}
+            for processes in (1, 2):
+                config = Config(world_path=directory, scan_processes=processes)
+                results[processes] = {
+                    (region_x, region_z): (sorted(chunks) if chunks is not None else None, type(error))
+                    for region_x, region_z, chunks, error in render.scan_regions(config, regions)
+                }
+
+        self.assertEqual(len(results[1]), 5)
+        # Errors are passed back along with the region instead of stopping the scan
+        self.assertEqual(results[1][(5, 5)], (None, FileNotFoundError))
+        self.assertEqual(sum(len(chunks) for chunks, _ in results[1].values() if chunks is not None), 34 * 34)
+        self.assertDictEqual(results[2], results[1])
+
+
+class TestTileStore(unittest.TestCase):
+    def test_stores(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tiles_path = os.path.join(directory, "tiles")
+            for store in (tile_store.DirectoryTileStore("png"), tile_store.PackedTileStore(os.path.join(directory, "tiles.pack"))):
+                store.write(f"{tiles_path}/zoom_0/-3/4", b"a")
+                store.write(f"{tiles_path}/zoom_-1/2/-1", b"b")
+                store.write(f"{tiles_path}/zoom_0/5/6", b"c")
+                store.remove(f"{tiles_path}/zoom_0/5/6")
+                store.flush()
+
+                self.assertEqual(store.read(f"{tiles_path}/zoom_0/-3/4"), b"a")
+                self.assertIsNone(store.read(f"{tiles_path}/zoom_0/5/6"))
+                self.assertTrue(store.exists(f"{tiles_path}/zoom_-1/2/-1"))
+                self.assertFalse(store.exists(f"{tiles_path}/zoom_-1/2/-2"))
+                self.assertSetEqual(set(store.list_tiles(tiles_path, 0)), {(-3, 4)})
+                self.assertSetEqual(set(store.list_tile_sizes(tiles_path, -1, workers=2)), {(2, -1, 1)})
+                store.close()
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_pfm(self):
+        rng = np.random.default_rng(10)
+        linear = rng.random((5, 7, 3), dtype=np.float32) * 1.5
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scene-50.pfm")
+            benchmark.write_pfm(path, linear)
+            pixels = snapshot.read_pfm(path)
+            self.assertIsInstance(pixels.base, np.memmap)
+            np.testing.assert_array_equal(pixels, linear)
+
+            config = Config(snapshot_format="pfm")
+            image = snapshot.read_snapshot(config, path, 1.0, "GAMMA")
+            expected = np.round(np.minimum(linear, 1) ** (1 / snapshot.GAMMA) * 255)
+            self.assertLessEqual(np.abs(image[..., :3].astype(np.int64) - expected).max(), 1)
+            self.assertTrue((image[..., 3] == 255).all())
+            image = snapshot.read_snapshot(config, path, 0.5, "NONE")
+            self.assertLessEqual(np.abs(image[..., :3].astype(np.int64) - np.round(np.minimum(linear * 0.5, 1) * 255)).max(), 1)
+            del pixels
+
+        snapshot.check_scene(config, {"postprocess": "GAMMA"})
+        with self.assertRaises(ValueError):
+            snapshot.check_scene(config, {"postprocess": "TONEMAP1"})
+        snapshot.check_scene(Config(), {"postprocess": "TONEMAP1"})
+
+    def test_png(self):
+        rgba = np.random.default_rng(11).integers(0, 256, (6, 4, 4), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scene-50.png")
+            Image.fromarray(rgba).save(path)
+            np.testing.assert_array_equal(snapshot.read_snapshot(Config(), path, 1.0, "GAMMA"), rgba)
+            Image.fromarray(rgba[..., :3]).save(path)
+            image = snapshot.read_snapshot(Config(), path, 1.0, "GAMMA")
+            np.testing.assert_array_equal(image[..., :3], rgba[..., :3])
+            self.assertTrue((image[..., 3] == 255).all())
+
+
+class TestSchedule(unittest.TestCase):
+    def test_z_order(self):
+        batches = [(x, y) for x in range(-4, 4) for y in range(-4, 4)]
+        random.Random(0).shuffle(batches)
+        ordered = schedule.order_batches(batches)
+        self.assertSetEqual(set(ordered), set(batches))
+        # Every aligned square of batches is rendered in one go
+        for size in (2, 4):
+            squares = [(x // size, y // size) for x, y in ordered]
+            self.assertEqual(sum(a != b for a, b in zip(squares, squares[1:])), 64 // size ** 2 - 1)
+
+    def test_cost_model(self):
+        rng = np.random.default_rng(0)
+        chunks = rng.integers(100, 1000, 50)
+        tiles = rng.integers(1, 16, 50)
+        spp = rng.choice([16, 50], 50)
+        loads_chunks = np.arange(50) % 2 == 0
+        # Loading the chunks costs far more per chunk than rendering from an octree
+        seconds = 5 + np.where(loads_chunks, 0.05, 0.01) * chunks + 0.5 * tiles + 0.2 * spp
+        model = schedule.CostModel(np.stack([chunks, tiles, spp, loads_chunks, seconds], axis=1))
+        np.testing.assert_allclose(model.predict([500, 200], 4, 50, [False, True]), [22, 27])
+        # With only loading runs on record, runs that reuse an octree are predicted from their fit
+        loading_model = schedule.CostModel(np.stack([chunks, tiles, spp, loads_chunks, seconds], axis=1)[loads_chunks])
+        np.testing.assert_allclose(loading_model.predict(500, 4, 50, [True, False]), [42, 42])
+        self.assertEqual(schedule.CostModel([]).predict(500, [4, 8], 50, True).tolist(), [1, 1])
+
+    def test_octree_batches(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                config = Config(tile_batch_size=4, tile_render_batch_size=2, samples_per_pixel=10)
+                con = database.open_database(config)
+                cur = con.cursor()
+                for index in range(2 * schedule.MIN_HISTORY):
+                    loads_chunks = index % 2 == 0
+                    schedule.record_timing(config, cur, 0, 0, 0, 0, 100 + index, 4, loads_chunks, 100 if loads_chunks else 10)
+                tiles_to_render = coord_index.CoordIndex(tile_math.get_tile_rect(0, 0, 7, 3))
+                chunk_counts = {(0, 0): 100, (1, 0): 100}
+
+                # Only the first run of each batch loads its chunks, and none of a batch whose octree is cached
+                octree_batches = {(1, 0)}
+                plan = schedule.plan_schedule(config, cur, [(1, 0), (0, 0)], tiles_to_render, chunk_counts, octree_batches)
+                self.assertListEqual(plan.batches, [(0, 0), (1, 0)])
+                np.testing.assert_allclose(plan.costs, [100 + 3 * 10, 4 * 10])
+                # A later preset renders both batches from the octrees this one builds
+                self.assertSetEqual(octree_batches, {(0, 0), (1, 0)})
+                plan = schedule.plan_schedule(config, cur, [(0, 0), (1, 0)], tiles_to_render, chunk_counts, octree_batches)
+                np.testing.assert_allclose(plan.costs, [4 * 10, 4 * 10])
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+    def test_eta(self):
+        plan = schedule.Schedule([(0, 0), (0, 1), (1, 0)], [10.0, 30.0, 20.0], True)
+        self.assertEqual(plan.get_eta(0, 0), 60)
+        # The first batch took twice as long as predicted, so the rest are expected to as well
+        self.assertEqual(plan.get_eta(1, 20), 100)
+        self.assertEqual(plan.get_eta(3, 120), 0)
+
+
+class TestOctreeCache(unittest.TestCase):
+    def test_key(self):
+        config = Config(world_path="/world")
+        scene = {"yClipMax": 320, "waterWorldEnabled": False, "sun": {"intensity": 1.0}}
+        key = octree_cache.get_octree_key(config, scene, [(0, 1), (2, 3)], {(0, 1): 10, (2, 3): 20})
+        self.assertEqual(key, octree_cache.get_octree_key(
+            dataclasses.replace(config, render_name="night", samples_per_pixel=8), {**scene, "sun": {"intensity": 0.1}}, [(2, 3), (0, 1)], {(0, 1): 10, (2, 3): 20}
+        ))
+        self.assertNotEqual(key, octree_cache.get_octree_key(config, scene, [(0, 1), (2, 3)], {(0, 1): 10, (2, 3): 21}))
+        self.assertNotEqual(key, octree_cache.get_octree_key(config, scene, [(0, 1)], {(0, 1): 10, (2, 3): 20}))
+        self.assertNotEqual(key, octree_cache.get_octree_key(config, {**scene, "yClipMax": 128}, [(0, 1), (2, 3)], {(0, 1): 10, (2, 3): 20}))
+        self.assertNotEqual(key, octree_cache.get_octree_key(config, {**scene, "waterWorldEnabled": True}, [(0, 1), (2, 3)], {(0, 1): 10, (2, 3): 20}))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = octree_cache.OctreeCache(os.path.join(directory, "cache"), 10)
+            scene_path = os.path.join(directory, "scene.octree2")
+            for key, data in (("a", b"123456"), ("b", b"7890")):
+                with open(scene_path, "wb") as f:
+                    f.write(data)
+                cache.store(key, scene_path)
+                os.remove(scene_path)
+
+            self.assertTrue(cache.fetch("a", scene_path))
+            with open(scene_path, "rb") as f:
+                self.assertEqual(f.read(), b"123456")
+            self.assertFalse(cache.fetch("c", scene_path))
+
+            # Storing a third octree goes over the limit and evicts b, which was used least recently
+            os.utime(cache.get_entry_path("b"), (0, 0))
+            with open(os.path.join(directory, "other.octree2"), "wb") as f:
+                f.write(b"x")
+            cache.store("c", os.path.join(directory, "other.octree2"))
+            self.assertListEqual(sorted(os.listdir(cache.cache_path)), ["a.octree2", "c.octree2"])
+            self.assertEqual(cache.keys(), {"a", "c"})
+            self.assertEqual(octree_cache.OctreeCache(os.path.join(directory, "missing"), 10).keys(), set())
+
+
+class TestConfig(unittest.TestCase):
+    def test_presets(self):
+        config = Config(presets=[
+            {"render_name": "day"},
+            {"render_name": "night", "samples_per_pixel": 200, "scene": {"sun": {"intensity": 0.1}}},
+        ])
+        day, night = config.get_presets()
+        self.assertEqual((day.render_name, day.samples_per_pixel, day.scene_overrides), ("day", 50, None))
+        self.assertEqual((night.render_name, night.samples_per_pixel, night.scene_overrides), ("night", 200, {"sun": {"intensity": 0.1}}))
+        self.assertEqual(tile_store.get_tiles_path(night), "chunky/scenes/scene_name/night/tiles")
+        self.assertEqual(tile_store.get_tiles_path(Config()), "chunky/scenes/scene_name/tiles")
+
+        with self.assertRaises(ValueError):
+            Config(presets=[{"render_name": "day"}, {"render_name": "day"}]).get_presets()
+        with self.assertRaises(ValueError):
+            Config(presets=[{"render_name": "day", "tile_pixel_size": 256}]).get_presets()
+        with self.assertRaises(ValueError):
+            Config(presets=[{"render_name": "day"}, {"render_name": "flood", "scene": {"waterWorldEnabled": True}}]).get_presets()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = metrics.Metrics()
+            recorder.configure(Config(
+                metrics_path=os.path.join(directory, "events.jsonl"),
+                prometheus_textfile=os.path.join(directory, "render.prom"),
+                profile_path=os.path.join(directory, "render.prof"),
+            ), "worker-1")
+            with recorder.span("batch", batch=[1, 2]):
+                with recorder.span("encode", tiles=3):
+                    recorder.count("tiles_written", 3)
+            recorder.close()
+
+            with open(os.path.join(directory, "events.jsonl")) as f:
+                events = [json.loads(line) for line in f]
+            self.assertListEqual([(event["event"], event.get("stage")) for event in events], [("span", "encode"), ("span", "batch"), ("totals", None)])
+            self.assertEqual(events[0]["tiles"], 3)
+            self.assertEqual(events[1]["instance"], "worker-1")
+            self.assertEqual(events[2]["counters"], {"tiles_written": 3})
+
+            with open(os.path.join(directory, "render-worker-1.prom")) as f:
+                prometheus = f.read()
+            self.assertIn('chunky_leaflet_stage_spans_total{stage="encode"} 1', prometheus)
+            self.assertIn("chunky_leaflet_tiles_written_total 3", prometheus)
+            self.assertTrue(os.path.isfile(os.path.join(directory, "render.prof")))
+
+    def test_profile_overlapping_threads(self):
+        # Like Chunky on the main thread while the pipeline thread processes the previous snapshot
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = metrics.Metrics()
+            recorder.configure(Config(profile_path=os.path.join(directory, "render.prof")))
+            entered = threading.Event()
+            errors = []
+
+            def move_image():
+                try:
+                    with recorder.span("move_image"):
+                        entered.set()
+                except Exception as e:
+                    errors.append(e)
+                    entered.set()
+
+            with recorder.span("chunky"):
+                thread = threading.Thread(target=move_image)
+                thread.start()
+                entered.wait()
+            thread.join()
+            recorder.close()
+
+            self.assertListEqual(errors, [])
+            self.assertTrue(os.path.isfile(os.path.join(directory, "render.prof")))
+
+
+class TestWatch(unittest.TestCase):
+    def test_region_watcher(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "region"))
+            region_path = os.path.join(directory, "region", "r.0.-1.mca")
+            with open(region_path, "wb") as f:
+                f.write(b"\0" * 8192)
+            watcher = watch.RegionWatcher(Config(world_path=directory, watch_settle_time=60))
+            try:
+                self.assertSetEqual(watcher.get_changes(block=False), set())
+                with open(region_path, "ab") as f:
+                    f.write(b"\0" * 4096)
+                # Not reported until it has gone unmodified for the settle time
+                self.assertSetEqual(watcher.get_changes(block=False), set())
+                os.utime(region_path, (0, 0))
+                self.assertSetEqual(watcher.get_changes(block=True), {(0, -1)})
+                self.assertSetEqual(watcher.get_changes(block=False), set())
+                os.remove(region_path)
+                self.assertSetEqual(watcher.get_changes(block=False), {(0, -1)})
+            finally:
+                watcher.close()
+
+    def test_batch_queue(self):
+        queue = watch.BatchQueue()
+        queue.push((0, 0), 10)
+        queue.push((1, 0), 30)
+        queue.push((2, 0), 20)
+        queue.push((0, 0), 40)
+        queue.push((1, 0), 5)
+        self.assertEqual(len(queue), 3)
+        self.assertListEqual([queue.pop() for _ in range(3)], [(0, 0), (1, 0), (2, 0)])
+        self.assertEqual(len(queue), 0)
+
+
+class TestRebuild(unittest.TestCase):
+    def test_only_stale(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                config = Config(tile_pixel_size=4, zoom_levels=2)
+                tiles_path = tile_store.get_tiles_path(config)
+                image_handler = image.PngImageHandler()
+                con = database.open_database(config)
+                cur = con.cursor()
+
+                def write_tile(x, y, colour, last_modified):
+                    image_handler.save_image(np.full((4, 4, 4), colour, dtype=np.uint8), f"{tiles_path}/zoom_0/{x}/{y}")
+                    database.record_tiles(cur, config.render_name, [(0, x, y, last_modified, 0)])
+                    con.commit()
+
+                def contains_colour(tile, colour):
+                    zoom, x, y = tile
+                    parent = image_handler.load_image(f"{tiles_path}/zoom_{zoom}/{x}/{y}")
+                    return bool(np.any(np.all(parent == colour, axis=-1)))
+
+                for x in range(4):
+                    for y in range(4):
+                        write_tile(x, y, (10, 20, 30, 255), 100)
+                rebuild.rebuild_pyramid(config, image_handler, processes=2)
+                self.assertListEqual(cur.execute(
+                    "SELECT zoom_level, COUNT(*), MAX(last_modified) FROM tiles GROUP BY zoom_level ORDER BY zoom_level"
+                ).fetchall(), [(-2, 1, 100), (-1, 4, 100), (0, 16, 100)])
+
+                write_tile(0, 0, (200, 0, 0, 255), 200)
+                # Removed to tell whether it is built again, which it isn't, as none of its children changed
+                image_handler.remove_image(f"{tiles_path}/zoom_-1/1/1")
+                rebuild.rebuild_pyramid(config, image_handler, only_stale=True, processes=2)
+
+                self.assertTrue(contains_colour((-1, 0, 0), (200, 0, 0, 255)))
+                self.assertTrue(contains_colour((-2, 0, 0), (200, 0, 0, 255)))
+                self.assertFalse(image_handler.image_exists(f"{tiles_path}/zoom_-1/1/1"))
+                self.assertDictEqual(dict(((zoom, x, y), last_modified) for zoom, x, y, last_modified in cur.execute(
+                    "SELECT zoom_level, x, y, last_modified FROM tiles WHERE zoom_level < 0"
+                )), {(-2, 0, 0): 200, (-1, 0, 0): 200, (-1, 1, 0): 100, (-1, 0, 1): 100, (-1, 1, 1): 100})
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+
+class TestDatabase(unittest.TestCase):
+    def test_journal(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                con = database.open_database(Config())
+                cur = con.cursor()
+                database.set_dirty_tiles(cur, "r", {(0, 1, 2), (0, 1, 3), (-1, 0, 1)})
+                database.record_tiles(cur, "r", [(0, 1, 2, 100, 0)])
+                # Nothing is committed until the caller commits
+                con.rollback()
+                self.assertSetEqual(database.get_dirty_tiles(cur, "r"), {(0, 1, 2), (0, 1, 3), (-1, 0, 1)})
+
+                database.record_tiles(cur, "r", [(0, 1, 2, 100, 0), (0, 1, 3, 200, 1)])
+                con.commit()
+                self.assertSetEqual(database.get_dirty_tiles(cur, "r"), {(-1, 0, 1)})
+                self.assertListEqual(cur.execute("SELECT y, last_modified, empty FROM tiles ORDER BY y").fetchall(), [(2, 100, 0), (3, 200, 1)])
+                self.assertEqual(cur.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+                con.close()
+
+                # A farm across machines switches an existing tiles.db back to the rollback journal
+                con = database.open_database(Config(journal_mode="DELETE"))
+                self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+                con.close()
+                with self.assertRaises(ValueError):
+                    database.open_database(Config(journal_mode="MEMORY; DROP TABLE tiles"))
+            finally:
+                os.chdir(cwd)
+
+
+def submit_in_thread(post: pipeline.PostProcessPipeline, fn, *args, **kwargs) -> threading.Event:
+    """
+    Submits the job from another thread, and returns an event set once submit has returned.
+    """
+    submitted = threading.Event()
+    threading.Thread(target=lambda: (post.submit(fn, *args, **kwargs), submitted.set()), daemon=True).start()
+    return submitted
+
+
+class TestPipeline(unittest.TestCase):
+    def test_queue_size(self):
+        release = threading.Event()
+        done = []
+        with pipeline.PostProcessPipeline(2) as post:
+            post.submit(release.wait)
+            post.submit(done.append, 1)
+            # Both slots are taken, so the next snapshot waits, while a job without one goes ahead
+            self.assertTrue(submit_in_thread(post, done.append, "timing", takes_slot=False).wait(5))
+            submitted = submit_in_thread(post, done.append, 2)
+            self.assertFalse(submitted.wait(0.2))
+            release.set()
+            self.assertTrue(submitted.wait(5))
+        # Jobs run in the order they were submitted
+        self.assertListEqual(done, [1, "timing", 2])
+
+    def test_errors(self):
+        def fail():
+            raise ValueError("Broken snapshot")
+
+        done = []
+        with self.assertRaisesRegex(ValueError, "Broken snapshot"):
+            with pipeline.PostProcessPipeline(1) as post:
+                post.submit(fail)
+                # Waits for the slot of the failed job and raises its error instead of queueing another
+                post.submit(done.append, 1)
+        self.assertListEqual(done, [])
+
+        with self.assertRaisesRegex(ValueError, "Broken snapshot"):
+            with pipeline.PostProcessPipeline(2) as post:
+                post.submit(fail)
+                post.wait()
+
+        with self.assertRaisesRegex(ValueError, "Broken snapshot"):
+            pipeline.PostProcessPipeline(0).submit(fail)
+
+
+class TestRender(unittest.TestCase):
+    def test_overlapping_batches(self):
+        cwd = os.getcwd()
+        repo_path = os.path.dirname(os.path.abspath(__file__))
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name in ("default_settings.json", "index.template.html"):
+                shutil.copyfile(os.path.join(repo_path, file_name), os.path.join(directory, file_name))
+            os.chdir(directory)
+            try:
+                config = Config(
+                    world_path=os.path.join(directory, "world"), tile_pixel_size=16, tile_batch_size=2, tile_render_batch_size=1,
+                    zoom_levels=2, scan_processes=1, postprocess_queue_size=8
+                )
+                benchmark.generate_world(config.world_path, 8, 0, 0)
+                move_image = render.move_image
+
+                def slow_move_image(*args):
+                    # Lets Chunky render the sub-batches of the next batch before this one's are processed
+                    time.sleep(0.02)
+                    move_image(*args)
+
+                image_handler = image.PngImageHandler()
+                with mock.patch.object(render, "run_chunky", benchmark.stand_in_chunky), \
+                        mock.patch.object(render, "move_image", slow_move_image):
+                    render.render(config, image_handler)
+
+                con = database.open_database(config)
+                planned = render.plan_render(config, con.cursor(), dry_run=True)
+                self.assertEqual(len(planned.tiles_to_render), 0)
+                self.assertSetEqual(database.get_dirty_tiles(con.cursor(), config.render_name), set())
+                self.assertListEqual(os.listdir("chunky/scenes/scene_name/snapshots"), [])
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+
+class TestFarm(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        # Queued batches carry their octree key, which is made from default_settings.json in the working directory
+        shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), "default_settings.json"),
+                        os.path.join(self.directory.name, "default_settings.json"))
+        os.chdir(self.directory.name)
+        self.config = Config(world_path="/world", tile_batch_size=4, tile_padding_top=1, lease_duration=60)
+        self.con = database.open_database(self.config)
+        chunks = tile_math.get_tile_rect(0, 0, 7, 7)
+        padding_top = tile_math.get_chunk_padding_top(self.config, [None] * len(chunks))
+        tiles = tile_math.get_tiles_for_chunks(self.config, chunks, padding_top)
+        tiles_to_render = coord_index.CoordIndex(tiles)
+        self.plan = render.RenderPlan(
+            coord_index.CoordIndex(chunks, padding_top),
+            coord_index.CoordIndex(chunks, np.full(len(chunks), 100)),
+            coord_index.CoordIndex(tiles, np.full(len(tiles), 100)),
+            tiles_to_render,
+            render.get_zoom_tiles_to_render(tiles_to_render, 1),
+            sorted(render.tiles_to_batches(self.config, tiles_to_render)),
+            None
+        )
+        farm.enqueue_batches(self.config, self.con.cursor(), self.plan)
+
+    def tearDown(self):
+        self.con.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_lease(self):
+        other = database.open_database(self.config)
+        leased = []
+        while True:
+            jobs = [farm.lease_batch(self.config, self.con, "a"), farm.lease_batch(self.config, other, "b")]
+            leased += [job[:2] for job in jobs if job is not None]
+            if None in jobs:
+                break
+        other.close()
+        # Every batch is handed out once, to one of the workers
+        self.assertListEqual(sorted(leased), self.plan.batches)
+        self.assertIsNone(farm.lease_batch(self.config, self.con, "a"))
+        self.assertEqual(farm.count_leased_batches(self.config, self.con.cursor()), len(self.plan.batches))
+
+    def test_expired_lease(self):
+        cur = self.con.cursor()
+        batch_x, batch_y, payload = farm.lease_batch(self.config, self.con, "a")
+        self.assertGreater(len(payload["tiles"]), 0)
+        cur.execute("UPDATE batches SET lease_expires = ? WHERE batch_x = ? AND batch_y = ?", (time.time() - 1, batch_x, batch_y))
+        self.con.commit()
+        self.assertTupleEqual(farm.lease_batch(self.config, self.con, "b")[:2], (batch_x, batch_y))
+
+        # a lost the batch to b, so its late completion doesn't count
+        unfinished = farm.count_unfinished_batches(self.config, cur)
+        farm.complete_batch(self.config, cur, "a", batch_x, batch_y)
+        self.assertEqual(farm.count_unfinished_batches(self.config, cur), unfinished)
+        self.assertTupleEqual(cur.execute(
+            "SELECT status, worker FROM batches WHERE batch_x = ? AND batch_y = ?", (batch_x, batch_y)
+        ).fetchone(), ("leased", "b"))
+        farm.complete_batch(self.config, cur, "b", batch_x, batch_y)
+        self.assertEqual(farm.count_unfinished_batches(self.config, cur), unfinished - 1)
+
+    def test_heartbeat(self):
+        config = dataclasses.replace(self.config, lease_duration=0.4)
+        batch_x, batch_y, _ = farm.lease_batch(config, self.con, "a")
+        with farm.LeaseHeartbeat(config, "a", batch_x, batch_y):
+            # The lease would have expired without the heartbeat extending it
+            time.sleep(1)
+            self.assertEqual(farm.count_leased_batches(config, self.con.cursor()), 1)
+
+    def test_enqueue_keeps_live_leases(self):
+        cur = self.con.cursor()
+        live = farm.lease_batch(self.config, self.con, "a")[:2]
+        expired = farm.lease_batch(self.config, self.con, "b")[:2]
+        cur.execute("UPDATE batches SET lease_expires = ? WHERE batch_x = ? AND batch_y = ?", (time.time() - 1, *expired))
+        self.con.commit()
+
+        farm.enqueue_batches(self.config, cur, self.plan)
+        statuses = {(x, y): (status, worker) for x, y, status, worker in cur.execute("SELECT batch_x, batch_y, status, worker FROM batches")}
+        self.assertListEqual(sorted(statuses), self.plan.batches)
+        self.assertTupleEqual(statuses[live], ("leased", "a"))
+        self.assertTupleEqual(statuses[expired], ("pending", None))
+        self.assertEqual(sum(status == "pending" for status, _ in statuses.values()), len(self.plan.batches) - 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,16 +1,91 @@
-import math
+import dataclasses
 
-from config import Config
+import numpy as np
+
+from config import Config, TILE_ROW_HEIGHT
+
+# Offsets from a tile's center chunk to the chunks that are visible in it at the y=0 plane
+TILE_CHUNK_OFFSETS = np.array([
+    (-2, -1),
+    (-1, -2),
+    (-1, -1),
+    (-1, 0),
+    (0, -1),
+    (0, 0),
+    (0, 1),
+    (1, 0),
+], dtype=np.int64)
+
+COORD_OFFSET = 1 << 31
+
+# Number of coordinates processed at once, to bound the size of intermediate arrays
+BLOCK_SIZE = 1 << 18
+
+
+def to_coord_array(coords) -> np.ndarray:
+    return np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+
+
+def pack_coords(coords: np.ndarray) -> np.ndarray:
+    """
+    Packs (x, y) pairs into single 64-bit keys that sort in the same order as the pairs.
+    """
+    coords = to_coord_array(coords)
+    return ((coords[:, 0] + COORD_OFFSET).astype(np.uint64) << np.uint64(32)) | (coords[:, 1] + COORD_OFFSET).astype(np.uint64)
+
+
+def unpack_coords(keys: np.ndarray) -> np.ndarray:
+    keys = np.asarray(keys, dtype=np.uint64)
+    coords = np.empty((len(keys), 2), dtype=np.int64)
+    coords[:, 0] = (keys >> np.uint64(32)).astype(np.int64) - COORD_OFFSET
+    coords[:, 1] = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64) - COORD_OFFSET
+    return coords
+
+
+def unique_coords(coords) -> np.ndarray:
+    """
+    Removes duplicate (x, y) pairs. The result is sorted by x and then y, like sorted() on a list of tuples.
+    """
+    return unpack_coords(np.unique(pack_coords(coords)))
+
+
+def to_tuples(coords: np.ndarray) -> list[tuple[int, int]]:
+    return [(x, y) for x, y in coords.tolist()]
+
+
+def get_z_order(coords) -> np.ndarray:
+    """
+    Returns the Morton key of each (x, y) pair. Sorting by it walks a Z-order curve, which finishes each aligned
+    2^n by 2^n square before moving on to the next, like the quadtree of zoom tiles does.
+    """
+    # Offsetting by a power of two keeps the squares aligned for negative coordinates
+    coords = (to_coord_array(coords) + COORD_OFFSET).astype(np.uint64)
+    keys = np.zeros(len(coords), dtype=np.uint64)
+    for bit in range(32):
+        bit = np.uint64(bit)
+        keys |= ((coords[:, 0] >> bit) & np.uint64(1)) << (np.uint64(2) * bit + np.uint64(1))
+        keys |= ((coords[:, 1] >> bit) & np.uint64(1)) << (np.uint64(2) * bit)
+    return keys
+
+
+def get_tile_for_chunks(config: Config, chunks) -> np.ndarray:
+    """
+    Returns the top-left-most (lowest x/y) tile each chunk is in at the y=0 plane.
+    """
+    chunks = to_coord_array(chunks)
+    chunk_sum = chunks[:, 0] + chunks[:, 1]
+    tiles = np.empty_like(chunks)
+    tiles[:, 0] = chunks[:, 0] + (-chunk_sum) // 2
+    tiles[:, 1] = (chunk_sum + 2) // 4
+    return tiles
 
 
 def get_tile_for_chunk(config: Config, chunk_x, chunk_z):
     """
     Returns top-left-most (lowest x/y) tile the chunk is in at the y=0 plane.
     """
-    tile_x = chunk_x - (chunk_z + chunk_x) / 2
-    tile_y = (chunk_z + chunk_x) / 4 + 0.5
-
-    return math.floor(tile_x), math.floor(tile_y)
+    tile_x, tile_y = get_tile_for_chunks(config, (chunk_x, chunk_z))[0].tolist()
+    return tile_x, tile_y
 
 
 def get_camera_pos_of_tile(config: Config, tile_x, tile_y):
@@ -19,58 +94,259 @@ def get_camera_pos_of_tile(config: Config, tile_x, tile_y):
     return center_x * 16.0, 0.0, center_y * 16.0
 
 
+def get_chunks_for_tiles(config: Config, tiles) -> np.ndarray:
+    """
+    Returns the unique chunks that are visible in any of the tiles at the y=0 plane.
+    """
+    tiles = to_coord_array(tiles)
+    keys = []
+    for start in range(0, len(tiles), BLOCK_SIZE):
+        block = tiles[start:start + BLOCK_SIZE]
+        centers = np.stack([block[:, 0] + 2 * block[:, 1], -block[:, 0] + 2 * block[:, 1]], axis=1)
+        chunks = (centers[:, None, :] + TILE_CHUNK_OFFSETS[None, :, :]).reshape(-1, 2)
+        keys.append(np.unique(pack_coords(chunks)))
+    if len(keys) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    return unpack_coords(np.unique(np.concatenate(keys)))
+
+
 def get_chunks_for_tile(config: Config, tile_x: int, tile_y: int):
     """
     Returns the set of chunks that are visible in the tile at the y=0 plane.
     """
-    center_x = tile_x + 2 * tile_y
-    center_y = -tile_x + 2 * tile_y
+    return set(to_tuples(get_chunks_for_tiles(config, (tile_x, tile_y))))
 
-    return {
-        (center_x-2, center_y-1),
-        (center_x-1, center_y-2),
-        (center_x-1, center_y-1),
-        (center_x-1, center_y),
-        (center_x, center_y-1),
-        (center_x, center_y),
-        (center_x, center_y+1),
-        (center_x+1, center_y),
-    }
+
+def get_chunk_padding_top(config: Config, heights) -> np.ndarray:
+    """
+    Returns the number of rows of tiles above its own that each chunk can be seen in, given the height of its
+    highest block. Chunks whose height is None are given config.tile_padding_top.
+    """
+    heights = np.array([np.nan if height is None else height for height in heights], dtype=np.float64)
+    padding_top = np.ceil(np.maximum(heights, 0) / TILE_ROW_HEIGHT)
+    padding_top[np.isnan(padding_top)] = config.tile_padding_top
+    return np.minimum(padding_top, config.tile_padding_top).astype(np.int64)
+
+
+def group_by_padding_top(config: Config, padding_top):
+    """
+    Splits chunks by their top padding. Yields a copy of the config with tile_padding_top set to each padding
+    and the indices of the chunks with that padding.
+    """
+    padding_top = np.asarray(padding_top, dtype=np.int64).reshape(-1)
+    for padding in np.unique(padding_top).tolist():
+        yield dataclasses.replace(config, tile_padding_top=padding), np.flatnonzero(padding_top == padding)
+
+
+def get_tiles_for_chunks(config: Config, chunks, padding_top=None) -> np.ndarray:
+    """
+    Returns the unique tiles that any of the chunks are visible in. padding_top optionally gives each chunk its
+    own top padding instead of config.tile_padding_top.
+    """
+    chunks = to_coord_array(chunks)
+    if padding_top is not None:
+        tiles = [get_tiles_for_chunks(group_config, chunks[indices]) for group_config, indices in group_by_padding_top(config, padding_top)]
+        return unique_coords(np.concatenate([np.empty((0, 2), dtype=np.int64)] + tiles))
+    row_offsets = np.arange(-config.tile_padding_top, config.tile_padding_bottom + 1, dtype=np.int64)
+    keys = []
+    for start in range(0, len(chunks), BLOCK_SIZE):
+        block = chunks[start:start + BLOCK_SIZE]
+        base_tiles = get_tile_for_chunks(config, block)
+        # Chunks on odd diagonals straddle two columns of tiles
+        for column, columns_block in ((0, base_tiles), (1, base_tiles[(block[:, 0] + block[:, 1]) % 2 == 1])):
+            tile_x = np.repeat(columns_block[:, 0] + column, len(row_offsets))
+            tile_y = (columns_block[:, 1][:, None] + row_offsets[None, :]).reshape(-1)
+            keys.append(np.unique(pack_coords(np.stack([tile_x, tile_y], axis=1))))
+    if len(keys) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    return unpack_coords(np.unique(np.concatenate(keys)))
 
 
 def get_tiles_for_chunk(config: Config, chunk_x: int, chunk_z: int) -> set[tuple[int, int]]:
     """
     Returns the set of tiles that the chunk is visible in.
     """
-    base_tile_x, base_tile_y = get_tile_for_chunk(config, chunk_x, chunk_z)
-    width = 2 if (chunk_x + chunk_z) % 2 == 1 else 1
+    return set(to_tuples(get_tiles_for_chunks(config, (chunk_x, chunk_z))))
 
-    base_tile_y -= config.tile_padding_top
-    height = config.tile_padding_top + config.tile_padding_bottom + 1
 
-    tile_set = set()
+def get_center_tiles(chunks) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the tiles each chunk is visible in at the y=0 plane, by the tiles' center chunks, found by inverting
+    TILE_CHUNK_OFFSETS, along with the index of the chunk of each tile. A tile's center chunk (x, z) always has
+    x + z divisible by 4.
+    """
+    chunks = to_coord_array(chunks)
+    tiles = []
+    indices = []
+    for offset in TILE_CHUNK_OFFSETS:
+        centers = chunks - offset
+        center_sum = centers[:, 0] + centers[:, 1]
+        valid = np.flatnonzero(center_sum % 4 == 0)
+        tiles.append(np.stack([(centers[valid, 0] - centers[valid, 1]) // 2, center_sum[valid] // 4], axis=1))
+        indices.append(valid)
+    return np.concatenate(tiles), np.concatenate(indices)
 
-    for x in range(base_tile_x, base_tile_x + width):
-        for y in range(base_tile_y, base_tile_y + height):
-            tile_set.add((x, y))
 
-    return tile_set
+def get_tiles_depending_on_chunks(config: Config, chunks, padding_top=None) -> np.ndarray:
+    """
+    Returns the unique tiles whose chunk lists, from get_chunklist_for_tile, include any of the chunks. These are
+    the tiles whose get_tile_last_modified can change with the chunks. padding_top is as in get_tiles_for_chunks.
+    """
+    chunks = to_coord_array(chunks)
+    if padding_top is not None:
+        tiles = [get_tiles_depending_on_chunks(group_config, chunks[indices]) for group_config, indices in group_by_padding_top(config, padding_top)]
+        return unique_coords(np.concatenate([np.empty((0, 2), dtype=np.int64)] + tiles))
+    # The chunk bounds of a tile, turned around
+    border = config.tile_border_size
+    offsets = get_tile_rect(-border, -border - config.tile_padding_bottom, border, border + config.tile_padding_top)
+    center_tiles = unique_coords(get_center_tiles(chunks)[0])
+    return unique_coords((center_tiles[:, None, :] + offsets[None, :, :]).reshape(-1, 2))
+
+
+def get_chunks_for_tile_chunklists(config: Config, tiles) -> np.ndarray:
+    """
+    Returns the unique chunks in the chunk lists, from get_chunklist_for_tile, of any of the tiles. These are the
+    chunks get_tile_last_modified needs for the tiles, whatever top padding each chunk has up to config's.
+    """
+    tiles = to_coord_array(tiles)
+    border = config.tile_border_size
+    offsets = get_tile_rect(-border, -border - config.tile_padding_top, border, border + config.tile_padding_bottom)
+    return get_chunks_for_tiles(config, unique_coords((tiles[:, None, :] + offsets[None, :, :]).reshape(-1, 2)))
+
+
+def get_tile_rect(min_x, min_y, max_x, max_y) -> np.ndarray:
+    """
+    Returns all tiles in the rectangle, bounds included.
+    """
+    xs, ys = np.meshgrid(np.arange(min_x, max_x + 1, dtype=np.int64), np.arange(min_y, max_y + 1, dtype=np.int64), indexing="ij")
+    return np.stack([xs.reshape(-1), ys.reshape(-1)], axis=1)
+
+
+def get_tile_chunk_bounds(config: Config, tile_x, tile_z):
+    """
+    Returns the rectangle of tiles (min_x, min_y, max_x, max_y) whose chunks are loaded to render the tile.
+    """
+    return (
+        tile_x - config.tile_border_size,
+        tile_z - config.tile_border_size - config.tile_padding_top,
+        tile_x + config.tile_border_size,
+        tile_z + config.tile_border_size + config.tile_padding_bottom,
+    )
 
 
 def get_chunkset_for_tile(config: Config, tile_x, tile_z):
-    base_x = tile_x - config.tile_border_size
-    base_z = tile_z - config.tile_border_size - config.tile_padding_top
+    return set(to_tuples(get_chunks_for_tiles(config, get_tile_rect(*get_tile_chunk_bounds(config, tile_x, tile_z)))))
+
+
+def get_chunklist_for_tile(config: Config, tile_x, tile_z):
+    return to_tuples(get_chunks_for_tiles(config, get_tile_rect(*get_tile_chunk_bounds(config, tile_x, tile_z))))
+
 
-    width = config.tile_border_size * 2 + 1
+def get_batch_bounds(config: Config, batch_x, batch_y):
+    """
+    Returns the rectangle of tiles (min_x, min_y, max_x, max_y) whose chunks are loaded to render the batch. This
+    is the union of the chunk bounds of every tile in the batch, its border and padding.
+    """
+    base_x = batch_x * config.tile_batch_size - config.tile_border_size
+    base_y = batch_y * config.tile_batch_size - config.tile_border_size - config.tile_padding_top
+
+    width = config.tile_batch_size + config.tile_border_size * 2 + 1
     height = width + config.tile_padding_top + config.tile_padding_bottom
 
-    chunkset = set()
+    min_x, min_y, _, _ = get_tile_chunk_bounds(config, base_x, base_y)
+    _, _, max_x, max_y = get_tile_chunk_bounds(config, base_x + width - 1, base_y + height - 1)
+    return min_x, min_y, max_x, max_y
 
-    for i in range(width):
-        for j in range(height):
-            chunkset = chunkset.union(get_chunks_for_tile(config, base_x+i, base_z+j))
-    return chunkset
 
+def get_chunks_for_batch(config: Config, batch_x, batch_y) -> np.ndarray:
+    """
+    Returns the sorted chunks that are loaded to render the batch.
+    """
+    return get_chunks_for_tiles(config, get_tile_rect(*get_batch_bounds(config, batch_x, batch_y)))
 
-def get_chunklist_for_tile(config: Config, tile_x, tile_z):
-    return sorted(list(get_chunkset_for_tile(config, tile_x, tile_z)))
+
+def get_chunklist_for_batch(config: Config, batch_x, batch_y):
+    return to_tuples(get_chunks_for_batch(config, batch_x, batch_y))
+
+
+def filter_chunks_for_batch(config: Config, batch_x, batch_y, chunks, padding_top) -> np.ndarray:
+    """
+    Returns the chunks, out of the given ones, that are loaded to render the batch when each chunk has its own
+    top padding.
+    """
+    chunks = to_coord_array(chunks)
+    keep = np.zeros(len(chunks), dtype=bool)
+    for group_config, indices in group_by_padding_top(config, padding_top):
+        keep[indices] = np.isin(pack_coords(chunks[indices]), pack_coords(get_chunks_for_batch(group_config, batch_x, batch_y)))
+    return chunks[keep]
+
+
+def get_tile_last_modified(config: Config, chunks, timestamps, tiles, padding_top=None, max_cells: int = 1 << 22) -> np.ndarray:
+    """
+    Returns, for each tile, the latest timestamp of the chunks in get_chunklist_for_tile, or 0 if there are none.
+    padding_top optionally gives each chunk its own top padding, as in get_tiles_for_chunks.
+
+    Chunk timestamps are first rasterized into a grid over tile space holding the latest timestamp of the chunks
+    visible in each tile. Since the chunks of a tile's chunk list are the chunks of a rectangle of tiles around
+    it, the result is then a sliding window max over that grid, done one axis at a time. The grid is processed
+    in stripes of rows of at most max_cells cells.
+    """
+    tiles = to_coord_array(tiles)
+    chunks = to_coord_array(chunks)
+    timestamps = np.asarray(timestamps, dtype=np.int64).reshape(-1)
+    result = np.zeros(len(tiles), dtype=np.int64)
+    if len(tiles) == 0 or len(chunks) == 0:
+        return result
+
+    if padding_top is not None:
+        for group_config, indices in group_by_padding_top(config, padding_top):
+            group_result = get_tile_last_modified(group_config, chunks[indices], timestamps[indices], tiles, max_cells=max_cells)
+            np.maximum(result, group_result, out=result)
+        return result
+
+    # The tiles each chunk is visible in
+    entries, entry_chunks = get_center_tiles(chunks)
+    order = np.argsort(entries[:, 1], kind="stable")
+    entry_y = entries[order, 1]
+    entry_x = entries[order, 0]
+    entry_timestamps = timestamps[entry_chunks[order]]
+
+    window_x = config.tile_border_size
+    window_above = config.tile_border_size + config.tile_padding_top
+    window_below = config.tile_border_size + config.tile_padding_bottom
+
+    min_x = int(tiles[:, 0].min())
+    max_x = int(tiles[:, 0].max())
+    grid_min_x = min_x - window_x
+    grid_width = max_x - min_x + 1 + 2 * window_x
+
+    tile_order = np.argsort(tiles[:, 1], kind="stable")
+    sorted_tile_y = tiles[tile_order, 1]
+    stripe_height = max(1, max_cells // grid_width - window_above - window_below)
+
+    y = int(sorted_tile_y[0])
+    while y <= sorted_tile_y[-1]:
+        tile_start, tile_end = np.searchsorted(sorted_tile_y, [y, y + stripe_height])
+        if tile_start == tile_end:
+            y = int(sorted_tile_y[tile_start])
+            continue
+
+        rows = min(stripe_height, int(sorted_tile_y[-1]) - y + 1)
+        grid_min_y = y - window_above
+        grid_height = rows + window_above + window_below
+        entry_start, entry_end = np.searchsorted(entry_y, [grid_min_y, grid_min_y + grid_height])
+        stripe_x = entry_x[entry_start:entry_end] - grid_min_x
+        stripe_y = entry_y[entry_start:entry_end] - grid_min_y
+        inside = (stripe_x >= 0) & (stripe_x < grid_width)
+
+        grid = np.zeros((grid_height, grid_width), dtype=np.int64)
+        np.maximum.at(grid, (stripe_y[inside], stripe_x[inside]), entry_timestamps[entry_start:entry_end][inside])
+
+        grid = np.lib.stride_tricks.sliding_window_view(grid, window_above + window_below + 1, axis=0).max(axis=-1)
+        grid = np.lib.stride_tricks.sliding_window_view(grid, 2 * window_x + 1, axis=1).max(axis=-1)
+
+        stripe_tiles = tile_order[tile_start:tile_end]
+        result[stripe_tiles] = grid[tiles[stripe_tiles, 1] - y, tiles[stripe_tiles, 0] - min_x]
+        y += stripe_height
+
+    return result
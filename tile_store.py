@@ -0,0 +1,227 @@
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from config import Config
+from database import set_journal_mode
+
+TILE_PATH_PATTERN = re.compile(r"zoom_(-?\d+)/(-?\d+)/(-?\d+)$")
+
+
+def parse_tile_path(path: str) -> tuple[int, int, int]:
+    """
+    Returns the (zoom, x, y) of a tile path ending in zoom_<z>/<x>/<y>.
+    """
+    match = TILE_PATH_PATTERN.search(path.replace(os.sep, "/"))
+    if match is None:
+        raise ValueError(f"Not a tile path: {path}")
+    return int(match[1]), int(match[2]), int(match[3])
+
+
+class TileStore:
+    """
+    Stores encoded tiles. Tiles are addressed by their path without the file extension, which ends in
+    zoom_<z>/<x>/<y>. Writes and removals may be buffered until flush is called.
+    """
+    def write(self, path: str, data: bytes):
+        raise NotImplementedError
+
+    def read(self, path: str) -> Optional[bytes]:
+        """
+        Returns the encoded tile, or None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def exists(self, path: str) -> bool:
+        raise NotImplementedError
+
+    def remove(self, path: str):
+        """
+        Removes the tile if it exists.
+        """
+        raise NotImplementedError
+
+    def list_tiles(self, tiles_path: str, zoom: int) -> Iterator[tuple[int, int]]:
+        """
+        Yields the (x, y) of every tile stored at the zoom level under tiles_path.
+        """
+        raise NotImplementedError
+
+    def list_tile_sizes(self, tiles_path: str, zoom: int, workers: int = 1) -> Iterator[tuple[int, int, int]]:
+        """
+        Yields the (x, y, size in bytes) of every tile stored at the zoom level under tiles_path, listing with up to
+        workers threads.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DirectoryTileStore(TileStore):
+    """
+    Stores each tile as its own file, <y>.<extension> in the directory zoom_<z>/<x>.
+    """
+    def __init__(self, file_extension: str):
+        self.file_extension = file_extension
+
+    def get_file_path(self, path: str):
+        return f"{path}.{self.file_extension}"
+
+    def write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(self.get_file_path(path), "wb") as f:
+            f.write(data)
+
+    def read(self, path: str) -> Optional[bytes]:
+        try:
+            with open(self.get_file_path(path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, path: str) -> bool:
+        return os.path.isfile(self.get_file_path(path))
+
+    def remove(self, path: str):
+        if self.exists(path):
+            os.remove(self.get_file_path(path))
+
+    def list_tiles(self, tiles_path: str, zoom: int) -> Iterator[tuple[int, int]]:
+        zoom_path = f"{tiles_path}/zoom_{zoom}"
+        if not os.path.isdir(zoom_path):
+            return
+        suffix = f".{self.file_extension}"
+        for x_entry in os.scandir(zoom_path):
+            if not x_entry.is_dir():
+                continue
+            for y_entry in os.scandir(x_entry.path):
+                if y_entry.name.endswith(suffix):
+                    yield int(x_entry.name), int(y_entry.name[:-len(suffix)])
+
+    def list_column_sizes(self, x_path: str) -> list[tuple[int, int, int]]:
+        suffix = f".{self.file_extension}"
+        x = int(os.path.basename(x_path))
+        return [
+            (x, int(y_entry.name[:-len(suffix)]), y_entry.stat().st_size)
+            for y_entry in os.scandir(x_path) if y_entry.name.endswith(suffix) and y_entry.is_file()
+        ]
+
+    def list_tile_sizes(self, tiles_path: str, zoom: int, workers: int = 1) -> Iterator[tuple[int, int, int]]:
+        zoom_path = f"{tiles_path}/zoom_{zoom}"
+        if not os.path.isdir(zoom_path):
+            return
+        x_paths = [x_entry.path for x_entry in os.scandir(zoom_path) if x_entry.is_dir()]
+        # Listing is bound by file system latency, which threads overlap well on network mounts
+        with ThreadPoolExecutor(workers) as pool:
+            for column in pool.map(self.list_column_sizes, x_paths):
+                yield from column
+
+
+class PackedTileStore(TileStore):
+    """
+    Stores all tiles as blobs in one SQLite file, keyed by (zoom_level, x, y) like MBTiles. Writes are committed
+    on flush. The connection is shared between threads behind a lock, and each process opens its own.
+    """
+    def __init__(self, pack_path: str, journal_mode: str = "WAL"):
+        self.pack_path = pack_path
+        self.journal_mode = journal_mode
+        self.lock = threading.Lock()
+        self.con = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.con is None:
+            os.makedirs(os.path.dirname(self.pack_path) or ".", exist_ok=True)
+            self.con = sqlite3.connect(self.pack_path, timeout=60, check_same_thread=False)
+            # WAL lets the encoder and pyramid processes read while tiles are being written
+            set_journal_mode(self.con, self.journal_mode)
+            self.con.execute("""
+                CREATE TABLE IF NOT EXISTS tile_data (
+                    zoom_level INTEGER NOT NULL,
+                    x INTEGER NOT NULL,
+                    y INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (zoom_level, x, y)
+                )
+            """)
+            self.con.commit()
+        return self.con
+
+    def write(self, path: str, data: bytes):
+        with self.lock:
+            self.connect().execute("INSERT OR REPLACE INTO tile_data (zoom_level, x, y, data) VALUES (?, ?, ?, ?)", (*parse_tile_path(path), data))
+
+    def read(self, path: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT data FROM tile_data WHERE zoom_level = ? AND x = ? AND y = ?", parse_tile_path(path)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def exists(self, path: str) -> bool:
+        with self.lock:
+            return self.connect().execute(
+                "SELECT 1 FROM tile_data WHERE zoom_level = ? AND x = ? AND y = ?", parse_tile_path(path)
+            ).fetchone() is not None
+
+    def remove(self, path: str):
+        with self.lock:
+            self.connect().execute("DELETE FROM tile_data WHERE zoom_level = ? AND x = ? AND y = ?", parse_tile_path(path))
+
+    def list_tiles(self, tiles_path: str, zoom: int) -> Iterator[tuple[int, int]]:
+        with self.lock:
+            rows = self.connect().execute("SELECT x, y FROM tile_data WHERE zoom_level = ?", (zoom,)).fetchall()
+        yield from rows
+
+    def list_tile_sizes(self, tiles_path: str, zoom: int, workers: int = 1) -> Iterator[tuple[int, int, int]]:
+        with self.lock:
+            rows = self.connect().execute("SELECT x, y, length(data) FROM tile_data WHERE zoom_level = ?", (zoom,)).fetchall()
+        yield from rows
+
+    def flush(self):
+        with self.lock:
+            if self.con is not None:
+                self.con.commit()
+
+    def close(self):
+        self.flush()
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["con"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def get_output_path(config: Config):
+    """
+    Returns the directory of index.html and the tiles. Each preset has a directory of its own.
+    """
+    if config.presets:
+        return f"chunky/scenes/{config.scene_name}/{config.render_name}"
+    return f"chunky/scenes/{config.scene_name}"
+
+
+def get_tiles_path(config: Config):
+    return f"{get_output_path(config)}/tiles"
+
+
+def create_tile_store(config: Config, file_extension: str) -> TileStore:
+    if config.tile_store == "directory":
+        return DirectoryTileStore(file_extension)
+    if config.tile_store == "packed":
+        return PackedTileStore(f"{get_output_path(config)}/tiles.pack", config.journal_mode)
+    raise ValueError(f"Unknown tile store: {config.tile_store}")
@@ -0,0 +1,318 @@
+import ctypes
+import ctypes.util
+import heapq
+import os
+import select
+import sqlite3
+import sys
+import time
+
+from config import Config
+from coord_index import CoordIndex
+from database import open_database, add_dirty_tiles
+from image import ImageHandler, create_image_handler
+from metrics import metrics
+from pipeline import PostProcessPipeline
+from pyramid import TileCache
+from region_scan import RegionScanCache
+from render import RenderPlan, get_zoom_tiles_to_render, make_pending_zoom_tiles, plan_presets, \
+    render_presets, scan_regions, tiles_to_batches, write_index
+from tile_math import get_chunk_padding_top, get_chunks_for_tile_chunklists, get_tiles_depending_on_chunks, get_tiles_for_chunks, \
+    get_tile_last_modified, get_tile_rect, to_tuples
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+
+def open_inotify(path: str):
+    """
+    Returns a non-blocking inotify file descriptor watching the files in path, or None where the C library doesn't
+    have inotify, which is everywhere but Linux.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class RegionWatcher:
+    """
+    Reports the region files of the world that changed, by their mtime and size. A changed region is only reported
+    once it has gone settle_time seconds without being modified, so it isn't read while the server saves it.
+
+    With inotify, waiting wakes up as soon as a region file is written. Without it, the region files are checked
+    every poll_interval seconds.
+    """
+    def __init__(self, config: Config):
+        self.config = config
+        self.region_path = os.path.join(config.world_path, "region")
+        self.fd = open_inotify(self.region_path)
+        self.stats = self.stat_regions()
+
+    def stat_regions(self) -> dict[tuple[int, int], os.stat_result]:
+        stats = {}
+        for entry in os.scandir(self.region_path):
+            parts = entry.name.split(".")
+            if len(parts) != 4 or parts[0] != "r" or parts[3] != "mca":
+                continue
+            try:
+                stats[(int(parts[1]), int(parts[2]))] = entry.stat()
+            except (ValueError, FileNotFoundError):
+                continue
+        return stats
+
+    def check(self) -> tuple[set[tuple[int, int]], float]:
+        """
+        Returns the changed regions that have settled, and the time at which the next of the unsettled ones will
+        have, or None if there are none.
+        """
+        now = time.time()
+        stats = self.stat_regions()
+        settled = set()
+        next_settled = None
+        for region in stats.keys() | self.stats.keys():
+            stat = stats.get(region)
+            previous = self.stats.get(region)
+            if stat is not None and previous is not None and (stat.st_mtime_ns, stat.st_size) == (previous.st_mtime_ns, previous.st_size):
+                continue
+            settled_time = now if stat is None else stat.st_mtime + self.config.watch_settle_time
+            if settled_time <= now:
+                settled.add(region)
+                if stat is None:
+                    del self.stats[region]
+                else:
+                    self.stats[region] = stat
+            elif next_settled is None or settled_time < next_settled:
+                next_settled = settled_time
+        return settled, next_settled
+
+    def get_changes(self, block: bool) -> set[tuple[int, int]]:
+        """
+        Returns the regions that changed and settled since the last call. With block, waits for there to be some.
+        """
+        while True:
+            settled, next_settled = self.check()
+            if len(settled) > 0 or not block:
+                return settled
+            if self.fd is None:
+                timeout = self.config.watch_poll_interval
+                if next_settled is not None:
+                    timeout = min(timeout, max(next_settled - time.time(), 0))
+                time.sleep(timeout)
+                continue
+            timeout = None if next_settled is None else max(next_settled - time.time(), 0)
+            select.select([self.fd], [], [], timeout)
+            self.drain_events()
+
+    def drain_events(self):
+        # Which files the events are for doesn't matter, since check compares every region file
+        while True:
+            try:
+                if len(os.read(self.fd, 65536)) == 0:
+                    return
+            except BlockingIOError:
+                return
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class BatchQueue:
+    """
+    Batches waiting to be rendered, the one with the latest change first. Pushing a batch that is already queued
+    raises its priority if the new one is higher.
+    """
+    def __init__(self):
+        self.heap = []
+        self.priorities = {}
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def push(self, batch: tuple[int, int], priority: int):
+        if self.priorities.get(batch, priority - 1) >= priority:
+            return
+        self.priorities[batch] = priority
+        heapq.heappush(self.heap, (-priority, batch))
+
+    def pop(self) -> tuple[int, int]:
+        while True:
+            priority, batch = heapq.heappop(self.heap)
+            # Entries whose priority was raised since are left in the heap and skipped here
+            if self.priorities.get(batch) == -priority:
+                del self.priorities[batch]
+                return batch
+
+
+def queue_tiles(config: Config, queue: BatchQueue, tiles_to_render: CoordIndex, tile_last_modified: CoordIndex):
+    """
+    Queues the batches of tiles_to_render, each by the latest change among its tiles.
+    """
+    tiles = tiles_to_render.coords()
+    priorities = {}
+    for (tile_x, tile_y), last_modified in zip(tiles.tolist(), tile_last_modified.lookup(tiles).tolist()):
+        batch = (tile_x // config.tile_batch_size, tile_y // config.tile_batch_size)
+        priorities[batch] = max(priorities.get(batch, 0), last_modified)
+    for batch, priority in priorities.items():
+        queue.push(batch, priority)
+
+
+def update_plans(
+        config: Config,
+        plans: list[tuple[Config, RenderPlan]],
+        cur: sqlite3.Cursor,
+        region_cache: RegionScanCache,
+        regions: set[tuple[int, int]],
+        region_stats: dict[tuple[int, int], os.stat_result],
+        queue: BatchQueue
+):
+    """
+    Rescans the changed regions and updates the plans of the presets with the tiles whose chunks changed, adding
+    them and their zoom parents to the journal and their batches to the queue. region_stats are the stats of the
+    region files as of the change, which are cached along with their scans.
+    """
+    # The chunk index is the same in every plan, so the first one's stands for all of them
+    first_plan = plans[0][1]
+    changed_chunks = {}
+    for region_x, region_z, region_chunks, error in scan_regions(config, [region for region in regions if region in region_stats]):
+        if error is not None:
+            print(f"Failed to scan region {region_x}, {region_z}: {error}", file=sys.stderr)
+            continue
+        region_chunks = region_cache.put(region_x, region_z, region_stats[(region_x, region_z)], region_chunks)
+        region_chunks = [chunk for chunk in region_chunks if chunk.complete]
+        padding_top = get_chunk_padding_top(config, [chunk.height for chunk in region_chunks]).tolist()
+        new_chunks = {(chunk.x, chunk.z): (padding, chunk.content_modified) for chunk, padding in zip(region_chunks, padding_top)}
+        for chunk_x in range(region_x * 32, region_x * 32 + 32):
+            for chunk_z in range(region_z * 32, region_z * 32 + 32):
+                chunk = (chunk_x, chunk_z)
+                if chunk in first_plan.chunk_padding_top:
+                    old = (first_plan.chunk_padding_top[chunk], first_plan.chunk_last_modified[chunk])
+                    if new_chunks.get(chunk) != old:
+                        changed_chunks[chunk] = (old, new_chunks.get(chunk))
+                elif chunk in new_chunks:
+                    changed_chunks[chunk] = (None, new_chunks[chunk])
+
+    # Chunks of deleted regions are removed from the index like any other
+    for region_x, region_z in regions - region_stats.keys():
+        region_chunks = get_tile_rect(region_x * 32, region_z * 32, region_x * 32 + 31, region_z * 32 + 31)
+        region_chunks = region_chunks[first_plan.chunk_padding_top.contains(region_chunks)]
+        for chunk in to_tuples(region_chunks):
+            changed_chunks[chunk] = ((first_plan.chunk_padding_top[chunk], first_plan.chunk_last_modified[chunk]), None)
+    region_cache.remove_missing(list(region_stats))
+    cur.connection.commit()
+
+    print(f"{len(regions)} regions changed, with {len(changed_chunks)} changed chunks.")
+    if len(changed_chunks) == 0:
+        return
+
+    chunks = list(changed_chunks)
+    # Tiles that could see a chunk before or after the change
+    padding_top = [max(old[0] if old else 0, new[0] if new else 0) for old, new in changed_chunks.values()]
+    tiles = get_tiles_depending_on_chunks(config, chunks, padding_top)
+    removed_chunks = [chunk for chunk, (_, new) in changed_chunks.items() if new is None]
+    added_chunks = [chunk for chunk, (_, new) in changed_chunks.items() if new is not None]
+    added_padding_top, added_last_modified = zip(*[changed_chunks[chunk][1] for chunk in added_chunks]) if added_chunks else ((), ())
+    new_tiles = CoordIndex(get_tiles_for_chunks(config, added_chunks, added_padding_top))
+
+    for _, plan in plans:
+        plan.chunk_padding_top.discard(removed_chunks)
+        plan.chunk_last_modified.discard(removed_chunks)
+        plan.chunk_padding_top.update(added_chunks, added_padding_top)
+        plan.chunk_last_modified.update(added_chunks, added_last_modified)
+
+    # Tiles no longer seeing any chunk are rendered once more, empty, rather than left showing what was removed
+    tiles = tiles[first_plan.tile_last_modified.contains(tiles) | new_tiles.contains(tiles)]
+    # Only the chunks the tiles can see are looked up, rather than every chunk in the world
+    nearby_chunks = get_chunks_for_tile_chunklists(config, tiles)
+    nearby_chunks = nearby_chunks[first_plan.chunk_padding_top.contains(nearby_chunks)]
+    last_modified = get_tile_last_modified(
+        config,
+        nearby_chunks,
+        first_plan.chunk_last_modified.lookup(nearby_chunks),
+        tiles,
+        first_plan.chunk_padding_top.lookup(nearby_chunks)
+    )
+
+    for preset, plan in plans:
+        dirty_tiles = CoordIndex(tiles[plan.tile_last_modified.lookup(tiles, default=-1) != last_modified])
+        plan.tile_last_modified.update(tiles, last_modified)
+        plan.tiles_to_render |= dirty_tiles
+        zoom_tiles_to_render = get_zoom_tiles_to_render(dirty_tiles, config.zoom_levels)
+        plan.zoom_tiles_to_render |= zoom_tiles_to_render
+        add_dirty_tiles(cur, preset.render_name, zoom_tiles_to_render)
+        queue_tiles(config, queue, dirty_tiles, plan.tile_last_modified)
+        print(f"Queued {len(dirty_tiles)} changed tiles of {preset.render_name} in {len(tiles_to_batches(config, dirty_tiles))} batches.")
+
+
+def watch(config: Config, image_handler: ImageHandler):
+    """
+    Renders every preset like render, then keeps the chunk and tile index in memory and re-renders the tiles of
+    chunks that change, until interrupted. Batches with the most recently changed chunks are rendered first, and
+    changes are picked up between batches.
+    """
+    con = open_database(config)
+    cur = con.cursor()
+
+    # Started before planning, so no change made during it is missed
+    watcher = RegionWatcher(config)
+    print("Watching region files with " + ("inotify." if watcher.fd is not None else f"polling every {config.watch_poll_interval} seconds."))
+
+    with metrics.span("plan"):
+        plans = plan_presets(config, cur)
+    for preset, _ in plans:
+        write_index(preset)
+    image_handlers = [image_handler] + [create_image_handler(preset) for preset, _ in plans[1:]]
+    tile_caches = [TileCache(config.pyramid_cache_tiles) for _ in plans]
+    region_cache = RegionScanCache(cur)
+
+    queue = BatchQueue()
+    for _, plan in plans:
+        queue_tiles(config, queue, plan.tiles_to_render, plan.tile_last_modified)
+
+    zoom_tiles_pending = True
+    try:
+        with PostProcessPipeline(config.postprocess_queue_size) as pipeline:
+            while True:
+                regions = watcher.get_changes(block=len(queue) == 0 and not zoom_tiles_pending)
+                if len(regions) > 0:
+                    with metrics.span("watch_update", regions=len(regions)):
+                        update_plans(config, plans, cur, region_cache, regions, watcher.stats, queue)
+                    zoom_tiles_pending = True
+
+                if len(queue) > 0:
+                    batch_x, batch_y = queue.pop()
+                    print(f"Rendering batch {batch_x}, {batch_y}. {len(queue)} batches queued.")
+                    render_presets(config, plans, image_handlers, tile_caches, cur, pipeline, batch_x, batch_y)
+                    # The plans and the cursor belong to the pipeline until it is drained
+                    pipeline.wait()
+                    metrics.count("batches")
+                    metrics.flush()
+                elif zoom_tiles_pending:
+                    for (preset, _), preset_image_handler in zip(plans, image_handlers):
+                        make_pending_zoom_tiles(preset, preset_image_handler, cur)
+                    zoom_tiles_pending = False
+                    metrics.flush()
+                    print("Up to date. Waiting for region files to change...")
+    except KeyboardInterrupt:
+        print("Stopped watching. Tiles still pending are picked up by the next run.")
+    finally:
+        watcher.close()
+        for preset_image_handler in image_handlers[1:]:
+            preset_image_handler.close()